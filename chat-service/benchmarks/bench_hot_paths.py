@@ -0,0 +1,194 @@
+"""
+Benchmark: chat-service hot paths, with a saved baseline and a regression gate
+
+Times, in this process:
+  - parse/*: separate_text_and_code and extract_python_code on a large response
+  - load_csv/*: CodeExecutor.load_csv at several file sizes
+  - execute/*: execute_code overhead - a trivial block, a block that uses the
+    DataFrame (copied in thread isolation, sent to the worker in process
+    isolation), the same once the DataFrame is snapshotted (memory-mapped by
+    the worker) and a block that renders a plot
+  - dataframe_info: get_dataframe_info on the largest frame
+  - sse/*: sse_event for text deltas and a plot frame
+
+Each case runs --repeat times; the fastest run is compared against the
+baseline, which is the least noisy figure on a shared machine. Baselines are
+per machine (see .gitignore): save one from the main branch, then compare a
+change on the same host.
+
+Usage:
+    python benchmarks/bench_hot_paths.py --save-baseline
+    python benchmarks/bench_hot_paths.py --compare --threshold 0.2
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+os.environ.setdefault("EXECUTOR_PREWARM", "0")
+os.environ.setdefault("SNAPSHOTS", "0")
+
+import numpy as np  # noqa: E402
+import pandas as pd  # noqa: E402
+
+import main  # noqa: E402
+import snapshots  # noqa: E402
+from code_executor import EXECUTOR_ISOLATION, CodeExecutor  # noqa: E402
+from data_analysis_agent import extract_python_code, separate_text_and_code  # noqa: E402
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), "baselines", "hot_paths.json")
+
+
+def time_case(fn: Callable[[], object], repeat: int, min_seconds: float = 0.05) -> Dict[str, float]:
+    """Per-call seconds of fn: calls are batched so one timed run lasts at least min_seconds"""
+    start = time.perf_counter()
+    fn()  # Warm-up, also sizes the batch
+    single = time.perf_counter() - start
+    number = max(1, int(min_seconds / single)) if single > 0 else 1000
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        runs.append((time.perf_counter() - start) / number)
+    return {"min": min(runs), "median": statistics.median(runs), "calls": number * repeat}
+
+
+def large_response(blocks: int = 40) -> str:
+    parts = []
+    for i in range(blocks):
+        parts.append(f"Step {i}: " + "the analysis continues with more explanation. " * 40)
+        parts.append("```python\n" + "\n".join(f"x_{j} = df['value'].rolling({j + 2}).mean()" for j in range(30)) + "\n```")
+    return "\n\n".join(parts)
+
+
+def write_csv(directory: str, rows: int) -> str:
+    rng = np.random.default_rng(0)
+    path = os.path.join(directory, f"rows_{rows}.csv")
+    pd.DataFrame({
+        "id": np.arange(rows),
+        "value": rng.normal(size=rows),
+        "amount": rng.integers(0, 10_000, size=rows),
+        "region": rng.choice(["north", "south", "east", "west"], size=rows),
+        "label": rng.choice(["alpha", "beta", "gamma"], size=rows),
+    }).to_csv(path, index=False)
+    return path
+
+
+def run_suite(sizes: List[int], repeat: int, only: str) -> Dict[str, Dict[str, float]]:
+    results = {}
+
+    def case(name: str, fn: Callable[[], object], case_repeat: int = repeat):
+        if only and only not in name:
+            return
+        results[name] = time_case(fn, case_repeat)
+        print(f"  {name:<34} {results[name]['min'] * 1000:>10.3f} ms", flush=True)
+
+    response = large_response()
+    case("parse/separate_text_and_code", lambda: separate_text_and_code(response))
+    case("parse/extract_python_code", lambda: extract_python_code(response))
+
+    executor = CodeExecutor()
+    with tempfile.TemporaryDirectory() as directory:
+        paths = {rows: write_csv(directory, rows) for rows in sizes}
+        for rows, path in paths.items():
+            case(f"load_csv/{rows}_rows", lambda path=path: executor.load_csv(path, "df"), max(3, repeat // 2))
+
+        executor.load_csv(paths[max(sizes)], "df")
+        case("execute/noop", lambda: executor.execute_code("x = 1"))
+        case("execute/uses_dataframe", lambda: executor.execute_code("print(len(df))"))
+        case("execute/plot", lambda: executor.execute_code("plt.figure()\nplt.hist(df['value'].head(10_000), bins=30)"))
+        case("dataframe_info", lambda: executor.get_dataframe_info("df"))
+        if importlib.util.find_spec("pyarrow") is not None:
+            snapshots.SNAPSHOT_DIR = Path(directory)
+            frames, datasets, df_count = executor.snapshot_changes()
+            written = snapshots.write_snapshot(0, frames, datasets, df_count)
+            executor.snapshot_written(frames, written, {name: snapshots.frame_path(0, name) for name in written})
+            case("execute/uses_snapshotted_dataframe", lambda: executor.execute_code("print(len(df))"))
+        executor.clear()
+
+    progress = main.TurnProgress("csv_analysis")
+    delta = {"content": "The mean value per region is roughly constant ", "done": False}
+    plot = {"type": "image", "data": "iVBORw0KGgo" * 10_000, "done": False}  # ~110 KB of base64
+    case("sse/text_delta", lambda: main.sse_event(delta, progress))
+    case("sse/plot_frame", lambda: main.sse_event(plot))
+    return results
+
+
+def environment() -> Dict[str, str]:
+    return {
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "cpus": str(os.cpu_count()),
+        "isolation": EXECUTOR_ISOLATION,
+    }
+
+
+def compare(results: Dict[str, Dict[str, float]], baseline: dict, threshold: float) -> List[str]:
+    """Print current vs baseline and return the cases slower than the threshold allows"""
+    for key, value in baseline.get("environment", {}).items():
+        if environment().get(key) != value:
+            print(f"warning: baseline {key} was {value}, now {environment().get(key)}")
+    regressions = []
+    print(f"\n| {'case':<34} | {'baseline':>11} | {'current':>11} | {'change':>7} |")
+    print(f"|{'-' * 36}|{'-' * 13}|{'-' * 13}|{'-' * 9}|")
+    for name, current in results.items():
+        previous = baseline["results"].get(name)
+        if previous is None:
+            print(f"| {name:<34} | {'-':>11} | {current['min'] * 1000:>8.3f} ms | {'new':>7} |")
+            continue
+        change = current["min"] / previous["min"] - 1
+        flag = " !" if change > threshold else ""
+        print(f"| {name:<34} | {previous['min'] * 1000:>8.3f} ms | {current['min'] * 1000:>8.3f} ms | {change:>+6.0%}{flag} |")
+        if change > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000], help="CSV rows")
+    parser.add_argument("--repeat", type=int, default=7)
+    parser.add_argument("--filter", default="", help="only run cases whose name contains this")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="write the results as the new baseline")
+    parser.add_argument("--compare", action="store_true", help="exit 1 if a case regressed beyond --threshold")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    print(f"chat-service hot paths ({EXECUTOR_ISOLATION} isolation, best of {args.repeat})")
+    results = run_suite(sorted(args.sizes), args.repeat, args.filter)
+
+    if args.save_baseline:
+        saved = {}
+        if args.filter and os.path.exists(args.baseline):  # Update only the cases that ran
+            with open(args.baseline) as f:
+                saved = json.load(f)["results"]
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump({"environment": environment(), "results": {**saved, **results}}, f, indent=2)
+        print(f"\nBaseline saved to {args.baseline}")
+    if args.compare:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) over {args.threshold:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+        print(f"\nNo regressions over {args.threshold:.0%}")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,101 @@
+"""
+Benchmark: typical analysis-agent queries on pandas vs the DuckDB sql() engine
+
+Generates a synthetic sales CSV (plus a small dimension table for joins), then
+times each query three ways:
+  - pandas (warm): on an already-loaded DataFrame, as CodeExecutor runs today
+  - pandas (cold): including pd.read_csv, as on the first question of a session
+  - duckdb: sql() straight over the CSV file, as exposed by CodeExecutor
+
+Usage:
+    python benchmarks/bench_query_engine.py --rows 5000000
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from code_executor import _make_sql_function  # noqa: E402
+
+
+def generate(path: str, dim_path: str, rows: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    pd.DataFrame({
+        "order_id": np.arange(rows),
+        "customer_id": rng.integers(0, max(rows // 20, 1), rows),
+        "region": rng.choice(["north", "south", "east", "west", "central"], rows),
+        "product_id": rng.integers(0, 1000, rows),
+        "quantity": rng.integers(1, 20, rows),
+        "price": rng.gamma(2.0, 30.0, rows).round(2),
+    }).to_csv(path, index=False)
+    pd.DataFrame({
+        "product_id": np.arange(1000),
+        "category": rng.choice(["toys", "books", "food", "garden", "tools"], 1000),
+    }).to_csv(dim_path, index=False)
+
+
+PANDAS_QUERIES = {
+    "group-by sum": lambda df, dim: df.assign(revenue=df.quantity * df.price).groupby("region")["revenue"].sum(),
+    "filter + mean": lambda df, dim: df.loc[df.quantity > 10, "price"].mean(),
+    "distinct count": lambda df, dim: df["customer_id"].nunique(),
+    "top-10 customers": lambda df, dim: df.groupby("customer_id")["price"].sum().nlargest(10),
+    "join + group-by": lambda df, dim: df.merge(dim, on="product_id").groupby("category")["quantity"].sum(),
+}
+
+SQL_QUERIES = {
+    "group-by sum": "SELECT region, SUM(quantity * price) AS revenue FROM df GROUP BY region",
+    "filter + mean": "SELECT AVG(price) FROM df WHERE quantity > 10",
+    "distinct count": "SELECT COUNT(DISTINCT customer_id) FROM df",
+    "top-10 customers": "SELECT customer_id, SUM(price) AS total FROM df GROUP BY customer_id ORDER BY total DESC LIMIT 10",
+    "join + group-by": "SELECT category, SUM(quantity) FROM df JOIN products USING (product_id) GROUP BY category",
+}
+
+
+def timed(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "sales.csv")
+        dim_path = os.path.join(tmp, "products.csv")
+        generate(path, dim_path, args.rows)
+        size_mb = os.path.getsize(path) / 1024**2
+
+        load_seconds = timed(lambda: pd.read_csv(path), 1)
+        df = pd.read_csv(path)
+        dim = pd.read_csv(dim_path)
+        sql, close = _make_sql_function({"df": path, "products": dim_path})
+        sql("SELECT 1")  # Open the connection outside the timings
+
+        print(f"{args.rows:,} rows, {size_mb:.1f} MB CSV; pandas read_csv: {load_seconds:.3f}s; "
+              f"DataFrame memory: {df.memory_usage(deep=True).sum() / 1024**2:.1f} MB\n")
+        print(f"| {'query':<18} | {'pandas warm':>11} | {'pandas cold':>11} | {'duckdb':>9} | {'speedup (cold)':>14} |")
+        print(f"|{'-' * 20}|{'-' * 13}|{'-' * 13}|{'-' * 11}|{'-' * 16}|")
+        for name, pandas_query in PANDAS_QUERIES.items():
+            warm = timed(lambda: pandas_query(df, dim), args.repeat)
+            duck = timed(lambda: sql(SQL_QUERIES[name]), args.repeat)
+            cold = load_seconds + warm
+            print(f"| {name:<18} | {warm:>10.3f}s | {cold:>10.3f}s | {duck:>8.3f}s | {cold / duck:>13.1f}x |")
+        close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""
+Benchmark: time to first token of a chat turn, serial vs pipelined storage I/O
+
+storage-service is replaced by an httpx.MockTransport that adds a fixed
+latency per request, and OpenAI by a fake stream whose first token arrives
+after --llm-ms. Compares:
+  - serial: save the user message, then fetch history, then fetch each image,
+    then call the model (the handler's previous behaviour)
+  - pipelined: stream_chat_response as it runs now (save and history read
+    overlap, images are fetched concurrently)
+
+The assistant's answer is still saved before the final "done" frame, well
+after the first token, so it does not affect these figures.
+
+Usage:
+    python benchmarks/bench_ttft.py --storage-ms 40 --history 20 --images 3
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+import types
+
+import httpx
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+os.environ.setdefault("EXECUTOR_PREWARM", "0")
+
+import main  # noqa: E402
+
+PIXEL_PNG = bytes.fromhex(
+    "89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+    "1f15c4890000000d49444154789c6300010000050001"
+    "0d0a2db40000000049454e44ae426082"
+)
+
+
+def mock_storage(latency: float, history: int, images: int) -> httpx.MockTransport:
+    stored = [
+        {
+            "id": i,
+            "role": "user" if i % 2 == 0 else "assistant",
+            "content": f"message {i}",
+            "image_url": f"/uploads/image-{i}.png" if i % 2 == 0 and i // 2 < images else None,
+        }
+        for i in range(history)
+    ]
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(latency)
+        if request.url.path.startswith("/uploads/"):
+            return httpx.Response(200, content=PIXEL_PNG, headers={"content-type": "image/png"})
+        if request.method == "POST":
+            body = json.loads(request.content)
+            return httpx.Response(200, json={**body, "id": len(stored) + 1})
+        return httpx.Response(200, json=stored)
+
+    return httpx.MockTransport(handler)
+
+
+def fake_openai(llm_latency: float):
+    class Stream:
+        def __init__(self):
+            self.sent = 0
+
+        def __aiter__(self):
+            return self
+
+        async def __anext__(self):
+            if self.sent == 20:
+                raise StopAsyncIteration
+            await asyncio.sleep(llm_latency if self.sent == 0 else 0.001)
+            self.sent += 1
+            delta = types.SimpleNamespace(content=f"token{self.sent} ")
+            return types.SimpleNamespace(choices=[types.SimpleNamespace(delta=delta)], usage=None)
+
+        async def close(self):
+            pass
+
+    async def create(**kwargs):
+        return Stream()
+
+    return types.SimpleNamespace(chat=types.SimpleNamespace(completions=types.SimpleNamespace(create=create)))
+
+
+async def serial_ttft(conversation_id: int) -> float:
+    start = time.perf_counter()
+    await main.post_message(conversation_id, {"role": "user", "content": "hi", "image_url": None, "plots": None})
+    history = [await main.format_history_message(msg) for msg in await main.fetch_messages(conversation_id)]
+    stream = await main.client.chat.completions.create(model="m", messages=history, stream=True)
+    async for _ in stream:
+        return time.perf_counter() - start
+
+
+async def pipelined_ttft(conversation_id: int) -> float:
+    start = time.perf_counter()
+    frames = main.stream_chat_response(conversation_id, "hi", "m")
+    async for frame in frames:
+        if '"content": "token' in frame:
+            elapsed = time.perf_counter() - start
+            await frames.aclose()
+            return elapsed
+
+
+async def run(args):
+    main.storage_client = httpx.AsyncClient(
+        base_url="http://storage", transport=mock_storage(args.storage_ms / 1000, args.history, args.images)
+    )
+    main.client = fake_openai(args.llm_ms / 1000)
+
+    results = {"serial": [], "pipelined": []}
+    for i in range(args.repeat):
+        for name, measure in (("serial", serial_ttft), ("pipelined", pipelined_ttft)):
+            main._image_cache.clear()  # Measure cold image fetches every time
+            results[name].append(await measure(i))
+    await main.persistence.drain(timeout=10)
+    await main.storage_client.aclose()
+    return results
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--storage-ms", type=float, default=40.0, help="latency per storage-service request")
+    parser.add_argument("--llm-ms", type=float, default=300.0, help="model latency to the first token")
+    parser.add_argument("--history", type=int, default=20, help="messages already in the conversation")
+    parser.add_argument("--images", type=int, default=3, help="history messages carrying an image")
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    serial = statistics.median(results["serial"])
+    pipelined = statistics.median(results["pipelined"])
+    print(f"storage latency {args.storage_ms:.0f} ms, model first token {args.llm_ms:.0f} ms, "
+          f"{args.history} history messages ({args.images} with images)\n")
+    print(f"| {'pipeline':<10} | {'median TTFT':>11} | {'storage wait':>12} |")
+    print(f"|{'-' * 12}|{'-' * 13}|{'-' * 14}|")
+    for name, value in (("serial", serial), ("pipelined", pipelined)):
+        print(f"| {name:<10} | {value * 1000:>8.1f} ms | {(value - args.llm_ms / 1000) * 1000:>9.1f} ms |")
+    print(f"\nTTFT reduced by {(serial - pipelined) * 1000:.1f} ms ({(1 - pipelined / serial) * 100:.0f}%)")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,236 @@
+"""
+Conversation-affine scale-out of chat-service
+
+Analysis state (a conversation's CodeExecutor and its DataFrames) lives in the
+memory of one chat-service node. With CLUSTER_MODE enabled, several nodes
+(replicas, each with its own CLUSTER_NODE_URL) share a registry of live nodes
+and of which node holds each conversation's executor:
+
+  - a conversation already placed stays on its node while that node is alive
+  - a new conversation is placed on the live nodes with a consistent-hash ring,
+    so adding a node moves only ~1/N of new placements
+  - a request arriving at the wrong node is proxied to the owner
+  - when the owner stops heartbeating the conversation is re-placed, and the
+    new owner rehydrates it from the recorded CSV source; an owner that still
+    heartbeats but refuses a connection is retried, never dropped, so one
+    replica's network hiccup cannot split a conversation across two nodes
+
+The registry is Redis (CLUSTER_MODE=redis, `pip install "chat-service[cluster]"`)
+or, for replicas on one host, a shared SQLite file (CLUSTER_MODE=local).
+"""
+
+import asyncio
+import bisect
+import hashlib
+import logging
+import os
+import re
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+from metrics import CLUSTER_NODES
+
+CLUSTER_MODE = os.getenv("CLUSTER_MODE", "off")  # off | local | redis
+CLUSTER_NODE_URL = os.getenv("CLUSTER_NODE_URL", "http://localhost:8001")  # How other nodes reach this one
+CLUSTER_NODE_ID = re.sub(r"[^A-Za-z0-9_-]", "-", os.getenv("CLUSTER_NODE_ID") or f"{socket.gethostname()}-{os.getpid()}")
+CLUSTER_REGISTRY_PATH = os.getenv("CLUSTER_REGISTRY_PATH", os.path.join(tempfile.gettempdir(), "chat-service-cluster.db"))
+CLUSTER_REDIS_URL = os.getenv("CLUSTER_REDIS_URL", "redis://localhost:6379/0")
+CLUSTER_HEARTBEAT_SECONDS = float(os.getenv("CLUSTER_HEARTBEAT_SECONDS", "5"))
+CLUSTER_NODE_TTL_SECONDS = float(os.getenv("CLUSTER_NODE_TTL_SECONDS", "15"))  # Missed heartbeats before a node is dead
+HASH_RING_VNODES = int(os.getenv("HASH_RING_VNODES", "160"))  # Keeps node shares within a few percent
+
+# Set on proxied requests so the receiving node always handles them itself
+FORWARDED_HEADER = "X-Chat-Forwarded-By"
+
+logger = logging.getLogger(__name__)
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """Consistent-hash ring with virtual nodes"""
+
+    def __init__(self, nodes: List[str], vnodes: int = HASH_RING_VNODES):
+        points = sorted((_hash(f"{node}#{i}"), node) for node in nodes for i in range(vnodes))
+        self._points = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node_for(self, key) -> Optional[str]:
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, _hash(str(key))) % len(self._points)
+        return self._nodes[index]
+
+
+class LocalRegistry:
+    """Registry in a SQLite file shared by the replicas of one host (stand-in for Redis)"""
+
+    def __init__(self, path: str = CLUSTER_REGISTRY_PATH):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=5.0, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS nodes (node_id TEXT PRIMARY KEY, url TEXT, last_seen REAL)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS executors (conversation_id INTEGER PRIMARY KEY, node_id TEXT, csv_path TEXT)"
+        )
+
+    def _execute(self, sql: str, params: tuple = ()) -> list:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def heartbeat(self, node_id: str, url: str):
+        self._execute(
+            "INSERT INTO nodes VALUES (?, ?, ?) ON CONFLICT(node_id) DO UPDATE SET url = excluded.url, last_seen = excluded.last_seen",
+            (node_id, url, time.time()),
+        )
+
+    def remove_node(self, node_id: str):
+        self._execute("DELETE FROM nodes WHERE node_id = ?", (node_id,))
+
+    def live_nodes(self) -> Dict[str, str]:
+        rows = self._execute("SELECT node_id, url FROM nodes WHERE last_seen > ?", (time.time() - CLUSTER_NODE_TTL_SECONDS,))
+        return dict(rows)
+
+    def location(self, conversation_id: int) -> Optional[dict]:
+        rows = self._execute("SELECT node_id, csv_path FROM executors WHERE conversation_id = ?", (conversation_id,))
+        return {"node_id": rows[0][0], "csv_path": rows[0][1]} if rows else None
+
+    def claim(self, conversation_id: int, node_id: str, csv_path: Optional[str]):
+        self._execute(
+            "INSERT OR REPLACE INTO executors VALUES (?, ?, ?)", (conversation_id, node_id, csv_path)
+        )
+
+    def release(self, conversation_id: int):
+        self._execute("DELETE FROM executors WHERE conversation_id = ?", (conversation_id,))
+
+    def close(self):
+        self._conn.close()
+
+
+class RedisRegistry:
+    """Registry in Redis: node keys expire with their heartbeats, placements are hashes"""
+
+    def __init__(self, url: str = CLUSTER_REDIS_URL):
+        import redis  # Optional dependency, only needed for CLUSTER_MODE=redis
+
+        self._redis = redis.Redis.from_url(url, decode_responses=True)
+
+    def heartbeat(self, node_id: str, url: str):
+        self._redis.set(f"chat:node:{node_id}", url, px=int(CLUSTER_NODE_TTL_SECONDS * 1000))
+
+    def remove_node(self, node_id: str):
+        self._redis.delete(f"chat:node:{node_id}")
+
+    def live_nodes(self) -> Dict[str, str]:
+        keys = list(self._redis.scan_iter("chat:node:*"))
+        urls = self._redis.mget(keys) if keys else []
+        return {key.split(":", 2)[2]: url for key, url in zip(keys, urls) if url}
+
+    def location(self, conversation_id: int) -> Optional[dict]:
+        placement = self._redis.hgetall(f"chat:executor:{conversation_id}")
+        return {"node_id": placement["node_id"], "csv_path": placement.get("csv_path") or None} if placement else None
+
+    def claim(self, conversation_id: int, node_id: str, csv_path: Optional[str]):
+        self._redis.hset(f"chat:executor:{conversation_id}", mapping={"node_id": node_id, "csv_path": csv_path or ""})
+
+    def release(self, conversation_id: int):
+        self._redis.delete(f"chat:executor:{conversation_id}")
+
+    def close(self):
+        self._redis.close()
+
+
+class Cluster:
+    """This node's view of the cluster: membership, placement and ownership"""
+
+    def __init__(self, registry, node_id: str = CLUSTER_NODE_ID, node_url: str = CLUSTER_NODE_URL):
+        self.registry = registry
+        self.node_id = node_id
+        self.node_url = node_url
+        self._nodes: Dict[str, str] = {node_id: node_url}
+        self._ring = HashRing([node_id])
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        self._stopping: Optional[asyncio.Event] = None
+        CLUSTER_NODES.set_function(lambda: len(self._nodes))
+
+    def _set_nodes(self, nodes: Dict[str, str]):
+        nodes[self.node_id] = self.node_url  # This node is always a candidate, even mid-heartbeat
+        if nodes.keys() != self._nodes.keys():
+            logger.info("Cluster membership: %s", ", ".join(sorted(nodes)))
+            self._ring = HashRing(list(nodes))
+        self._nodes = nodes
+
+    async def _heartbeat(self):
+        while not self._stopping.is_set():
+            try:
+                await asyncio.to_thread(self.registry.heartbeat, self.node_id, self.node_url)
+                self._set_nodes(await asyncio.to_thread(self.registry.live_nodes))
+            except Exception as e:  # Registry briefly unreachable: keep routing with the last view
+                logger.warning("Cluster heartbeat failed: %s", e)
+            try:
+                await asyncio.wait_for(self._stopping.wait(), CLUSTER_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+    async def start(self):
+        await asyncio.to_thread(self.registry.heartbeat, self.node_id, self.node_url)
+        self._set_nodes(await asyncio.to_thread(self.registry.live_nodes))
+        self._stopping = asyncio.Event()
+        self._heartbeat_task = asyncio.create_task(self._heartbeat())
+
+    async def stop(self):
+        """Leave the cluster; this node's conversations are re-placed on their next request"""
+        if self._heartbeat_task is not None:
+            # Not cancelled: cancelling would abandon a registry call still running in its thread
+            self._stopping.set()
+            await self._heartbeat_task
+        await asyncio.to_thread(self.registry.remove_node, self.node_id)
+        self.registry.close()
+
+    def node_url_for(self, node_id: str) -> Optional[str]:
+        return self._nodes.get(node_id)
+
+    async def owner(self, conversation_id: int) -> str:
+        """Node that holds (or should hold) a conversation's executor"""
+        location = await asyncio.to_thread(self.registry.location, conversation_id)
+        if location is not None and location["node_id"] in self._nodes:
+            return location["node_id"]
+        return self._ring.node_for(conversation_id)
+
+    async def claim(self, conversation_id: int, csv_path: Optional[str]) -> Optional[dict]:
+        """Record this node as the conversation's owner; returns the previous placement, if any"""
+        previous = await asyncio.to_thread(self.registry.location, conversation_id)
+        if previous is None or previous["node_id"] != self.node_id or previous["csv_path"] != csv_path:
+            await asyncio.to_thread(self.registry.claim, conversation_id, self.node_id, csv_path)
+        return previous
+
+    async def release(self, conversation_id: int):
+        await asyncio.to_thread(self.registry.release, conversation_id)
+
+    async def is_live(self, node_id: str) -> bool:
+        """Re-read membership after a node refused a connection: has its heartbeat expired?
+
+        Only the node's own missed heartbeats take it out of the cluster; a connection
+        error seen by one replica may be local to that replica.
+        """
+        try:
+            self._set_nodes(await asyncio.to_thread(self.registry.live_nodes))
+        except Exception as e:  # Registry unreachable too: assume the node is still alive
+            logger.warning("Cluster membership refresh failed: %s", e)
+        return node_id in self._nodes
+
+
+def create_cluster() -> Optional[Cluster]:
+    if CLUSTER_MODE == "off":
+        return None
+    if CLUSTER_MODE == "redis":
+        return Cluster(RedisRegistry())
+    if CLUSTER_MODE == "local":
+        return Cluster(LocalRegistry())
+    raise ValueError(f"Unknown CLUSTER_MODE {CLUSTER_MODE!r} (expected off, local or redis)")
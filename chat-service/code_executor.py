@@ -3,29 +3,704 @@ Sandboxed Python Code Executor for Data Analysis
 Inspired by MCP server data exploration
 """
 
-import pandas as pd
-import numpy as np
-import matplotlib
-matplotlib.use('Agg')  # Non-interactive backend
-import matplotlib.pyplot as plt
-import seaborn as sns
+from __future__ import annotations
+
 import io
+import re
 import sys
+import ast
+import keyword
 import base64
-from typing import Dict, Optional, List, Tuple
+import threading
+from collections import OrderedDict, deque
+from collections.abc import MutableMapping
+from contextvars import ContextVar
+from typing import Deque, Dict, Optional, List, Tuple
 import traceback
 import json
+import time
+import os
+import signal
+import socket
+import subprocess
+import multiprocessing
+import multiprocessing.connection
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import reduction
+from multiprocessing.connection import Connection
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Execution isolation: 'process' forks a resource-limited child per execution,
+# 'thread' runs in-process (no preemptive limits, used where fork is unavailable)
+EXECUTOR_ISOLATION = os.getenv("EXECUTOR_ISOLATION", "process")
+EXECUTION_TIMEOUT_SECONDS = float(os.getenv("EXECUTION_TIMEOUT_SECONDS", "60"))
+EXECUTION_CPU_SECONDS = int(os.getenv("EXECUTION_CPU_SECONDS", "60"))
+EXECUTION_MEMORY_MB = int(os.getenv("EXECUTION_MEMORY_MB", "2048"))  # Address space on top of the parent's
+# Captured stdout keeps its first and last MAX_STDOUT_BYTES / 2; the middle is dropped as it is printed
+MAX_STDOUT_BYTES = int(os.getenv("MAX_STDOUT_BYTES", str(64 * 1024)))
+EXECUTION_HISTORY_SIZE = int(os.getenv("EXECUTION_HISTORY_SIZE", "50"))
+MAX_PLOTS = int(os.getenv("MAX_PLOTS", "10"))
+MAX_PLOT_BYTES = int(os.getenv("MAX_PLOT_BYTES", str(5 * 1024 * 1024)))
+# Keep forked, warmed workers waiting for the next executions (they hold no conversation data)
+EXECUTOR_PREFORK = os.getenv("EXECUTOR_PREFORK", "1") == "1"
+EXECUTOR_STANDBY_WORKERS = max(1, int(os.getenv("EXECUTOR_STANDBY_WORKERS", "2")))
+# Optional columnar engine exposed to generated code as sql(); 'none' disables it
+QUERY_ENGINE = os.getenv("QUERY_ENGINE", "duckdb")
+QUERY_ENGINE_THREADS = int(os.getenv("QUERY_ENGINE_THREADS", str(os.cpu_count() or 4)))
+# Datasets not loaded yet are profiled from their first rows
+PROFILE_SAMPLE_ROWS = int(os.getenv("PROFILE_SAMPLE_ROWS", "1000"))
+PROFILE_MAX_COLUMNS = int(os.getenv("PROFILE_MAX_COLUMNS", "60"))
+
+# Names generated code already uses for something else
+_RESERVED_NAMES = {'pd', 'np', 'plt', 'sns', 'sql', 'print'}
+
+_FORK_AVAILABLE = resource is not None and 'fork' in multiprocessing.get_all_start_methods()
+_PROCESS_ISOLATION = EXECUTOR_ISOLATION == 'process' and _FORK_AVAILABLE
+
+
+def _current_address_space() -> int:
+    """Virtual memory size of this process in bytes (Linux), 0 if unknown"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[0]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return 0
+
+
+def _apply_resource_limits():
+    """Apply CPU-time and address-space limits to the current (child) process"""
+    resource.setrlimit(resource.RLIMIT_CPU, (EXECUTION_CPU_SECONDS, EXECUTION_CPU_SECONDS + 1))
+    # The forked child inherits the parent's mappings, so the cap is headroom on top of them
+    address_space = _current_address_space()
+    if address_space:
+        limit = address_space + EXECUTION_MEMORY_MB * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+# Per-execution stdout target and pyplot figure registry. Both are context-local,
+# so executions running concurrently on different threads never see each other's
+# prints or figures.
+_stdout_target: ContextVar[Optional[io.TextIOBase]] = ContextVar('stdout_target', default=None)
+_figure_registry: ContextVar[Optional[OrderedDict]] = ContextVar('figure_registry', default=None)
+
+
+class _ContextLocalStdout(io.TextIOBase):
+    """sys.stdout replacement that writes to the current execution's buffer, if any"""
+    
+    def __init__(self, fallback):
+        self._fallback = fallback
+    
+    def _target(self):
+        target = _stdout_target.get()
+        return target if target is not None else self._fallback
+    
+    def write(self, text):
+        return self._target().write(text)
+    
+    def flush(self):
+        return self._target().flush()
+    
+    def writable(self):
+        return True
+    
+    def isatty(self):
+        return _stdout_target.get() is None and self._fallback.isatty()
+    
+    def fileno(self):
+        return self._fallback.fileno()
+    
+    @property
+    def encoding(self):
+        return getattr(self._fallback, 'encoding', 'utf-8')
+
+
+class _ContextLocalFigureRegistry(MutableMapping):
+    """Stand-in for pyplot's global Gcf.figs that is scoped to the current execution"""
+    
+    def __init__(self, fallback: OrderedDict):
+        self._fallback = fallback
+    
+    def _current(self) -> OrderedDict:
+        registry = _figure_registry.get()
+        return registry if registry is not None else self._fallback
+    
+    def __getitem__(self, key):
+        return self._current()[key]
+    
+    def __setitem__(self, key, value):
+        self._current()[key] = value
+    
+    def __delitem__(self, key):
+        del self._current()[key]
+    
+    def __iter__(self):
+        return iter(self._current())
+    
+    def __len__(self):
+        return len(self._current())
+    
+    # Gcf relies on OrderedDict extras and reversible views
+    def move_to_end(self, key, last=True):
+        self._current().move_to_end(key, last)
+    
+    def keys(self):
+        return self._current().keys()
+    
+    def values(self):
+        return self._current().values()
+    
+    def items(self):
+        return self._current().items()
+
+
+def _install_context_isolation():
+    """Route sys.stdout and pyplot's figure manager registry through context-local state"""
+    from matplotlib import _pylab_helpers
+    
+    if not isinstance(sys.stdout, _ContextLocalStdout):
+        sys.stdout = _ContextLocalStdout(sys.stdout)
+    if not isinstance(_pylab_helpers.Gcf.figs, _ContextLocalFigureRegistry):
+        _pylab_helpers.Gcf.figs = _ContextLocalFigureRegistry(_pylab_helpers.Gcf.figs)
+
+
+
+# The data stack is imported on first use so plain chat never pays for it.
+# These names are bound by _ensure_data_stack() and used by generated code.
+pd = None
+np = None
+plt = None
+sns = None
+_data_stack_lock = threading.Lock()
+_warmed_up = False
+
+# Workers are never forked from this process: its threads (event loop, execution
+# pool, HTTP clients) may hold locks that a forked child could never release.
+# A single-threaded fork server, started once, warms the data stack and forks a
+# blank worker per execution. The worker holds no conversation state until its
+# job arrives: frames that are in a snapshot file are memory-mapped by the
+# worker from a descriptor sent with the job (page cache shared with the
+# service), the others are sent pickled and freed when the worker exits.
+_fork_server: Optional[Tuple[subprocess.Popen, Connection]] = None
+_fork_server_lock = threading.Lock()
+# Standby workers are forked here, off the request path
+_standby_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="standby")
+_standby_workers: Deque["_Worker"] = deque()
+_standby_lock = threading.Lock()
+_standby_refill_queued = False
+
+
+def _ensure_data_stack():
+    """Import pandas/numpy/matplotlib/seaborn once, on the first analysis request"""
+    global pd, np, plt, sns
+    if sns is not None:
+        return
+    with _data_stack_lock:
+        if sns is not None:
+            return
+        import pandas
+        import numpy
+        import matplotlib
+        matplotlib.use('Agg')  # Non-interactive backend
+        import matplotlib.pyplot
+        import seaborn
+        _install_context_isolation()
+        pd, np, plt = pandas, numpy, matplotlib.pyplot
+        sns = seaborn  # Bound last: marks the stack as ready
+
+
+def query_engine_available() -> bool:
+    """Whether the DuckDB engine is enabled and installed (checked without importing it)"""
+    return QUERY_ENGINE == "duckdb" and importlib.util.find_spec("duckdb") is not None
+
+
+def _make_sql_function(sources: Dict[str, str]):
+    """
+    Build the sql() helper exposed to generated code. Each loaded dataset is a
+    view over its source CSV, so DuckDB scans the file directly with all cores
+    instead of going through the pandas copy. The connection is opened lazily,
+    inside the execution process, on the first call.
+    """
+    state = {'connection': None}
+    
+    def sql(query: str):
+        """Run a DuckDB SQL query over the uploaded CSV files and return a pandas DataFrame"""
+        if state['connection'] is None:
+            import duckdb
+            
+            connection = duckdb.connect()
+            connection.execute(f"SET threads TO {QUERY_ENGINE_THREADS}")
+            for name, path in sources.items():
+                escaped = path.replace("'", "''")
+                connection.execute(f'CREATE VIEW "{name}" AS SELECT * FROM read_csv_auto(\'{escaped}\')')
+            state['connection'] = connection
+        return state['connection'].execute(query).df()
+    
+    def close():
+        if state['connection'] is not None:
+            state['connection'].close()
+            state['connection'] = None
+    
+    return sql, close
+
+
+def warm_up():
+    """
+    Get ready for the first analysis request: start the fork server (which
+    warms its own data stack) when executions are isolated, else warm this process
+    """
+    if _PROCESS_ISOLATION:
+        _ensure_data_stack()  # CSVs are still read and profiled here
+        with _fork_server_lock:
+            _ensure_fork_server()
+        _queue_standby_refill()
+    else:
+        _warm_up_process()
+
+
+def _warm_up_process():
+    """
+    Import the data stack and render a throwaway figure so the Agg backend,
+    font cache and CSV parser are initialised before the first real request.
+    Processes forked afterwards inherit this warm state.
+    """
+    global _warmed_up
+    if _warmed_up:
+        return
+    _ensure_data_stack()
+    with _data_stack_lock:
+        if _warmed_up:
+            return
+        figures = OrderedDict()
+        token = _figure_registry.set(figures)
+        try:
+            df = pd.read_csv(io.StringIO("a,b\n1,2.5\n2,3.5\n3,1.0\n"))
+            df.describe()
+            plt.figure(figsize=(4, 3))
+            sns.histplot(df['b'])
+            plt.title('warm-up')
+            for manager in figures.values():
+                manager.canvas.figure.savefig(io.BytesIO(), format='png', bbox_inches='tight', dpi=100)
+        finally:
+            figures.clear()
+            _figure_registry.reset(token)
+        _warmed_up = True
+
+
+def _ensure_fork_server() -> Tuple[subprocess.Popen, Connection]:
+    """The running fork server, started (or restarted) if needed; caller holds _fork_server_lock"""
+    global _fork_server
+    if _fork_server is None or _fork_server[0].poll() is not None:
+        parent_sock, child_sock = socket.socketpair()
+        command = (
+            f"import sys; sys.path.insert(0, {os.path.dirname(os.path.abspath(__file__))!r}); "
+            f"import code_executor; code_executor._fork_server_main({child_sock.fileno()})"
+        )
+        # A fresh interpreter (fork + exec), in its own session so terminal signals reach only the service
+        process = subprocess.Popen([sys.executable, "-c", command], pass_fds=[child_sock.fileno()], start_new_session=True)
+        child_sock.close()
+        _fork_server = (process, Connection(parent_sock.detach()))
+    return _fork_server
+
+
+def _fork_server_call(message, handle: Optional[int] = None):
+    """Send a request (and a descriptor) to the fork server and return its reply, restarting a dead server once"""
+    global _fork_server
+    with _fork_server_lock:
+        for attempt in range(2):
+            process, conn = _ensure_fork_server()
+            try:
+                conn.send(message)
+                if handle is not None:
+                    reduction.send_handle(conn, handle, process.pid)
+                return conn.recv()  # Waits for the server's warm-up on first use
+            except (EOFError, OSError):  # Server gone (e.g. OOM-killed): start a new one once
+                conn.close()
+                _fork_server = None
+                if attempt or message[0] != 'fork':
+                    raise
+
+
+def _fork_server_main(fd: int):
+    """Fork server entry point: warm the data stack, then fork a worker per request"""
+    conn = Connection(fd)
+    _warm_up_process()
+    if importlib.util.find_spec("pyarrow") is not None:
+        import pyarrow.feather  # noqa: F401  Workers map snapshot files with it
+    exit_codes: OrderedDict = OrderedDict()
+    while True:
+        _reap_workers(exit_codes)
+        try:
+            request = conn.recv()
+        except (EOFError, OSError):
+            return  # The service exited; idle workers exit with their connections
+        if request[0] == 'fork':
+            worker_fd = reduction.recv_handle(conn)
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    conn.close()
+                    _worker_main(Connection(worker_fd))
+                finally:
+                    os._exit(0)
+            os.close(worker_fd)
+            conn.send(pid)
+        elif request[0] == 'exit_code':
+            pid = request[1]
+            if pid not in exit_codes:
+                try:
+                    exit_codes[pid] = os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1])
+                except ChildProcessError:
+                    exit_codes[pid] = None
+            conn.send(exit_codes.pop(pid))
+
+
+def _reap_workers(exit_codes: OrderedDict):
+    """Collect exited workers without blocking, keeping the last exit codes for exit_code requests"""
+    while True:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            return
+        if pid == 0:
+            return
+        exit_codes[pid] = os.waitstatus_to_exitcode(status)
+        if len(exit_codes) > 256:
+            exit_codes.popitem(last=False)
+
+
+# Frames mapped from snapshot files, kept for the worker's lifetime (see _map_frame)
+_mapped_frames: list = []
+
+
+def _map_frame(fd: int):
+    """
+    DataFrame over a snapshot file, memory-mapped (worker side)
+
+    Numeric columns are views of the read-only mapping. Generated code gets a
+    shallow copy: with pandas copy-on-write, a column it writes to is copied
+    first, so only written columns cost memory. Older pandas gets a deep copy.
+    """
+    import mmap
+    import pyarrow as pa
+    from pyarrow import feather
+
+    try:
+        mapping = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    finally:
+        os.close(fd)
+    mapped = feather.read_table(pa.BufferReader(pa.py_buffer(mapping))).to_pandas(split_blocks=True, self_destruct=True)
+    if int(pd.__version__.split('.')[0]) < 3:
+        return mapped.copy()
+    _mapped_frames.append(mapped)  # Kept referenced, so writes to the copy never reach the mapping
+    return mapped.copy(deep=False)
+
+
+def _worker_main(conn: Connection):
+    """
+    Entry point of a worker forked by the fork server: wait for one job, take
+    its frames, run it under limits and report back
+    """
+    try:
+        try:
+            code, save_to_memory, frames, mapped, sources = conn.recv()
+            fds = [reduction.recv_handle(conn) for _ in mapped]
+        except (EOFError, OSError):
+            return  # Discarded while idle
+        executor = CodeExecutor()
+        try:
+            for name, fd in zip(mapped, fds):
+                frames[name] = _map_frame(fd)
+        except Exception as e:
+            result = executor._empty_result()
+            result['error'] = f"RuntimeError: Could not read the snapshot of '{name}': {e}"
+            conn.send((result, {}))
+            return
+        executor.dataframes, executor.sources = frames, sources
+        _apply_resource_limits()
+        payload = executor._run(code, save_to_memory, copy_frames=False)
+        try:
+            conn.send(payload)
+        except MemoryError:
+            result = executor._empty_result()
+            result['error'] = f"MemoryError: Result exceeded the {EXECUTION_MEMORY_MB} MB memory limit."
+            conn.send((result, {}))
+    finally:
+        conn.close()
+
+
+class _Worker:
+    """A worker forked by the fork server: waits for one execution on its connection, runs it and exits"""
+    
+    def __init__(self, pid: int, conn: Connection):
+        self.pid = pid
+        self.conn = conn
+    
+    def alive(self) -> bool:
+        # An idle worker never sends anything, so a readable connection means it exited
+        return not self.conn.closed and not self.conn.poll()
+    
+    def kill(self):
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    
+    def close(self):
+        self.conn.close()  # An idle worker exits when its connection closes
+    
+    def exit_code(self) -> Optional[int]:
+        """The worker's exit code (waiting for it to exit), or None if unknown"""
+        try:
+            return _fork_server_call(('exit_code', self.pid))
+        except (EOFError, OSError):
+            return None
+
+
+def _fork_worker() -> _Worker:
+    parent_sock, child_sock = socket.socketpair()
+    try:
+        pid = _fork_server_call(('fork',), child_sock.fileno())
+    except BaseException:
+        parent_sock.close()
+        raise
+    finally:
+        child_sock.close()
+    return _Worker(pid, Connection(parent_sock.detach()))
+
+
+def _take_worker() -> _Worker:
+    """A standby worker if one is alive, else a freshly forked one; standbys are refilled in the background"""
+    worker = None
+    with _standby_lock:
+        while _standby_workers and worker is None:
+            candidate = _standby_workers.popleft()
+            if candidate.alive():
+                worker = candidate
+            else:
+                candidate.close()
+    _queue_standby_refill()
+    return worker if worker is not None else _fork_worker()
+
+
+def _queue_standby_refill():
+    global _standby_refill_queued
+    if not EXECUTOR_PREFORK:
+        return
+    with _standby_lock:
+        if _standby_refill_queued or len(_standby_workers) >= EXECUTOR_STANDBY_WORKERS:
+            return
+        _standby_refill_queued = True
+    _standby_pool.submit(_refill_standby)
+
+
+def _refill_standby():
+    global _standby_refill_queued
+    try:
+        while True:
+            with _standby_lock:
+                if len(_standby_workers) >= EXECUTOR_STANDBY_WORKERS:
+                    return
+            worker = _fork_worker()
+            with _standby_lock:
+                _standby_workers.append(worker)
+    except (EOFError, OSError):
+        return  # The next execution forks its own worker
+    finally:
+        with _standby_lock:
+            _standby_refill_queued = False
+
+
+def _utf8_len(text: str) -> int:
+    if text.isascii():
+        return len(text)
+    # Encode in slices so one huge print does not need a second copy of itself
+    step = 1 << 20
+    return sum(len(text[i:i + step].encode('utf-8', 'replace')) for i in range(0, len(text), step))
+
+
+def _utf8_head(text: str, limit: int) -> str:
+    """Longest prefix of text that fits in limit bytes"""
+    return text[:limit].encode('utf-8', 'replace')[:limit].decode('utf-8', 'ignore')
+
+
+def _utf8_tail(text: str, limit: int) -> str:
+    """Longest suffix of text that fits in limit bytes"""
+    if limit <= 0:
+        return ''
+    return text[-limit:].encode('utf-8', 'replace')[-limit:].decode('utf-8', 'ignore')
+
+
+class _BoundedOutput(io.TextIOBase):
+    """
+    Write-only text buffer that keeps the first and last limit/2 bytes written
+    to it. Everything in between is discarded as it arrives, so printing a
+    million-row frame costs that print's string, never an unbounded buffer.
+    """
+    
+    def __init__(self, limit: int = MAX_STDOUT_BYTES):
+        self._head_limit = limit // 2
+        self._tail_limit = limit - self._head_limit
+        self._head: List[str] = []
+        self._head_bytes = 0
+        self._head_full = False
+        self._tail: Deque[str] = deque()
+        self._tail_bytes = 0
+        self._total_bytes = 0
+        self._total_lines = 0
+    
+    def writable(self):
+        return True
+    
+    def write(self, text):
+        written = len(text)
+        size = _utf8_len(text)
+        self._total_bytes += size
+        self._total_lines += text.count('\n')
+        
+        if not self._head_full:
+            if self._head_bytes + size <= self._head_limit:
+                self._head.append(text)
+                self._head_bytes += size
+                return written
+            part = _utf8_head(text, self._head_limit - self._head_bytes)
+            self._head.append(part)
+            self._head_bytes += _utf8_len(part)
+            self._head_full = True
+            text = text[len(part):]
+            size = _utf8_len(text)
+        
+        if size >= self._tail_limit:
+            text = _utf8_tail(text, self._tail_limit)
+            self._tail.clear()
+            self._tail.append(text)
+            self._tail_bytes = _utf8_len(text)
+            return written
+        self._tail.append(text)
+        self._tail_bytes += size
+        while self._tail_bytes > self._tail_limit:
+            first = self._tail[0]
+            first_bytes = _utf8_len(first)
+            excess = self._tail_bytes - self._tail_limit
+            if first_bytes <= excess:
+                self._tail.popleft()
+                self._tail_bytes -= first_bytes
+            else:
+                kept = _utf8_tail(first, first_bytes - excess)
+                self._tail[0] = kept
+                self._tail_bytes -= first_bytes - _utf8_len(kept)
+        return written
+    
+    def getvalue(self) -> str:
+        head, tail = ''.join(self._head), ''.join(self._tail)
+        if self._head_bytes + self._tail_bytes >= self._total_bytes:
+            return head + tail
+        # Cut at line boundaries so no half rows are shown around the marker
+        cut = head.rfind('\n')
+        if cut >= len(head) // 2:
+            head = head[:cut + 1]
+        cut = tail.find('\n')
+        if 0 <= cut < len(tail) // 2:
+            tail = tail[cut + 1:]
+        omitted_bytes = self._total_bytes - _utf8_len(head) - _utf8_len(tail)
+        omitted_lines = self._total_lines - head.count('\n') - tail.count('\n')
+        if not head.endswith('\n'):
+            head += '\n'
+        lines = f"{omitted_lines} lines, " if omitted_lines else ""
+        return (f"{head}... [output truncated: {lines}{omitted_bytes} of {self._total_bytes} bytes omitted] ..."
+                f"\n{tail}")
+
+
+def summarize_output(text: str, max_chars: int) -> str:
+    """
+    Shorten execution output to about max_chars for a prompt: whole lines from
+    the start (two thirds of the budget) and the end, with a count of what was left out
+    """
+    if len(text) <= max_chars:
+        return text
+    lines = text.splitlines(keepends=True)
+    head, head_chars = [], 0
+    for line in lines:
+        if head_chars + len(line) > max_chars * 2 // 3:
+            break
+        head.append(line)
+        head_chars += len(line)
+    tail, tail_chars = [], 0
+    for line in reversed(lines[len(head):]):
+        if head_chars + tail_chars + len(line) > max_chars:
+            break
+        tail.append(line)
+        tail_chars += len(line)
+    tail.reverse()
+    omitted = len(lines) - len(head) - len(tail)
+    if not head and not tail:  # A single huge line
+        return text[:max_chars] + f"\n[... {len(text) - max_chars} characters omitted ...]\n"
+    body = ''.join(head)
+    if body and not body.endswith('\n'):
+        body += '\n'
+    return (f"{body}[... {omitted} lines ({len(text) - head_chars - tail_chars} characters) omitted ...]\n"
+            + ''.join(tail))
+
+
+def _dataset_name(label: str, taken) -> str:
+    """Python identifier for a dataset, from its file name"""
+    stem = os.path.splitext(os.path.basename(label.split('?')[0]))[0]
+    name = re.sub(r'\W+', '_', stem).strip('_').lower() or 'data'
+    if name[0].isdigit() or keyword.iskeyword(name) or name in _RESERVED_NAMES:
+        name = f"df_{name}"
+    candidate, suffix = name, 2
+    while candidate in taken:
+        candidate = f"{name}_{suffix}"
+        suffix += 1
+    return candidate
+
+
+def _read_csv_sample(csv_path: str):
+    return pd.read_csv(csv_path, nrows=PROFILE_SAMPLE_ROWS)
+
+
+# Code using these can reach any name, so every frame is treated as used
+_DYNAMIC_ACCESS = {'exec', 'eval', 'globals', 'locals', 'vars', '__import__', 'setattr', 'delattr'}
+
+
+def _code_names(code: str) -> Optional[set]:
+    """Every name a code block refers to, or None if that cannot be told"""
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return None
+    names = {node.id for node in ast.walk(tree) if isinstance(node, ast.Name)}
+    return None if names & _DYNAMIC_ACCESS else names
+
 
 class CodeExecutor:
     """Execute Python code safely for data analysis"""
     
     def __init__(self):
         self.dataframes: Dict[str, pd.DataFrame] = {}
+        self.datasets: Dict[str, str] = {}  # name -> CSV path or URL, loaded into dataframes on first use
+        self.sources: Dict[str, str] = {}  # df_name -> local CSV path, for the SQL engine
+        self._dataset_files: Dict[str, str] = {}  # name -> file name shown to the model
+        self._profiles: Dict[str, str] = {}  # name -> rendered profile (stable for the dataset's lifetime)
+        self._columns: Dict[str, Dict[str, str]] = {}  # name -> {column: dtype} of the profiled sample
         self.df_count = 0
-        self.execution_history: List[Dict] = []
+        self._unsnapshotted: set = set()  # Frames changed since their last successful snapshot
+        self._snapshot_pending: Dict[str, pd.DataFrame] = {}  # name -> version handed to a write in flight
+        self.execution_history: Deque[Dict] = deque(maxlen=EXECUTION_HISTORY_SIZE)  # Most recent actions only
+        self._active_processes: set = set()  # Workers running a job; a response's blocks run concurrently
+        # name -> (frame, snapshot file holding it): workers map the file instead of receiving the frame
+        self._frame_files: Dict[str, Tuple[pd.DataFrame, str]] = {}
+        self._cancelled: set = set()  # Pids of workers killed by cancel()
+        self._running = 0
+        self._lock = threading.Lock()  # Guards the write-back of saved frames and the snapshot bookkeeping
+        self._load_lock = threading.Lock()  # One lazy dataset load at a time
         
     def load_csv(self, csv_path: str, df_name: Optional[str] = None) -> Tuple[bool, str]:
         """Load a CSV file into a DataFrame"""
+        _ensure_data_stack()
         self.df_count += 1
         if not df_name:
             df_name = f"df_{self.df_count}"
@@ -37,6 +712,13 @@ class CodeExecutor:
             else:
                 self.dataframes[df_name] = pd.read_csv(csv_path)
             
+            self.datasets.setdefault(df_name, csv_path)
+            if os.path.isfile(csv_path):
+                self.sources[df_name] = csv_path
+            with self._lock:
+                self._unsnapshotted.add(df_name)
+                self._frame_files.pop(df_name, None)
+            
             df = self.dataframes[df_name]
             summary = f"Successfully loaded CSV into DataFrame '{df_name}'\n"
             summary += f"Shape: {df.shape[0]} rows × {df.shape[1]} columns\n"
@@ -62,10 +744,142 @@ class CodeExecutor:
             })
             return False, error_msg
     
+    def add_dataset(self, csv_path: str, name: Optional[str] = None, filename: Optional[str] = None) -> Tuple[bool, str]:
+        """
+        Register a CSV under a DataFrame name without loading it (see execute_code)
+        
+        The first dataset of a conversation is 'df'; later ones are named after
+        their file. A path that is already registered keeps its name. Only the
+        header and first rows are read, to validate the file.
+        
+        Returns (True, name) or (False, error message).
+        """
+        for existing, path in self.datasets.items():
+            if path == csv_path:
+                if filename and existing not in self._dataset_files:
+                    self._dataset_files[existing] = filename  # e.g. restored from a snapshot
+                    self._profiles.pop(existing, None)
+                return True, existing
+        _ensure_data_stack()
+        if not name:
+            if not self.datasets:
+                name = 'df'
+            elif filename:
+                name = _dataset_name(filename, set(self.datasets) | set(self.dataframes))
+            else:
+                name = _dataset_name(f"df_{len(self.datasets) + 1}", set(self.datasets) | set(self.dataframes))
+        elif not name.isidentifier() or keyword.iskeyword(name) or name in _RESERVED_NAMES:
+            return False, f"Invalid dataset name {name!r}: it must be a Python identifier"
+        try:
+            _read_csv_sample(csv_path)
+        except Exception as e:
+            return False, f"Error loading CSV: {str(e)}"
+        if name in self.datasets:  # Replaced by a new file under the same name
+            self.dataframes.pop(name, None)
+            self._frame_files.pop(name, None)
+            self.sources.pop(name, None)
+            self._profiles.pop(name, None)
+            self._columns.pop(name, None)
+        self.datasets[name] = csv_path
+        if filename:
+            self._dataset_files[name] = filename
+        if os.path.isfile(csv_path):
+            self.sources[name] = csv_path
+        self.execution_history.append({'action': 'add_dataset', 'df_name': name, 'path': csv_path, 'success': True})
+        return True, name
+    
+    def referenced_datasets(self, code: str) -> List[str]:
+        """Registered datasets the code uses by name that are not loaded yet"""
+        try:
+            tree = ast.parse(code)
+        except SyntaxError:
+            return []  # Execution reports the error
+        names = {node.id for node in ast.walk(tree) if isinstance(node, ast.Name)}
+        return [name for name in self.datasets if name in names and name not in self.dataframes]
+    
+    def dataset_profiles(self) -> str:
+        """
+        Compact profile of every registered dataset, for the prompt
+        
+        Rendered only from the file (size and first rows) with fixed
+        formatting, so it stays byte-identical across turns, loads and
+        restarts and keeps the prompt prefix cacheable. What changes as code
+        runs is in session_state().
+        """
+        return "\n\n".join(self._dataset_profile(name) for name in self.datasets)
+    
+    def _dataset_profile(self, name: str) -> str:
+        cached = self._profiles.get(name)
+        if cached is not None:
+            return cached
+        
+        path = self.datasets[name]
+        try:
+            sample = _read_csv_sample(path)
+        except Exception:
+            if name not in self.dataframes:
+                raise
+            sample = self.dataframes[name].head(PROFILE_SAMPLE_ROWS)  # Source gone, frame restored from a snapshot
+        size = f", {os.path.getsize(path) / 1024**2:.1f} MB" if os.path.isfile(path) else ""
+        lines = [
+            f"{name}: file {self._dataset_files.get(name) or os.path.basename(path.split('?')[0])}{size}",
+            f"Column details are from the first {len(sample)} rows",
+        ]
+        if name in self.sources and query_engine_available():
+            lines.append(f"SQL engine: available - sql() can query this file directly as table \"{name}\"")
+        lines.append("Columns:")
+        for column in sample.columns[:PROFILE_MAX_COLUMNS]:
+            series = sample[column]
+            details = str(series.dtype)
+            if pd.api.types.is_numeric_dtype(series) and series.notna().any():
+                details += f", {series.min():.6g} to {series.max():.6g}"
+            missing = int(series.isna().sum())
+            if missing:
+                details += f", {missing} missing"
+            lines.append(f"  - {column} ({details})")
+        if len(sample.columns) > PROFILE_MAX_COLUMNS:
+            lines.append(f"  ... {len(sample.columns) - PROFILE_MAX_COLUMNS} more columns")
+        lines.append("First 3 rows:")
+        lines.append(sample.head(3).to_string(max_colwidth=40, float_format='{:.6g}'.format))
+        
+        profile = "\n".join(lines)
+        self._profiles[name] = profile
+        self._columns[name] = {str(column): str(dtype) for column, dtype in sample.dtypes.items()}
+        return profile
+    
+    def dataset_columns(self, name: str) -> Dict[str, str]:
+        """{column: dtype} of a dataset: the frame's if loaded, else the profiled sample's"""
+        df = self.dataframes.get(name)
+        if df is not None:
+            return {str(column): str(dtype) for column, dtype in df.dtypes.items()}
+        if name not in self._columns:
+            self._dataset_profile(name)
+        return self._columns[name]
+    
+    def session_state(self) -> str:
+        """Which datasets and saved frames are in memory right now (the volatile part of the prompt)"""
+        lines = []
+        for name in self.datasets:
+            if name in self.dataframes:
+                df = self.dataframes[name]
+                lines.append(f"- {name}: loaded, {df.shape[0]} rows × {df.shape[1]} columns")
+            else:
+                lines.append(f"- {name}: not loaded yet (loaded automatically when your code uses `{name}`)")
+        for name, df in self.dataframes.items():
+            if name not in self.datasets:
+                lines.append(f"- {name}: saved DataFrame, {df.shape[0]} rows × {df.shape[1]} columns")
+        return "\n".join(lines)
+    
     def execute_code(self, code: str, save_to_memory: Optional[List[str]] = None) -> Dict:
         """
         Execute Python code and return results
         
+        By default the code runs in a child process, forked from the fork server,
+        with wall-clock, CPU-time and address-space limits. The child gets only
+        the frames the code names: memory-mapped from their snapshot file where
+        there is one, else pickled to it. A timeout or crash never touches this
+        executor's state.
+        
         Returns:
             Dict with:
                 - success: bool
@@ -73,22 +887,219 @@ class CodeExecutor:
                 - error: str (if failed)
                 - plots: List[str] (base64 encoded images)
                 - saved_dfs: List[str] (saved dataframe names)
+                - timings: Dict[str, float] (seconds spent in exec and plot encoding)
+                - timed_out: bool (wall-clock or CPU-time limit exceeded)
+                - loaded_datasets: List[str] (datasets loaded because the code uses them)
         """
-        result = {
+        # Clean up code - remove plt.show() and plt.savefig() calls
+        code = code.replace('plt.show()', '# plt.show() removed - plots captured automatically')
+        code = code.replace('plt.savefig(', '# plt.savefig removed - not needed #(')
+        
+        _ensure_data_stack()
+        
+        # Load only the registered datasets this code refers to (once, if blocks run concurrently)
+        loaded = []
+        load_start = time.perf_counter()
+        with self._load_lock:
+            for name in self.referenced_datasets(code):
+                success, message = self.load_csv(self.datasets[name], name)
+                if not success:
+                    result = self._empty_result()
+                    result['error'] = f"Failed to load dataset '{name}': {message}"
+                    result['timings']['load_csv'] = time.perf_counter() - load_start
+                    return result
+                loaded.append(name)
+        load_seconds = time.perf_counter() - load_start
+        
+        with self._lock:
+            self._running += 1
+            if _PROCESS_ISOLATION:
+                frames, sources = dict(self.dataframes), dict(self.sources)
+                files = {name: path for name, (df, path) in self._frame_files.items() if frames.get(name) is df}
+        saved_frames = {}
+        try:
+            if _PROCESS_ISOLATION:
+                result, saved_frames = self._execute_isolated(code, save_to_memory, frames, sources, files)
+            else:
+                result, saved_frames = self._run(code, save_to_memory, copy_frames=True)
+        finally:
+            with self._lock:
+                self._running -= 1
+                for df_name, df in saved_frames.items():
+                    self.dataframes[df_name] = df
+                    self._unsnapshotted.add(df_name)
+                    self._frame_files.pop(df_name, None)
+        
+        result['loaded_datasets'] = loaded
+        if loaded:
+            result['timings']['load_csv'] = load_seconds
+        
+        if result['success']:
+            self.execution_history.append({
+                'action': 'execute_code',
+                'code': code[:100] + '...' if len(code) > 100 else code,
+                'success': True,
+                'plots_count': len(result['plots'])
+            })
+        else:
+            self.execution_history.append({
+                'action': 'execute_code',
+                'code': code[:100] + '...' if len(code) > 100 else code,
+                'success': False,
+                'error': result['error'].splitlines()[0] if result['error'] else None,
+                'timed_out': result['timed_out']
+            })
+        
+        return result
+    
+    def snapshot_changes(self) -> Tuple[Dict[str, pd.DataFrame], Dict[str, str], int]:
+        """
+        Changed frames not already being written (for snapshots.write_snapshot), plus datasets and df_count
+
+        They stay marked as changed until snapshot_written() confirms them.
+        """
+        with self._lock:
+            self._unsnapshotted = {name for name in self._unsnapshotted if name in self.dataframes}
+            changed = {name: self.dataframes[name] for name in self._unsnapshotted
+                       if self._snapshot_pending.get(name) is not self.dataframes[name]}
+            self._snapshot_pending.update(changed)
+            return changed, dict(self.datasets), self.df_count
+    
+    def snapshot_written(self, frames: Dict[str, pd.DataFrame], written: List[str], files: Dict[str, str]):
+        """
+        Unmark the frames a snapshot wrote, unless they were replaced meanwhile; the others stay changed
+
+        files maps each written frame to its snapshot file, which workers map from then on.
+        """
+        with self._lock:
+            for name, df in frames.items():
+                if self._snapshot_pending.get(name) is df:
+                    del self._snapshot_pending[name]
+            for name in written:
+                if self.dataframes.get(name) is frames[name]:
+                    self._unsnapshotted.discard(name)
+                    self._frame_files[name] = (frames[name], files[name])
+    
+    def has_unsnapshotted_changes(self) -> bool:
+        return bool(self._unsnapshotted)
+    
+    def restore(self, frames: Dict[str, pd.DataFrame], datasets: Dict[str, str], df_count: int, files: Dict[str, str]):
+        """Adopt state restored from a snapshot; files maps each frame to the snapshot file it was read from"""
+        _ensure_data_stack()
+        self.dataframes.update(frames)
+        with self._lock:
+            self._frame_files.update({name: (df, files[name]) for name, df in frames.items()})
+        for name, path in datasets.items():
+            self.datasets.setdefault(name, path)
+            if os.path.isfile(path):
+                self.sources[name] = path
+        self.df_count = max(self.df_count, df_count)
+    
+    def busy(self) -> bool:
+        return self._running > 0 or self._lock.locked()
+    
+    def cancel(self) -> bool:
+        """Kill the in-flight isolated executions, if any. Loaded dataframes are unaffected."""
+        killed = False
+        for worker in list(self._active_processes):
+            self._cancelled.add(worker.pid)
+            worker.kill()
+            killed = True
+        return killed
+    
+    def close(self):
+        """Drop the references kept for workers; the frames stay in memory"""
+        with self._lock:
+            self._frame_files.clear()
+    
+    def _execute_isolated(self, code: str, save_to_memory: Optional[List[str]], frames: Dict,
+                          sources: Dict[str, str], files: Dict[str, str]) -> Tuple[Dict, Dict[str, pd.DataFrame]]:
+        """Run code in a resource-limited worker (a standby if one is alive) and collect its result over a pipe"""
+        result = self._empty_result()
+        used = _code_names(code)  # Frames the code cannot reach are not sent
+        if used is not None:
+            frames = {name: df for name, df in frames.items() if name in used}
+        fds = {}
+        for name in frames:
+            if name in files:
+                try:
+                    fds[name] = os.open(files[name], os.O_RDONLY)
+                except OSError:
+                    pass  # Deleted by the disk budget: the frame is pickled instead
+        try:
+            try:
+                worker = _take_worker()
+            except (EOFError, OSError) as e:
+                result['error'] = f"RuntimeError: Could not start the execution process: {e}"
+                return result, {}
+            self._active_processes.add(worker)
+            
+            payload = None
+            start = time.perf_counter()
+            try:
+                pickled = {name: df for name, df in frames.items() if name not in fds}
+                worker.conn.send((code, save_to_memory, pickled, list(fds), sources))
+                for fd in fds.values():
+                    reduction.send_handle(worker.conn, fd, worker.pid)
+                if worker.conn.poll(EXECUTION_TIMEOUT_SECONDS):
+                    payload = worker.conn.recv()
+            except (EOFError, OSError):
+                payload = None  # Worker died before reporting (signal / hard OOM)
+            finally:
+                if payload is None:
+                    worker.kill()
+                worker.close()
+                self._active_processes.discard(worker)
+        finally:
+            for fd in fds.values():
+                os.close(fd)
+        
+        if payload is not None:
+            return payload
+        
+        elapsed = time.perf_counter() - start
+        result['timings']['exec'] = elapsed
+        exitcode = worker.exit_code()
+        if worker.pid in self._cancelled:
+            self._cancelled.discard(worker.pid)
+            result['error'] = "CancelledError: Execution was cancelled."
+        elif exitcode == -signal.SIGXCPU:
+            result['timed_out'] = True
+            result['error'] = (f"TimeoutError: Execution exceeded the {EXECUTION_CPU_SECONDS}s CPU-time limit. "
+                               "Use vectorized pandas operations instead of Python loops, or work on a sample.")
+        elif elapsed >= EXECUTION_TIMEOUT_SECONDS:
+            result['timed_out'] = True
+            result['error'] = (f"TimeoutError: Execution exceeded the {EXECUTION_TIMEOUT_SECONDS:g}s wall-clock limit. "
+                               "Use vectorized pandas operations instead of Python loops, or work on a sample.")
+        elif exitcode == -signal.SIGKILL:
+            result['error'] = ("MemoryError: Execution was killed, most likely for exceeding the "
+                               f"{EXECUTION_MEMORY_MB} MB memory limit.")
+        else:
+            result['error'] = f"RuntimeError: Execution process exited unexpectedly (exit code {exitcode})."
+        return result, {}
+    
+    def _empty_result(self) -> Dict:
+        return {
             'success': False,
             'stdout': '',
             'error': None,
             'plots': [],
-            'saved_dfs': []
+            'saved_dfs': [],
+            'timings': {},
+            'timed_out': False
         }
+    
+    def _run(self, code: str, save_to_memory: Optional[List[str]], copy_frames: bool) -> Tuple[Dict, Dict[str, pd.DataFrame]]:
+        """Execute code in the current process; returns the result and any frames to keep"""
+        result = self._empty_result()
+        saved_frames = {}
         
-        # Clean up code - remove plt.show() and plt.savefig() calls
-        code = code.replace('plt.show()', '# plt.show() removed - plots captured automatically')
-        code = code.replace('plt.savefig(', '# plt.savefig removed - not needed #(')
-        
-        # Prepare local environment with dataframes
+        # Prepare local environment with dataframes; only the frames the code names
+        # are copied, the others cannot be reached (concurrent blocks share them)
+        used = _code_names(code) if copy_frames else None
         local_dict = {
-            **{df_name: df.copy() for df_name, df in self.dataframes.items()},
+            **{df_name: (df.copy() if copy_frames and (used is None or df_name in used) else df)
+               for df_name, df in self.dataframes.items()},
         }
         
         # Prepare safe globals
@@ -100,16 +1111,23 @@ class CodeExecutor:
             'print': print,
             '__builtins__': __builtins__,
         }
+        close_sql = None
+        if self.sources and query_engine_available():
+            safe_globals['sql'], close_sql = _make_sql_function(dict(self.sources))
         
-        # Capture stdout
-        stdout_capture = io.StringIO()
-        old_stdout = sys.stdout
+        # Capture stdout and figures for this execution only
+        stdout_capture = _BoundedOutput()
+        figures = OrderedDict()
+        stdout_token = _stdout_target.set(stdout_capture)
+        figures_token = _figure_registry.set(figures)
         
         try:
-            sys.stdout = stdout_capture
-            
             # Execute the code
-            exec(code, safe_globals, local_dict)
+            exec_start = time.perf_counter()
+            try:
+                exec(code, safe_globals, local_dict)
+            finally:
+                result['timings']['exec'] = time.perf_counter() - exec_start
             
             # Get stdout
             result['stdout'] = stdout_capture.getvalue()
@@ -118,45 +1136,44 @@ class CodeExecutor:
             if save_to_memory:
                 for df_name in save_to_memory:
                     if df_name in local_dict and isinstance(local_dict[df_name], pd.DataFrame):
-                        self.dataframes[df_name] = local_dict[df_name]
+                        saved_frames[df_name] = local_dict[df_name]
                         result['saved_dfs'].append(df_name)
             
-            # Capture any matplotlib plots
-            if plt.get_fignums():
-                for fig_num in plt.get_fignums():
-                    fig = plt.figure(fig_num)
+            # Capture any matplotlib plots created by this execution
+            encode_start = time.perf_counter()
+            if figures:
+                omitted = 0
+                for manager in list(figures.values()):
+                    if len(result['plots']) >= MAX_PLOTS:
+                        omitted += 1
+                        continue
+                    fig = manager.canvas.figure
                     buf = io.BytesIO()
                     fig.savefig(buf, format='png', bbox_inches='tight', dpi=100)
-                    buf.seek(0)
-                    img_base64 = base64.b64encode(buf.read()).decode('utf-8')
-                    result['plots'].append(img_base64)
+                    if buf.tell() > MAX_PLOT_BYTES:
+                        omitted += 1
+                    else:
+                        result['plots'].append(base64.b64encode(buf.getvalue()).decode('utf-8'))
                     buf.close()
-                plt.close('all')
+                if omitted:
+                    result['stdout'] += f"\n[{omitted} plot(s) omitted: limit is {MAX_PLOTS} plots of at most {MAX_PLOT_BYTES // 1024} KB each]\n"
+            result['timings']['plot_encode'] = time.perf_counter() - encode_start
             
             result['success'] = True
             
-            self.execution_history.append({
-                'action': 'execute_code',
-                'code': code[:100] + '...' if len(code) > 100 else code,
-                'success': True,
-                'plots_count': len(result['plots'])
-            })
-            
         except Exception as e:
             result['error'] = f"{type(e).__name__}: {str(e)}\n{traceback.format_exc()}"
             result['stdout'] = stdout_capture.getvalue()
-            
-            self.execution_history.append({
-                'action': 'execute_code',
-                'code': code[:100] + '...' if len(code) > 100 else code,
-                'success': False,
-                'error': str(e)
-            })
         finally:
-            sys.stdout = old_stdout
-            plt.close('all')
+            # Dropping the registry releases the figures; Gcf.destroy would also
+            # touch backend state shared with other threads
+            figures.clear()
+            if close_sql is not None:
+                close_sql()
+            _figure_registry.reset(figures_token)
+            _stdout_target.reset(stdout_token)
         
-        return result
+        return result, saved_frames
     
     def get_dataframe_info(self, df_name: str) -> Optional[str]:
         """Get information about a specific dataframe"""
@@ -167,10 +1184,14 @@ class CodeExecutor:
         info_buffer = io.StringIO()
         df.info(buf=info_buffer)
         
+        engine_note = ""
+        if df_name in self.sources and query_engine_available():
+            engine_note = f"SQL engine: available - sql() can query this file directly as table \"{df_name}\"\n"
+        
         return f"""
 DataFrame: {df_name}
 Shape: {df.shape[0]} rows × {df.shape[1]} columns
-
+{engine_note}
 {info_buffer.getvalue()}
 
 First 5 rows:
@@ -180,12 +1201,23 @@ Summary statistics:
 {df.describe().to_string()}
 """
     
+    def memory_bytes(self) -> int:
+        """Shallow memory footprint of all held dataframes (cheap enough for metrics scrapes)"""
+        return int(sum(df.memory_usage(index=True, deep=False).sum() for df in self.dataframes.values()))
+    
     def list_dataframes(self) -> List[str]:
         """List all loaded dataframes"""
         return list(self.dataframes.keys())
     
     def clear(self):
         """Clear all dataframes and history"""
+        self.close()
         self.dataframes.clear()
+        self.datasets.clear()
+        self.sources.clear()
+        self._dataset_files.clear()
+        self._profiles.clear()
         self.execution_history.clear()
+        self._unsnapshotted.clear()
+        self._snapshot_pending.clear()
         self.df_count = 0
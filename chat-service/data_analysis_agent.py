@@ -12,8 +12,9 @@ DATA_ANALYSIS_SYSTEM_PROMPT = """You are an expert Data Analyst AI assistant wit
 - You have access to pandas, numpy, matplotlib, and seaborn libraries
 - Available imports: pd (pandas), np (numpy), plt (matplotlib.pyplot), sns (seaborn)
 - You can write Python code that will be executed in a sandboxed environment
-- The user has already loaded a CSV file into a DataFrame (usually named 'df' or 'df_1')
+- The user's CSV files are available as DataFrames named as in the dataset information (the first is usually 'df'); a dataset is loaded automatically when your code refers to its name, so only use the ones the question needs
 - You can print results, create visualizations, and perform statistical analysis
+- When the dataset information says "SQL engine: available", you can also call sql("...") to run DuckDB SQL directly on the uploaded file; it returns a pandas DataFrame
 
 **IMPORTANT - User Interface Behavior:**
 - **Users will NOT see your Python code** - it executes behind the scenes
@@ -65,6 +66,19 @@ plt.hist(df['column'])
 - The system will automatically capture and display your plots
 - After creating a plot, just move on - no need to display it manually
 
+**When to use sql() instead of pandas:**
+- Use sql() for group-bys, aggregations, joins, DISTINCT counts and top-N queries on large datasets (more than about a million rows or hundreds of MB) - it is multi-threaded and scans the file without copying it into memory
+- Tables are named after the DataFrames (e.g. FROM df); quote column names with spaces using double quotes
+- To join large datasets, join them in sql() rather than referring to the DataFrames, so neither file has to be loaded into memory
+- Use sql() to reduce the data first, then pandas/matplotlib on the small result for plotting or further processing
+- Keep using pandas for small datasets, row-wise transformations, and anything that depends on changes made to df in memory (sql() reads the original file)
+
+Example:
+```python
+top = sql("SELECT region, SUM(sales) AS total FROM df GROUP BY region ORDER BY total DESC LIMIT 10")
+print(top)
+```
+
 **Analysis Approach:**
 1. Explain what you're about to analyze in plain language
 2. Write code to perform the analysis (users won't see this)
@@ -288,7 +302,7 @@ def format_execution_result(result: Dict) -> str:
     return output
 
 
-def should_retry_code(error_message: str, retry_count: int, max_retries: int = 2) -> bool:
+def should_retry_code(error_message: str, retry_count: int, max_retries: int = 2, timed_out: bool = False) -> bool:
     """
     Determine if code execution should be retried
     
@@ -296,6 +310,7 @@ def should_retry_code(error_message: str, retry_count: int, max_retries: int = 2
         error_message: The error message from failed execution
         retry_count: Current number of retries
         max_retries: Maximum number of retries allowed
+        timed_out: Whether the execution hit the wall-clock or CPU-time limit
     
     Returns:
         True if should retry, False otherwise
@@ -303,6 +318,11 @@ def should_retry_code(error_message: str, retry_count: int, max_retries: int = 2
     if retry_count >= max_retries:
         return False
     
+    # Resource-limit failures are expensive to repeat, so allow a single
+    # retry that asks for a cheaper (vectorized / sampled) approach
+    if timed_out or (error_message and error_message.startswith('MemoryError')):
+        return retry_count == 0
+    
     # Retry for common fixable errors
     retryable_errors = [
         'NameError',
@@ -328,7 +348,13 @@ def create_retry_prompt(original_question: str, code: str, error: str) -> str:
     Returns:
         Prompt for the LLM to fix the code
     """
-    return f"""The previous code failed with an error. Please analyze the error and provide corrected code.
+    resource_hint = ""
+    if error.startswith('TimeoutError') or error.startswith('MemoryError'):
+        resource_hint = ("\n\nThe code ran out of time or memory. Avoid Python-level loops over rows and large "
+                         "intermediate copies or merges; use vectorized pandas operations, aggregate before "
+                         "joining, or work on a sample of the data.")
+    
+    return f"""The previous code failed with an error. Please analyze the error and provide corrected code.{resource_hint}
 
 **Original Question:** {original_question}
 
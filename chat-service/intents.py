@@ -0,0 +1,211 @@
+"""
+LLM-free fast path for common dataset questions
+
+Questions such as "show basic statistics", "which columns have missing values"
+or "plot a histogram of age" are answered with fixed, vectorized pandas and
+matplotlib templates instead of a model round trip. A question is routed only
+when the whole message matches one of the patterns below and everything it
+names resolves unambiguously (the dataset, and an existing column for column
+templates); anything else, or a template that fails to run, falls back to the
+LLM.
+"""
+
+import os
+import re
+from dataclasses import dataclass
+from string import Template
+from typing import Dict, List, Optional, Tuple
+
+FAST_PATH = os.getenv("FAST_PATH", "1") == "1"
+FAST_PATH_MAX_HEAD_ROWS = 50
+
+_GENERIC_TARGETS = r"(?:the |this |my |our )?(?:data|dataset|data set|dataframe|table|csv|csv file|file)"
+_TARGET_SUFFIX = re.compile(r"^(?P<rest>.+?) (?:in|of|for|from) (?:the )?(?:dataset |table |dataframe )?(?P<target>[a-z_]\w*)$")
+_GENERIC_SUFFIX = re.compile(rf"^(?P<rest>.+?) (?:in|of|for|from) {_GENERIC_TARGETS}$")
+_FILLER_PREFIX = re.compile(r"^(?:(?:please|can you|could you|would you|kindly|now|ok|okay|hey)\b[ ,]*)+")
+_FILLER_SUFFIX = re.compile(r"[ ,]*\bplease$")
+
+_DESCRIBE = re.compile(
+    r"(?:(?:show|give|get|display|print|compute|calculate|what are)(?: me)? )?(?:the )?"
+    r"(?:basic |summary |descriptive |some )?(?:statistics|stats)(?: summary)?"
+    r"|describe(?: the)?(?: data| dataset)?"
+    r"|(?:show |give |get )?(?:me )?(?:a |the )?(?:statistical )?summary statistics"
+)
+_MISSING = re.compile(
+    r"(?:which|what) columns (?:have|has|contain|contains) (?:any )?(?:missing|null|nan|empty|na) values"
+    r"|(?:(?:are there|is there) any |(?:show|count|check|find|check for|list)(?: me)? (?:the )?)?"
+    r"(?:missing|null|nan|na) (?:values|data)(?: per column| in each column| by column)?"
+)
+_SHAPE = re.compile(
+    r"how many rows(?: and columns)?(?: are there| does (?:it|this|the dataset|the data) have| (?:is|are) in it)?"
+    r"|(?:what is |what's |show |show me )?(?:the )?(?:shape|dimensions|size)"
+)
+_COLUMNS = re.compile(
+    r"(?:what|which) columns (?:are there|exist|does (?:it|this|the dataset|the data) have)"
+    r"|(?:what are |list |show |show me |list all |show all )?(?:the |all )?(?:columns|column names)(?: and (?:their )?(?:types|dtypes|data types))?"
+)
+_HEAD = re.compile(
+    r"(?:show|display|print|preview|give)(?: me)?(?: the)? (?:first|top) (?P<n>\d{1,4}) rows"
+    r"|(?:show|display|preview)(?: me)?(?: the)? (?:head|data|dataset|first rows|first few rows)"
+)
+_HISTOGRAM = re.compile(
+    r"(?:(?:plot|draw|show|create|make|give)(?: me)? )?(?:an? |the )?histogram (?:of|for) (?:the )?(?P<column>.+?)"
+    r"(?: distribution| column| values)?"
+    r"|(?:plot|draw|show|visualize|visualise)(?: me)? (?:the )?distribution of (?:the )?(?P<column2>.+?)(?: column| values)?"
+)
+
+_TEMPLATES = {
+    "describe": (
+        "Here are summary statistics for `$ds`: its shape, the column types and the distribution of the numeric columns.",
+        """print("Dataset shape:", $ds.shape)
+print("\\nColumn data types:")
+print($ds.dtypes.to_string())
+print("\\nBasic statistics:")
+print($ds.describe().to_string())""",
+    ),
+    "missing": (
+        "Here are the missing values per column of `$ds`.",
+        """_missing = $ds.isna().sum()
+_missing = _missing[_missing > 0].sort_values(ascending=False)
+if _missing.empty:
+    print("No missing values in any column.")
+else:
+    print("Missing values per column:")
+    print(pd.DataFrame({'missing': _missing, 'percent': (_missing / len($ds) * 100).round(2)}).to_string())
+    print(f"\\nTotal missing values: {_missing.sum()} ({_missing.sum() / $ds.size * 100:.2f}% of all cells)")""",
+    ),
+    "shape": (
+        "Here is the size of `$ds`.",
+        """print(f"{$ds.shape[0]} rows × {$ds.shape[1]} columns")""",
+    ),
+    "columns": (
+        "Here are the columns of `$ds` and their data types.",
+        """print(f"{$ds.shape[1]} columns:")
+print($ds.dtypes.rename('dtype').to_string())""",
+    ),
+    "head": (
+        "Here are the first $n rows of `$ds`.",
+        """print($ds.head($n).to_string(max_colwidth=40))""",
+    ),
+    "histogram": (
+        "Here is the distribution of `$column` in `$ds`.",
+        """_values = $ds[$column_literal].dropna()
+plt.figure(figsize=(10, 6))
+plt.hist(_values, bins=30, edgecolor='black', alpha=0.7, color='steelblue')
+plt.xlabel($column_literal)
+plt.ylabel('Frequency')
+plt.title('Distribution of ' + $column_literal)
+plt.grid(True, alpha=0.3)
+print(f"{len(_values)} values, mean {_values.mean():.4g}, median {_values.median():.4g}, std {_values.std():.4g}")""",
+    ),
+    "value_counts": (
+        "Here is how often each value of `$column` occurs in `$ds` (top 20).",
+        """_counts = $ds[$column_literal].value_counts(dropna=False).head(20)
+plt.figure(figsize=(10, 6))
+_counts.sort_values().plot.barh(color='steelblue', edgecolor='black')
+plt.xlabel('Count')
+plt.title('Distribution of ' + $column_literal)
+plt.grid(True, alpha=0.3, axis='x')
+print(_counts.to_string())""",
+    ),
+}
+
+_NUMERIC_DTYPE = re.compile(r"^(?:u?int|float|Int|UInt|Float)")
+
+
+@dataclass
+class Intent:
+    """A recognized question and the template code that answers it"""
+    name: str
+    dataset: str
+    explanation: str
+    code: str
+
+
+def _normalize(message: str) -> str:
+    text = " ".join(message.lower().split())
+    text = text.rstrip(" ?!.")
+    text = _FILLER_PREFIX.sub("", text)
+    return _FILLER_SUFFIX.sub("", text)
+
+
+def _split_target(text: str, datasets: List[str]) -> Tuple[str, Optional[str]]:
+    """(question without its "in <dataset>" suffix, the dataset it names or None)"""
+    generic = _GENERIC_SUFFIX.match(text)
+    if generic:
+        return generic.group("rest"), None
+    suffix = _TARGET_SUFFIX.match(text)
+    if suffix:
+        by_lower = {name.lower(): name for name in datasets}
+        if suffix.group("target") in by_lower:
+            return suffix.group("rest"), by_lower[suffix.group("target")]
+    return text, None
+
+
+def _column_key(value: str) -> str:
+    return re.sub(r"[\s_]+", " ", value.strip("'\"` ").lower())
+
+
+def _resolve_column(phrase: str, candidates: Dict[str, Dict[str, str]]) -> Optional[Tuple[str, str, str]]:
+    """(dataset, column, dtype) of the only column the phrase names exactly, if any"""
+    key = _column_key(phrase)
+    found = [
+        (dataset, column, dtype)
+        for dataset, columns in candidates.items()
+        for column, dtype in columns.items()
+        if _column_key(column) == key
+    ]
+    return found[0] if len(found) == 1 else None
+
+
+def _render(name: str, dataset: str, **values) -> Intent:
+    explanation, code = _TEMPLATES[name]
+    return Intent(
+        name=name,
+        dataset=dataset,
+        explanation=Template(explanation).substitute(ds=dataset, **values),
+        code=Template(code).substitute(ds=dataset, **values),
+    )
+
+
+def route_intent(message: str, executor) -> Optional[Intent]:
+    """
+    The template answering a message, or None to use the LLM
+
+    Conservative on purpose: the message must match a pattern in full, and a
+    conversation with several datasets must name one (or a column only one of
+    them has).
+    """
+    datasets = list(executor.datasets)
+    if not datasets:
+        return None
+    text, target = _split_target(_normalize(message), datasets)
+    if target is None and len(datasets) == 1:
+        target = datasets[0]
+
+    histogram = _HISTOGRAM.fullmatch(text)
+    if histogram:
+        phrase = histogram.group("column") or histogram.group("column2")
+        scope = [target] if target else datasets
+        resolved = _resolve_column(phrase, {name: executor.dataset_columns(name) for name in scope})
+        if resolved is None:
+            return None
+        dataset, column, dtype = resolved
+        kind = "histogram" if _NUMERIC_DTYPE.match(dtype) else "value_counts"
+        return _render(kind, dataset, column=column, column_literal=repr(column))
+
+    if target is None:
+        return None
+    if _DESCRIBE.fullmatch(text):
+        return _render("describe", target)
+    if _MISSING.fullmatch(text):
+        return _render("missing", target)
+    if _SHAPE.fullmatch(text):
+        return _render("shape", target)
+    if _COLUMNS.fullmatch(text):
+        return _render("columns", target)
+    head = _HEAD.fullmatch(text)
+    if head:
+        rows = min(int(head.group("n") or 5), FAST_PATH_MAX_HEAD_ROWS)
+        return _render("head", target, n=rows)
+    return None
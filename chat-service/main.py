@@ -1,17 +1,24 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Header, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, Response
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
+from collections import OrderedDict
 import os
 from dotenv import load_dotenv
 import httpx
 from openai import AsyncOpenAI
 import json
 import base64
+import re
+import time
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass, field
 
-# Import code executor and data analysis agent
-from code_executor import CodeExecutor
+# Import code executor and data analysis agent (the data stack itself is imported lazily)
+from code_executor import CodeExecutor, summarize_output, warm_up
 from data_analysis_agent import (
     DATA_ANALYSIS_SYSTEM_PROMPT,
     extract_python_code,
@@ -20,10 +27,59 @@ from data_analysis_agent import (
     should_retry_code,
     create_retry_prompt
 )
+from cluster import CLUSTER_HEARTBEAT_SECONDS, FORWARDED_HEADER, create_cluster
+from app_shared.compression import CompressionMiddleware
+from intents import FAST_PATH, route_intent
+from persistence import PersistenceQueue
+from prompts import build_analysis_messages, cache_options
+from snapshots import (
+    delete_snapshot, enforce_disk_budget, evict_to_snapshot, frame_path, read_snapshot, snapshot_frame_names,
+    snapshots_available, write_snapshot,
+)
+from turns import TurnRegistry, Turn
+from metrics import (
+    CLIENT_DISCONNECTS,
+    CLUSTER_FORWARDS,
+    CLUSTER_REHYDRATIONS,
+    CONTENT_TYPE as METRICS_CONTENT_TYPE,
+    EXECUTOR_EVICTIONS,
+    EXECUTOR_INFLIGHT,
+    FAST_PATH_TURNS,
+    TURN_LATENCY,
+    WORK_SAVED,
+    observe_llm_usage,
+    observe_stage,
+    register_executor_collectors,
+    render_latest,
+    stage,
+)
 
 load_dotenv()
 
-app = FastAPI(title="Chat Service", version="1.0.0")
+# Warm the data stack in the background after startup so the first CSV question
+# does not pay import and first-render costs, while plain chat starts immediately
+EXECUTOR_PREWARM = os.getenv("EXECUTOR_PREWARM", "1") == "1"
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if EXECUTOR_PREWARM:
+        execution_pool.submit(warm_up)
+    if cluster is not None:
+        await cluster.start()
+    yield
+    if cluster is not None:
+        await cluster.stop()  # Stop being routed to before winding down
+    await turns.shutdown()
+    # Flush queued writes (e.g. partial answers of the turns just cancelled)
+    await persistence.drain(timeout=10)
+    if _detached_tasks:
+        await asyncio.wait(_detached_tasks, timeout=10)
+    await storage_client.aclose()
+    await cluster_client.aclose()
+    execution_pool.shutdown(wait=False, cancel_futures=True)
+    await asyncio.to_thread(snapshot_pool.shutdown, wait=True)  # Finish snapshots in progress
+
+app = FastAPI(title="Chat Service", version="1.0.0", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -32,15 +88,55 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(CompressionMiddleware)
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 STORAGE_SERVICE_URL = os.getenv("STORAGE_SERVICE_URL", "http://localhost:8002")
 MODEL = os.getenv("MODEL", "gpt-5-mini")
 
+# Ask streamed completions for a final usage chunk (prompt and cache-hit tokens)
+LLM_STREAM_USAGE = os.getenv("LLM_STREAM_USAGE", "1") == "1"
+STREAM_OPTIONS = {"stream_options": {"include_usage": True}} if LLM_STREAM_USAGE else {}
+
 client = AsyncOpenAI(api_key=OPENAI_API_KEY)
 
+# One pooled client for all storage-service calls (keep-alive instead of a new connection per call)
+storage_client = httpx.AsyncClient(
+    base_url=STORAGE_SERVICE_URL,
+    timeout=10.0,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+)
+
 # Initialize code executor for data analysis
-code_executors = {}  # conversation_id -> CodeExecutor
+code_executors: "OrderedDict[int, CodeExecutor]" = OrderedDict()  # conversation_id -> CodeExecutor, least recently used first
+# With snapshots available, idle executors beyond this are dropped from memory and restored from disk on demand
+MAX_RESIDENT_EXECUTORS = int(os.getenv("MAX_RESIDENT_EXECUTORS", "64"))
+
+# Snapshot writes run one at a time, off the execution pool (see snapshots.py)
+snapshot_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="snapshot")
+_snapshot_writes: Dict[int, Future] = {}  # conversation_id -> latest queued write
+
+# Scale-out: with CLUSTER_MODE set, conversations are pinned to nodes (see cluster.py)
+cluster = create_cluster()
+cluster_client = httpx.AsyncClient(timeout=httpx.Timeout(10.0, read=None))  # Proxied SSE streams stay open
+
+# Streamed responses in flight, resumable by Last-Event-ID
+turns = TurnRegistry(id_prefix=f"{cluster.node_id}." if cluster is not None else "")
+
+# Executions block (exec or waiting on the sandbox process), so they run off the event loop.
+# CodeExecutor isolates stdout and figures per execution, so conversations run in parallel.
+EXECUTION_WORKERS = int(os.getenv("EXECUTION_WORKERS", str(os.cpu_count() or 4)))
+execution_pool = ThreadPoolExecutor(max_workers=EXECUTION_WORKERS, thread_name_prefix="code-exec")
+# Code blocks of one response run concurrently, at most this many at a time
+PARALLEL_CODE_BLOCKS = max(1, int(os.getenv("PARALLEL_CODE_BLOCKS", "4")))
+
+# Budget for execution output quoted in the interpretation prompt (the user still sees the full capture)
+INTERPRETATION_OUTPUT_CHARS = int(os.getenv("INTERPRETATION_OUTPUT_CHARS", "12000"))
+
+register_executor_collectors(
+    code_executors,
+    lambda: sum(executor.memory_bytes() for executor in list(code_executors.values())),
+)
 
 class ChatRequest(BaseModel):
     conversation_id: int
@@ -48,12 +144,24 @@ class ChatRequest(BaseModel):
     image_url: Optional[str] = None  # For image-based chat
     model: Optional[str] = None
 
+class DatasetRef(BaseModel):
+    csv_path: str  # Can be file path or URL
+    name: Optional[str] = None  # DataFrame name in generated code; derived from the filename if omitted
+    filename: Optional[str] = None
+
 class CSVAnalysisRequest(BaseModel):
     conversation_id: int
     message: str
-    csv_path: str  # Can be file path or URL
+    csv_path: Optional[str] = None  # A single dataset (named df), file path or URL
+    datasets: List[DatasetRef] = []  # Every dataset of the conversation, loaded only when code uses it
     model: Optional[str] = None
 
+    def dataset_refs(self) -> List[DatasetRef]:
+        refs = list(self.datasets)
+        if self.csv_path and all(ref.csv_path != self.csv_path for ref in refs):
+            refs.insert(0, DatasetRef(csv_path=self.csv_path))
+        return refs
+
 class Message(BaseModel):
     role: str
     content: str
@@ -62,106 +170,354 @@ class Message(BaseModel):
 def health_check():
     return {"status": "healthy", "service": "chat"}
 
-async def save_message(conversation_id: int, role: str, content: str, image_url: Optional[str] = None, plots: Optional[List[str]] = None):
-    """Save message to storage service"""
-    async with httpx.AsyncClient() as http_client:
-        try:
-            response = await http_client.post(
-                f"{STORAGE_SERVICE_URL}/api/conversations/{conversation_id}/messages",
-                json={"role": role, "content": content, "image_url": image_url, "plots": plots},
-                timeout=10.0
-            )
-            response.raise_for_status()
-        except Exception as e:
-            pass  # Silently fail, message saving is not critical for streaming
+@app.get("/metrics")
+def metrics():
+    """Prometheus scrape endpoint"""
+    return Response(content=render_latest(), media_type=METRICS_CONTENT_TYPE)
+
+async def post_message(conversation_id: int, payload: dict) -> dict:
+    """Write one message to storage service and return the stored record"""
+    response = await storage_client.post(f"/api/conversations/{conversation_id}/messages", json=payload)
+    response.raise_for_status()
+    return response.json()
+
+# Message writes are queued and ordered per conversation (see persistence.py)
+persistence = PersistenceQueue(post_message)
+
+def save_message(conversation_id: int, role: str, content: str, image_url: Optional[str] = None, plots: Optional[List[str]] = None) -> "asyncio.Future":
+    """Queue a message for storage; await the result for the stored record (None if the write failed)"""
+    future = persistence.submit(
+        conversation_id,
+        {"role": role, "content": content, "image_url": image_url, "plots": plots},
+    )
+    # Cancelling the awaiting turn must not cancel the write itself
+    return asyncio.shield(future)
+
+# History replays re-send the same images every turn. Keep their data URLs in a
+# byte-bounded LRU: immutable (content-addressed) uploads are served straight
+# from it, others are revalidated with If-None-Match.
+IMAGE_CACHE_BYTES = int(os.getenv("IMAGE_CACHE_BYTES", str(64 * 1024 * 1024)))
+_image_cache: "OrderedDict[str, Tuple[str, Optional[str], bool]]" = OrderedDict()  # url -> (data_url, etag, immutable)
+_image_cache_size = 0
+
+def _cache_image(image_url: str, data_url: str, etag: Optional[str], immutable: bool):
+    global _image_cache_size
+    if len(data_url) > IMAGE_CACHE_BYTES:
+        return
+    previous = _image_cache.pop(image_url, None)
+    if previous:
+        _image_cache_size -= len(previous[0])
+    _image_cache[image_url] = (data_url, etag, immutable)
+    _image_cache_size += len(data_url)
+    while _image_cache_size > IMAGE_CACHE_BYTES:
+        _, (evicted, _, _) = _image_cache.popitem(last=False)
+        _image_cache_size -= len(evicted)
+
+# Vision requests use storage-service's downscaled derivative of content-addressed
+# uploads instead of the full-resolution original
+VISION_IMAGE_VARIANT = os.getenv("VISION_IMAGE_VARIANT", "vision")  # 'vision' or 'original'
+VISION_DETAIL = os.getenv("VISION_DETAIL", "auto")  # OpenAI image detail: auto, low or high
+CONTENT_ADDRESSED_UPLOAD_RE = re.compile(r"^/uploads/([0-9a-f]{64})\.[A-Za-z0-9]+$")
+
+def vision_image_url(image_url: str) -> str:
+    """URL of the image variant to send to the model"""
+    match = CONTENT_ADDRESSED_UPLOAD_RE.match(image_url)
+    if VISION_IMAGE_VARIANT == "vision" and match:
+        return f"/uploads/{match.group(1)}.vision.jpg"
+    return image_url
 
 async def get_image_as_base64(image_url: str) -> str:
     """Download image from storage service and convert to base64 data URL"""
-    async with httpx.AsyncClient() as http_client:
-        try:
-            full_url = f"{STORAGE_SERVICE_URL}{image_url}"
-            response = await http_client.get(full_url, timeout=10.0)
-            response.raise_for_status()
-            
-            # Get image content type
-            content_type = response.headers.get('content-type', 'image/png')
-            
-            # Convert to base64
-            image_data = base64.b64encode(response.content).decode('utf-8')
-            data_url = f"data:{content_type};base64,{image_data}"
-            
-            return data_url
-        except Exception as e:
-            raise
+    cached = _image_cache.get(image_url)
+    if cached and cached[2]:
+        _image_cache.move_to_end(image_url)
+        return cached[0]
+    
+    headers = {"If-None-Match": cached[1]} if cached and cached[1] else None
+    response = await storage_client.get(image_url, headers=headers)
+    if response.status_code == 304 and cached:
+        _image_cache.move_to_end(image_url)
+        return cached[0]
+    response.raise_for_status()
+    
+    # Get image content type
+    content_type = response.headers.get('content-type', 'image/png')
+    
+    # Convert to base64
+    image_data = base64.b64encode(response.content).decode('utf-8')
+    data_url = f"data:{content_type};base64,{image_data}"
+    
+    _cache_image(
+        image_url,
+        data_url,
+        response.headers.get('etag'),
+        'immutable' in response.headers.get('cache-control', ''),
+    )
+    return data_url
+
+async def fetch_messages(conversation_id: int) -> List[dict]:
+    """Get the raw stored messages of a conversation from storage service"""
+    try:
+        response = await storage_client.get(f"/api/conversations/{conversation_id}/messages")
+        response.raise_for_status()
+        return response.json()
+    except Exception:
+        return []
 
-async def get_conversation_history(conversation_id: int) -> List[dict]:
-    """Get conversation history from storage service"""
-    async with httpx.AsyncClient() as http_client:
+async def format_history_message(msg: dict) -> dict:
+    """Convert a stored message to the OpenAI chat format, inlining its image"""
+    if msg.get("image_url"):
+        # Convert image to base64 data URL
         try:
-            response = await http_client.get(
-                f"{STORAGE_SERVICE_URL}/api/conversations/{conversation_id}/messages",
-                timeout=10.0
-            )
-            response.raise_for_status()
-            messages = response.json()
-        
-            formatted_messages = []
-            for msg in messages:
-                if msg.get("image_url"):
-                    # Convert image to base64 data URL
-                    try:
-                        image_data_url = await get_image_as_base64(msg["image_url"])
-                        formatted_messages.append({
-                            "role": msg["role"],
-                            "content": [
-                                {"type": "text", "text": msg["content"]},
-                                {"type": "image_url", "image_url": {"url": image_data_url}}
-                            ]
-                        })
-                    except Exception:
-                        # Fallback: just send text without image
-                        formatted_messages.append({"role": msg["role"], "content": msg["content"]})
-                else:
-                    # Regular text message
-                    formatted_messages.append({"role": msg["role"], "content": msg["content"]})
-            return formatted_messages
+            with stage("history", "image_fetch"):
+                derivative_url = vision_image_url(msg["image_url"])
+                try:
+                    image_data_url = await get_image_as_base64(derivative_url)
+                except Exception:
+                    if derivative_url == msg["image_url"]:
+                        raise
+                    image_data_url = await get_image_as_base64(msg["image_url"])
+            return {
+                "role": msg["role"],
+                "content": [
+                    {"type": "text", "text": msg["content"]},
+                    {"type": "image_url", "image_url": {"url": image_data_url, "detail": VISION_DETAIL}}
+                ]
+            }
         except Exception:
-            return []
+            # Fallback: just send text without image
+            return {"role": msg["role"], "content": msg["content"]}
+    # Regular text message
+    return {"role": msg["role"], "content": msg["content"]}
+
+async def get_conversation_history(conversation_id: int, user_message: dict, progress: "TurnProgress") -> List[dict]:
+    """
+    Store the new user message and build the model's history, overlapping the two
+
+    The write and the history read run concurrently, so the read may or may not
+    already include the new message; it is dropped by id and appended last.
+    """
+    stored, messages = await asyncio.gather(
+        timed(progress, "save_user_message", save_message(conversation_id, **user_message)),
+        timed(progress, "fetch_history", fetch_messages(conversation_id)),
+    )
+    if stored:
+        messages = [msg for msg in messages if msg.get("id") != stored["id"]]
+    messages.append(user_message)
+    with progress.stage("format_history"):
+        # Images are fetched concurrently
+        return list(await asyncio.gather(*(format_history_message(msg) for msg in messages)))
+
+# --- Client disconnects ---------------------------------------------------------
+# Turns run detached from the connection (see turns.py). When no client has been
+# attached for the grace period the turn's generator is cancelled at its current
+# await. Upstream work is then stopped - the LLM request or stream is closed and
+# the running execution killed - and whatever was already streamed is saved as a
+# partial answer.
+
+LLM_STAGES = {"llm_stream", "llm_call", "retry_llm_call", "interpretation_stream"}
+INTERRUPTED_NOTE = "\n\n_(Response interrupted: the client disconnected.)_"
+
+_detached_tasks = set()
+
+def run_detached(coro):
+    """Run a coroutine to completion even if the request that started it is cancelled"""
+    task = asyncio.create_task(coro)
+    _detached_tasks.add(task)
+    task.add_done_callback(_detached_tasks.discard)
+    return task
+
+@dataclass
+class TurnProgress:
+    """What a streamed turn has done so far, so an abandoned turn can be wound down"""
+    handler: str
+    current_stage: str = "start"
+    in_flight: Optional[str] = None  # Stage currently awaiting upstream work
+    content: List[str] = field(default_factory=list)  # Content frames sent to the client
+    plots: List[str] = field(default_factory=list)
+    pending_executions: int = 0  # Code blocks not yet run (including the running ones)
+    running_executions: int = 0
+    executions: List[asyncio.Task] = field(default_factory=list)  # Scheduled code blocks, cancelled with the turn
+    llm_stream: Optional[object] = None  # Open OpenAI stream to close on disconnect
+    finished: bool = False
+
+    @contextmanager
+    def stage(self, name: str):
+        self.current_stage = self.in_flight = name
+        with stage(self.handler, name):
+            yield
+        # Left set if the stage was interrupted, so abandon_turn knows what was cut short
+        self.in_flight = None
+
+    def record(self, payload: dict):
+        if payload.get('type') == 'image':
+            self.plots.append(payload['data'])
+        elif payload.get('content'):
+            self.content.append(payload['content'])
+
+async def timed(progress: TurnProgress, name: str, awaitable):
+    """Await one pipeline stage under its stage timer"""
+    with progress.stage(name):
+        return await awaitable
+
+def sse_event(payload: dict, progress: Optional[TurnProgress] = None) -> str:
+    """Format an SSE data frame, recording streamed content for partial-answer persistence"""
+    if progress is not None:
+        progress.record(payload)
+    return f"data: {json.dumps(payload)}\n\n"
+
+def turn_response(turn: Turn, last_seq: Optional[int] = None) -> StreamingResponse:
+    """SSE response reading a turn's replay buffer after last_seq, then live"""
+    return StreamingResponse(
+        turn.events(last_seq),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "Connection": "keep-alive",
+            "X-Turn-Id": turn.id,
+        }
+    )
+
+HOP_BY_HOP_HEADERS = {"connection", "keep-alive", "transfer-encoding", "te", "upgrade", "host", "content-length"}
+
+async def forward_to_node(node_id: str, request: Request, body: Optional[dict] = None) -> Optional[Response]:
+    """Proxy a request to another cluster node and stream its response back; None if it has left the cluster"""
+    url = cluster.node_url_for(node_id)
+    if url is None:
+        return None
+    headers = {k: v for k, v in request.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS}
+    headers[FORWARDED_HEADER] = cluster.node_id
+    upstream_request = cluster_client.build_request(
+        request.method, url + request.url.path, params=request.query_params, headers=headers, json=body
+    )
+    try:
+        upstream = await cluster_client.send(upstream_request, stream=True)
+    except (httpx.ConnectError, httpx.ConnectTimeout):
+        CLUSTER_FORWARDS.labels("owner_unreachable").inc()
+        if await cluster.is_live(node_id):
+            # Still heartbeating: taking the conversation over here would split it across two nodes
+            raise HTTPException(
+                status_code=503,
+                detail=f"Cluster node {node_id} is unreachable",
+                headers={"Retry-After": str(max(1, round(CLUSTER_HEARTBEAT_SECONDS)))},
+            )
+        return None
+    CLUSTER_FORWARDS.labels("forwarded").inc()
+    
+    async def relay():
+        # Closing upstream on client disconnect detaches the owner's turn like a direct client would
+        try:
+            async for chunk in upstream.aiter_raw():
+                yield chunk
+        finally:
+            await upstream.aclose()
+    
+    return StreamingResponse(
+        relay(),
+        status_code=upstream.status_code,
+        headers={k: v for k, v in upstream.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS},
+    )
+
+async def route_to_conversation_owner(conversation_id: int, request: Request, body: Optional[dict] = None) -> Optional[Response]:
+    """Proxy to the node holding the conversation's executor; None when it is (now) this node"""
+    if cluster is None or FORWARDED_HEADER in request.headers:
+        return None
+    owner = await cluster.owner(conversation_id)
+    if owner == cluster.node_id:
+        return None
+    return await forward_to_node(owner, request, body)
+
+async def route_to_turn_node(turn_id: Optional[str], request: Request, body: Optional[dict] = None) -> Optional[Response]:
+    """Proxy a resume to the node running the turn; None when the turn is local or its node is gone"""
+    if cluster is None or not turn_id or FORWARDED_HEADER in request.headers:
+        return None
+    node_id = turn_id.partition(".")[0]
+    if node_id == cluster.node_id:
+        return None
+    return await forward_to_node(node_id, request, body)
+
+def abandon_turn(progress: TurnProgress, conversation_id: int):
+    """Stop upstream work for a turn whose client disconnected and keep what was streamed"""
+    CLIENT_DISCONNECTS.labels(progress.handler, progress.current_stage).inc()
+    if progress.llm_stream is not None:
+        run_detached(progress.llm_stream.close())
+    if progress.in_flight in LLM_STAGES:
+        WORK_SAVED.labels(progress.handler, "llm_calls_aborted").inc()
+    # Running executions are killed (and counted) by run_code; the rest never start
+    skipped = progress.pending_executions - progress.running_executions
+    if skipped > 0:
+        WORK_SAVED.labels(progress.handler, "executions_skipped").inc(skipped)
+    if progress.content or progress.plots:
+        partial = "".join(progress.content) + INTERRUPTED_NOTE
+        save_message(conversation_id, "assistant", partial, plots=progress.plots or None)
 
 async def stream_chat_response(conversation_id: int, user_message: str, model: str, image_url: Optional[str] = None):
     """Stream chat response from OpenAI"""
+    turn_start = time.perf_counter()
+    outcome = "ok"
+    progress = TurnProgress("chat")
     try:
-        await save_message(conversation_id, "user", user_message, image_url)
-        history = await get_conversation_history(conversation_id)
+        history = await get_conversation_history(
+            conversation_id,
+            {"role": "user", "content": user_message, "image_url": image_url},
+            progress,
+        )
     
         messages = [
             {"role": "system", "content": "You are a helpful assistant."}
         ] + history
         
         full_response = ""
-        stream = await client.chat.completions.create(
-            model=model,
-            messages=messages,
-            stream=True,
-            temperature=0.7,
-        )
-        
-        async for chunk in stream:
-            if chunk.choices[0].delta.content:
-                content = chunk.choices[0].delta.content
-                full_response += content
-                yield f"data: {json.dumps({'content': content, 'done': False})}\n\n"
+        with progress.stage("llm_stream"):
+            stream = await client.chat.completions.create(
+                model=model,
+                messages=messages,
+                stream=True,
+                temperature=0.7,
+                **STREAM_OPTIONS,
+            )
+            progress.llm_stream = stream
+            
+            async for chunk in stream:
+                if chunk.usage is not None:
+                    observe_llm_usage("chat", "llm_stream", chunk.usage)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    content = chunk.choices[0].delta.content
+                    full_response += content
+                    yield sse_event({'content': content, 'done': False}, progress)
+            progress.llm_stream = None
         
-        await save_message(conversation_id, "assistant", full_response)
-        yield f"data: {json.dumps({'content': '', 'done': True})}\n\n"
+        # The answer is complete; save it even if the client leaves meanwhile
+        progress.finished = True
+        with progress.stage("save_assistant_message"):
+            await save_message(conversation_id, "assistant", full_response)
+        yield sse_event({'content': '', 'done': True}, progress)
         
+    except (asyncio.CancelledError, GeneratorExit):
+        if not progress.finished:
+            outcome = "disconnected"
+            abandon_turn(progress, conversation_id)
+        raise
     except Exception as e:
+        outcome = "error"
         error_message = f"Error: {str(e)}"
-        yield f"data: {json.dumps({'error': error_message, 'done': True})}\n\n"
+        yield sse_event({'error': error_message, 'done': True})
+    finally:
+        TURN_LATENCY.labels("chat", outcome).observe(time.perf_counter() - turn_start)
 
 @app.post("/api/chat/stream")
-async def chat_stream(request: ChatRequest):
+async def chat_stream(request: ChatRequest, http_request: Request, last_event_id: Optional[str] = Header(None)):
     """Stream chat responses"""
+    # Plain chat runs on any node; only a resume has to reach the node running the turn
+    forwarded = await route_to_turn_node(last_event_id, http_request, request.model_dump())
+    if forwarded is not None:
+        return forwarded
+    
+    # A reconnect for a turn that is still running (or recently finished) replays it
+    resumed = turns.resume(last_event_id, request.conversation_id)
+    if resumed:
+        return turn_response(*resumed)
+    
     if request.image_url:
         model = request.model or "gpt-4o"  
     else:
@@ -170,14 +526,11 @@ async def chat_stream(request: ChatRequest):
     if not OPENAI_API_KEY:
         raise HTTPException(status_code=500, detail="OpenAI API key not configured")
     
-    return StreamingResponse(
+    turn = turns.start(
+        request.conversation_id,
         stream_chat_response(request.conversation_id, request.message, model, request.image_url),
-        media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-        }
     )
+    return turn_response(turn)
 
 
 
@@ -185,51 +538,198 @@ def get_code_executor(conversation_id: int) -> CodeExecutor:
     """Get or create a code executor for a conversation"""
     if conversation_id not in code_executors:
         code_executors[conversation_id] = CodeExecutor()
+        evict_idle_executors()
+    code_executors.move_to_end(conversation_id)
     return code_executors[conversation_id]
 
-async def stream_csv_analysis_response(conversation_id: int, user_message: str, csv_path: str, model: str, max_retries: int = 2):
+def evict_idle_executors():
+    """Drop least recently used executors beyond MAX_RESIDENT_EXECUTORS whose every frame is on disk"""
+    if not snapshots_available():
+        return  # Memory is the only copy
+    for conversation_id in list(code_executors)[:-1]:  # The last one is being requested
+        if len(code_executors) <= MAX_RESIDENT_EXECUTORS:
+            break
+        executor = code_executors[conversation_id]
+        if (executor.busy() or executor.has_unsnapshotted_changes() or conversation_id in _snapshot_writes
+                or turns.running(conversation_id)):
+            continue
+        if evict_to_snapshot(conversation_id, executor.list_dataframes(), lambda: code_executors.pop(conversation_id)):
+            executor.clear()
+            EXECUTOR_EVICTIONS.inc()
+
+def write_snapshot_job(conversation_id: int, executor: CodeExecutor, frames: Dict, sources: Dict[str, str], df_count: int):
+    """Snapshot pool job: write the frames, confirm them to the executor and trim the disk used"""
+    written = []
+    try:
+        written = write_snapshot(conversation_id, frames, sources, df_count)
+    finally:
+        # Frames not written stay changed (and resident); written ones are mapped by workers from then on
+        executor.snapshot_written(frames, written, {name: frame_path(conversation_id, name) for name in written})
+    enforce_disk_budget(code_executors.__contains__)
+
+def schedule_snapshot(conversation_id: int, executor: CodeExecutor):
+    """Write the executor's changed frames to disk in the background"""
+    if not snapshots_available():
+        return
+    frames, sources, df_count = executor.snapshot_changes()
+    if not frames:
+        return
+    future = snapshot_pool.submit(write_snapshot_job, conversation_id, executor, frames, sources, df_count)
+    _snapshot_writes[conversation_id] = future
+    
+    def forget(done: Future):
+        if _snapshot_writes.get(conversation_id) is done:
+            del _snapshot_writes[conversation_id]
+    
+    future.add_done_callback(forget)
+
+def restore_executor(conversation_id: int, executor: CodeExecutor) -> bool:
+    """Load a conversation's snapshot into its (empty) executor; runs on the execution pool"""
+    snapshot = read_snapshot(conversation_id)
+    if snapshot is None:
+        return False
+    frames, datasets, df_count = snapshot
+    executor.restore(frames, datasets, df_count, {name: frame_path(conversation_id, name) for name in frames})
+    return True
+
+async def rehydrate_executor(conversation_id: int):
+    """Take over a conversation placed on a node that has left, from a (shared) snapshot or its CSV"""
+    location = await asyncio.to_thread(cluster.registry.location, conversation_id)
+    if location is None or location["node_id"] == cluster.node_id or not location["csv_path"]:
+        return
+    await cluster.claim(conversation_id, location["csv_path"])
+    CLUSTER_REHYDRATIONS.inc()
+    executor = get_code_executor(conversation_id)
+    loop = asyncio.get_running_loop()
+    if not await loop.run_in_executor(execution_pool, restore_executor, conversation_id, executor):
+        await loop.run_in_executor(execution_pool, executor.add_dataset, location["csv_path"])
+
+async def run_code(conversation_id: int, executor: CodeExecutor, code: str, progress: TurnProgress) -> dict:
+    """Execute a code block on the execution pool, recording timings and the in-flight gauge"""
+    EXECUTOR_INFLIGHT.inc()
+    progress.running_executions += 1
+    progress.current_stage = "execute"
+    try:
+        # Timed directly rather than with progress.stage: blocks of one turn may run concurrently
+        with stage(progress.handler, "execute"):
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(execution_pool, executor.execute_code, code)
+    except asyncio.CancelledError:
+        # Client gone: a queued job is dropped with its future, a running one is killed
+        if executor.cancel():
+            WORK_SAVED.labels(progress.handler, "executions_cancelled").inc()
+        raise
+    finally:
+        EXECUTOR_INFLIGHT.dec()
+        progress.running_executions -= 1
+    progress.pending_executions -= 1
+    if result['success']:
+        schedule_snapshot(conversation_id, executor)
+    for name, seconds in result.get('timings', {}).items():
+        observe_stage("csv_analysis", name, seconds)
+    return result
+
+def schedule_code_blocks(conversation_id: int, executor: CodeExecutor, code_blocks: List[str], progress: TurnProgress) -> List[asyncio.Task]:
+    """
+    Start a response's code blocks concurrently, at most PARALLEL_CODE_BLOCKS at a time
+
+    The blocks are independent: each runs in its own namespace on copies of the
+    executor's frames and saves nothing, so no block can see another's variables
+    or changes, and the order they run in does not matter.
+    """
+    slots = asyncio.Semaphore(PARALLEL_CODE_BLOCKS)
+    
+    async def run_block(code: str) -> dict:
+        async with slots:
+            return await run_code(conversation_id, executor, code, progress)
+    
+    tasks = [asyncio.create_task(run_block(code)) for code in code_blocks]
+    progress.executions.extend(tasks)
+    return tasks
+
+async def stream_csv_analysis_response(conversation_id: int, user_message: str, datasets: List[DatasetRef], model: str, max_retries: int = 2):
     """Stream CSV data analysis with code execution"""
+    turn_start = time.perf_counter()
+    outcome = "ok"
+    progress = TurnProgress("csv_analysis")
     try:
         executor = get_code_executor(conversation_id)
+        loop = asyncio.get_running_loop()
         
-        # Load CSV if not already loaded
-        if not executor.list_dataframes():
-            success, result = executor.load_csv(csv_path, "df")
-            
-            if not success:
-                error_msg = f"Failed to load CSV: {result}"
-                yield f"data: {json.dumps({'content': error_msg, 'done': True, 'error': True})}\n\n"
-                return
-            
-            # Send CSV info to user
-            yield f"data: {json.dumps({'content': f'✅ {result}\\n\\n', 'done': False})}\n\n"
+        async def register_and_profile():
+            # Restore an evicted executor, register the request's datasets (checked, not loaded:
+            # code loads what it uses), then profile them; all run on the execution pool
+            if not executor.datasets:
+                await timed(progress, "restore_snapshot", loop.run_in_executor(
+                    execution_pool, restore_executor, conversation_id, executor
+                ))
+            added = []
+            for ref in datasets:
+                known = ref.csv_path in executor.datasets.values()
+                success, result = await timed(progress, "add_dataset", loop.run_in_executor(
+                    execution_pool, executor.add_dataset, ref.csv_path, ref.name, ref.filename
+                ))
+                if not success:
+                    return result, added, None
+                if not known:
+                    added.append((result, ref.filename or os.path.basename(ref.csv_path)))
+            if not executor.datasets:
+                return "No dataset has been uploaded in this conversation.", added, None
+            profiles = await timed(progress, "build_profile", loop.run_in_executor(
+                execution_pool, executor.dataset_profiles
+            ))
+            return None, added, profiles
         
-        # Save user message
-        await save_message(conversation_id, "user", user_message)
+        cache = cache_options("csv-analysis", conversation_id)
         
-        # Get conversation history
-        history = await get_conversation_history(conversation_id)
+        # The datasets and the conversation (user message write + history read) are independent
+        (load_error, added, profiles), history = await asyncio.gather(
+            register_and_profile(),
+            get_conversation_history(conversation_id, {"role": "user", "content": user_message}, progress),
+        )
         
-        # Create messages with data analysis system prompt
-        df_info = executor.get_dataframe_info("df") if "df" in executor.list_dataframes() else None
-        messages = [
-            {"role": "system", "content": DATA_ANALYSIS_SYSTEM_PROMPT}
-        ]
+        if load_error is not None:
+            outcome = "error"
+            error_msg = f"Failed to load CSV: {load_error}"
+            yield sse_event({'content': error_msg, 'done': True, 'error': True})
+            return
+        
+        # Tell the user about new datasets
+        for name, label in added:
+            yield sse_event({'content': f"✅ Dataset '{name}' added from {label} (loaded when the analysis first uses it)\n\n", 'done': False})
         
-        if df_info:
-            messages.append({
-                "role": "system", 
-                "content": f"The user has loaded a dataset. Here's the information:\n\n{df_info}"
-            })
+        # Common questions are answered from templates without the LLM
+        intent = route_intent(user_message, executor) if FAST_PATH else None
+        if intent is not None:
+            progress.pending_executions = 1
+            result = await run_code(conversation_id, executor, intent.code, progress)
+            if result['success']:
+                FAST_PATH_TURNS.labels(intent.name, "answered").inc()
+                yield sse_event({'content': intent.explanation, 'done': False}, progress)
+                if result['stdout']:
+                    yield sse_event({'content': f"\n\n{result['stdout']}\n", 'done': False}, progress)
+                for plot_base64 in result['plots']:
+                    yield sse_event({'type': 'image', 'data': plot_base64, 'done': False}, progress)
+                progress.finished = True
+                with progress.stage("save_assistant_message"):
+                    answer = f"{intent.explanation}\n\n{result['stdout']}".rstrip()
+                    await save_message(conversation_id, "assistant", answer, plots=result['plots'] or None)
+                yield sse_event({'content': '', 'done': True}, progress)
+                return
+            FAST_PATH_TURNS.labels(intent.name, "fallback").inc()
         
-        messages.extend(history)
+        # Stable parts first (system prompt, profiles, history), volatile session state last
+        messages = build_analysis_messages(DATA_ANALYSIS_SYSTEM_PROMPT, profiles, history, executor.session_state())
         
         # First LLM call - generate analysis and code
-        response = await client.chat.completions.create(
-            model=model,
-            messages=messages,
-            temperature=0.7,
-        )
+        with progress.stage("llm_call"):
+            response = await client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=0.7,
+                **cache,
+            )
+        observe_llm_usage("csv_analysis", "llm_call", response.usage)
         
         full_response = response.choices[0].message.content
         
@@ -244,7 +744,7 @@ async def stream_csv_analysis_response(conversation_id: int, user_message: str,
             chunk_size = 50
             for i in range(0, len(explanatory_text), chunk_size):
                 chunk = explanatory_text[i:i+chunk_size]
-                yield f"data: {json.dumps({'content': chunk, 'done': False})}\n\n"
+                yield sse_event({'content': chunk, 'done': False}, progress)
         
         # Execute code blocks
         all_plots = []  # Collect all plots for saving
@@ -252,8 +752,11 @@ async def stream_csv_analysis_response(conversation_id: int, user_message: str,
         
         if code_blocks:
             retry_count = 0
+            progress.pending_executions = len(code_blocks)
+            # The blocks run concurrently; their results are still streamed in order
+            executions = schedule_code_blocks(conversation_id, executor, code_blocks, progress)
             for i, code in enumerate(code_blocks):
-                result = executor.execute_code(code)
+                result = await executions[i]
                 
                 # Collect execution output for follow-up
                 if result['success'] and result['stdout']:
@@ -263,11 +766,11 @@ async def stream_csv_analysis_response(conversation_id: int, user_message: str,
                 if result['success'] and result['stdout']:
                     # Format stdout nicely
                     output_msg = f"\n\n{result['stdout']}\n"
-                    yield f"data: {json.dumps({'content': output_msg, 'done': False})}\n\n"
+                    yield sse_event({'content': output_msg, 'done': False}, progress)
                 elif not result['success']:
                     # Only show errors if execution failed
                     error_msg = f"\n\n❌ **Error during execution:**\n```\n{result['error']}\n```\n"
-                    yield f"data: {json.dumps({'content': error_msg, 'done': False})}\n\n"
+                    yield sse_event({'content': error_msg, 'done': False}, progress)
                 
                 # Send plots as base64 images and collect them
                 if result['plots']:
@@ -278,24 +781,28 @@ async def stream_csv_analysis_response(conversation_id: int, user_message: str,
                             'data': plot_base64,
                             'done': False
                         }
-                        yield f"data: {json.dumps(plot_data)}\n\n"
+                        yield sse_event(plot_data, progress)
                 
                 # If code failed and should retry
-                if not result['success'] and should_retry_code(result['error'], retry_count, max_retries):
+                if not result['success'] and should_retry_code(result['error'], retry_count, max_retries,
+                                                               timed_out=result.get('timed_out', False)):
                     retry_count += 1
                     retry_prompt = create_retry_prompt(user_message, code, result['error'])
-                    yield f"data: {json.dumps({'content': '\\n\\n🔄 **Attempting to fix the error...**\\n\\n', 'done': False})}\n\n"
+                    yield sse_event({'content': '\n\n🔄 **Attempting to fix the error...**\n\n', 'done': False}, progress)
                     
                     # Retry with error feedback
                     messages.append({"role": "assistant", "content": full_response})
                     messages.append({"role": "user", "content": retry_prompt})
                     
                     # Get retry response (no streaming)
-                    retry_response_obj = await client.chat.completions.create(
-                        model=model,
-                        messages=messages,
-                        temperature=0.7,
-                    )
+                    with progress.stage("retry_llm_call"):
+                        retry_response_obj = await client.chat.completions.create(
+                            model=model,
+                            messages=messages,
+                            temperature=0.7,
+                            **cache,
+                        )
+                    observe_llm_usage("csv_analysis", "retry_llm_call", retry_response_obj.usage)
                     
                     retry_response = retry_response_obj.choices[0].message.content
                     
@@ -308,12 +815,13 @@ async def stream_csv_analysis_response(conversation_id: int, user_message: str,
                     if retry_text:
                         for i in range(0, len(retry_text), 50):
                             chunk = retry_text[i:i+50]
-                            yield f"data: {json.dumps({'content': chunk, 'done': False})}\n\n"
+                            yield sse_event({'content': chunk, 'done': False}, progress)
                     
                     # Execute retry code
                     if retry_code_blocks:
+                        progress.pending_executions += len(retry_code_blocks)
                         for retry_code in retry_code_blocks:
-                            retry_result = executor.execute_code(retry_code)
+                            retry_result = await run_code(conversation_id, executor, retry_code, progress)
                             
                             # Collect retry execution output
                             if retry_result['success'] and retry_result['stdout']:
@@ -322,10 +830,10 @@ async def stream_csv_analysis_response(conversation_id: int, user_message: str,
                             # Only show stdout (not the code)
                             if retry_result['success'] and retry_result['stdout']:
                                 output_msg = f"\n\n{retry_result['stdout']}\n"
-                                yield f"data: {json.dumps({'content': output_msg, 'done': False})}\n\n"
+                                yield sse_event({'content': output_msg, 'done': False}, progress)
                             elif not retry_result['success']:
                                 error_msg = f"\n\n❌ **Error during execution:**\n```\n{retry_result['error']}\n```\n"
-                                yield f"data: {json.dumps({'content': error_msg, 'done': False})}\n\n"
+                                yield sse_event({'content': error_msg, 'done': False}, progress)
                             
                             if retry_result['plots']:
                                 all_plots.extend(retry_result['plots'])  # Collect retry plots
@@ -335,17 +843,19 @@ async def stream_csv_analysis_response(conversation_id: int, user_message: str,
                                         'data': plot_base64,
                                         'done': False
                                     }
-                                    yield f"data: {json.dumps(plot_data)}\n\n"
+                                    yield sse_event(plot_data, progress)
                     
                     full_response = retry_response
         
         # If we have execution results but no plots, request a follow-up interpretation
         if execution_results and not all_plots:
-            # Create follow-up prompt with execution results
+            # Create follow-up prompt with execution results, summarized to fit the budget
+            budget = INTERPRETATION_OUTPUT_CHARS // len(execution_results)
+            execution_output = "\n".join(summarize_output(output, budget) for output in execution_results)
             follow_up_prompt = f"""Based on the execution results above, please provide a clear interpretation and answer to the user's question.
 
 Execution Output:
-{chr(10).join(execution_results)}
+{execution_output}
 
 Please provide a concise, direct answer that interprets these results in the context of the user's original question: "{user_message}"
 Do not write any more code. Just interpret and explain the results."""
@@ -354,65 +864,131 @@ Do not write any more code. Just interpret and explain the results."""
             messages.append({"role": "system", "content": follow_up_prompt})
             
             # Get interpretation response (stream it)
-            interpretation_stream = await client.chat.completions.create(
-                model=model,
-                messages=messages,
-                temperature=0.7,
-                stream=True,
-            )
-            
-            # Add separator before interpretation
-            yield f"data: {json.dumps({'content': '\\n\\n', 'done': False})}\n\n"
-            
-            interpretation_text = ""
-            async for chunk in interpretation_stream:
-                if chunk.choices[0].delta.content:
-                    content = chunk.choices[0].delta.content
-                    interpretation_text += content
-                    yield f"data: {json.dumps({'content': content, 'done': False})}\n\n"
+            with progress.stage("interpretation_stream"):
+                interpretation_stream = await client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    temperature=0.7,
+                    stream=True,
+                    **STREAM_OPTIONS,
+                    **cache,
+                )
+                progress.llm_stream = interpretation_stream
+                
+                # Add separator before interpretation
+                yield sse_event({'content': '\n\n', 'done': False}, progress)
+                
+                interpretation_text = ""
+                async for chunk in interpretation_stream:
+                    if chunk.usage is not None:
+                        observe_llm_usage("csv_analysis", "interpretation_stream", chunk.usage)
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        content = chunk.choices[0].delta.content
+                        interpretation_text += content
+                        yield sse_event({'content': content, 'done': False}, progress)
+                progress.llm_stream = None
             
             # Update full_response to include the interpretation
             full_response = f"{full_response}\n\n{interpretation_text}"
         
-        # Save assistant response with plots
-        await save_message(conversation_id, "assistant", full_response, plots=all_plots if all_plots else None)
+        # Save assistant response with plots; the answer is complete, so save it even if the client leaves meanwhile
+        progress.finished = True
+        with progress.stage("save_assistant_message"):
+            await save_message(conversation_id, "assistant", full_response, plots=all_plots if all_plots else None)
         
-        yield f"data: {json.dumps({'content': '', 'done': True})}\n\n"
+        yield sse_event({'content': '', 'done': True}, progress)
         
+    except (asyncio.CancelledError, GeneratorExit):
+        if not progress.finished:
+            outcome = "disconnected"
+            abandon_turn(progress, conversation_id)
+        raise
     except Exception as e:
+        outcome = "error"
         error_message = f"Error: {str(e)}"
-        yield f"data: {json.dumps({'error': error_message, 'done': True})}\n\n"
+        yield sse_event({'error': error_message, 'done': True})
+    finally:
+        for task in progress.executions:
+            task.cancel()  # Blocks still queued or running when the turn ends early
+        TURN_LATENCY.labels("csv_analysis", outcome).observe(time.perf_counter() - turn_start)
 
 @app.post("/api/csv-analysis/stream")
-async def csv_analysis_stream(request: CSVAnalysisRequest):
+async def csv_analysis_stream(request: CSVAnalysisRequest, http_request: Request, last_event_id: Optional[str] = Header(None)):
     """Stream CSV data analysis responses with code execution"""
+    forwarded = await route_to_turn_node(last_event_id, http_request, request.model_dump())
+    if forwarded is not None:
+        return forwarded
+    resumed = turns.resume(last_event_id, request.conversation_id)
+    if resumed:
+        return turn_response(*resumed)
+    
+    # The conversation's DataFrames live on one node
+    forwarded = await route_to_conversation_owner(request.conversation_id, http_request, request.model_dump())
+    if forwarded is not None:
+        return forwarded
+    
     model = request.model or MODEL
     
     if not OPENAI_API_KEY:
         raise HTTPException(status_code=500, detail="OpenAI API key not configured")
     
-    return StreamingResponse(
-        stream_csv_analysis_response(request.conversation_id, request.message, request.csv_path, model),
-        media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-        }
+    if cluster is not None:
+        refs = request.dataset_refs()
+        previous = await cluster.claim(request.conversation_id, refs[0].csv_path if refs else None)
+        if previous is not None and previous["node_id"] != cluster.node_id:
+            CLUSTER_REHYDRATIONS.inc()  # The CSV is reloaded by the turn's first stage
+    
+    turn = turns.start(
+        request.conversation_id,
+        stream_csv_analysis_response(request.conversation_id, request.message, request.dataset_refs(), model),
     )
+    return turn_response(turn)
+
+@app.get("/api/turns/{turn_id}/events")
+async def resume_turn(turn_id: str, http_request: Request, last_event_id: Optional[str] = Header(None)):
+    """Resume a turn's event stream (EventSource-style GET with Last-Event-ID)"""
+    forwarded = await route_to_turn_node(turn_id, http_request)
+    if forwarded is not None:
+        return forwarded
+    if last_event_id:
+        resumed = turns.resume(last_event_id)
+        if resumed and resumed[0].id == turn_id:
+            return turn_response(*resumed)
+    else:
+        turn = turns.get(turn_id)
+        if turn is not None:
+            return turn_response(turn)  # Replay from the start
+    raise HTTPException(status_code=404, detail="Turn not found or expired")
 
 @app.post("/api/csv-analysis/clear/{conversation_id}")
-async def clear_csv_analysis(conversation_id: int):
+async def clear_csv_analysis(conversation_id: int, http_request: Request):
     """Clear CSV analysis data for a conversation"""
+    forwarded = await route_to_conversation_owner(conversation_id, http_request)
+    if forwarded is not None:
+        return forwarded
+    if cluster is not None:
+        await cluster.release(conversation_id)
     if conversation_id in code_executors:
         code_executors[conversation_id].clear()
         del code_executors[conversation_id]
+    # Queued behind any pending write of this conversation
+    await asyncio.wrap_future(snapshot_pool.submit(delete_snapshot, conversation_id))
     return {"message": "CSV analysis data cleared"}
 
 @app.get("/api/csv-analysis/dataframes/{conversation_id}")
-async def list_dataframes(conversation_id: int):
+async def list_dataframes(conversation_id: int, http_request: Request):
     """List loaded dataframes for a conversation"""
+    forwarded = await route_to_conversation_owner(conversation_id, http_request)
+    if forwarded is not None:
+        return forwarded
+    if cluster is not None and conversation_id not in code_executors:
+        await rehydrate_executor(conversation_id)
+    if conversation_id not in code_executors:
+        names = snapshot_frame_names(conversation_id)
+        if names:
+            return {"dataframes": names}  # Evicted to disk, restored on the next analysis request
     executor = get_code_executor(conversation_id)
-    return {"dataframes": executor.list_dataframes()}
+    return {"dataframes": executor.list_dataframes(), "datasets": list(executor.datasets)}
 
 if __name__ == "__main__":
     import uvicorn
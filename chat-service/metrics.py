@@ -0,0 +1,142 @@
+"""
+Prometheus metrics and per-stage latency spans for the chat service
+"""
+
+from typing import Callable, Dict
+
+from app_shared.tracing import stage_timer
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+# Buckets span sub-millisecond storage round trips up to multi-minute analyses
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+STAGE_LATENCY = Histogram(
+    "chat_stage_duration_seconds",
+    "Time spent in each stage of a chat turn",
+    ["handler", "stage"],
+    buckets=STAGE_BUCKETS,
+)
+
+TURN_LATENCY = Histogram(
+    "chat_turn_duration_seconds",
+    "End-to-end duration of a streamed chat turn",
+    ["handler", "outcome"],
+    buckets=STAGE_BUCKETS,
+)
+
+EXECUTORS_ACTIVE = Gauge(
+    "chat_executors_active",
+    "Number of conversations holding a CodeExecutor in memory",
+)
+
+EXECUTOR_DATAFRAME_BYTES = Gauge(
+    "chat_executor_dataframe_bytes",
+    "Shallow memory footprint of all DataFrames held by executors",
+)
+
+EXECUTOR_INFLIGHT = Gauge(
+    "chat_executor_inflight",
+    "Code executions queued or running",
+)
+
+EXECUTOR_EVICTIONS = Counter(
+    "chat_executor_evictions_total",
+    "Idle executors dropped from memory beyond MAX_RESIDENT_EXECUTORS (restorable from their snapshot)",
+)
+
+CLIENT_DISCONNECTS = Counter(
+    "chat_client_disconnects_total",
+    "Streamed turns abandoned by the client (no reconnect within the grace period), by stage",
+    ["handler", "stage"],
+)
+
+# Upstream work that was not done (or was cut short) because the client had gone
+WORK_SAVED = Counter(
+    "chat_work_saved_total",
+    "Units of upstream work skipped after a client disconnect",
+    ["handler", "kind"],  # kind: llm_calls_aborted, executions_cancelled, executions_skipped
+)
+
+TURNS_ACTIVE = Gauge(
+    "chat_turns_active",
+    "Streamed turns still producing output, with or without a connected client",
+)
+
+SSE_RESUMES = Counter(
+    "chat_sse_resumes_total",
+    "Reconnects carrying a Last-Event-ID, by whether the turn could be resumed",
+    ["outcome"],  # resumed, expired
+)
+
+PERSIST_PENDING = Gauge(
+    "chat_persist_pending",
+    "Message writes queued for storage-service",
+)
+
+PERSIST_FAILURES = Counter(
+    "chat_persist_failures_total",
+    "Message writes dropped after exhausting retries",
+)
+
+CLUSTER_NODES = Gauge(
+    "chat_cluster_nodes",
+    "Live chat-service nodes as seen by this node (CLUSTER_MODE)",
+)
+
+CLUSTER_FORWARDS = Counter(
+    "chat_cluster_forwards_total",
+    "Requests proxied to the node owning the conversation or turn",
+    ["outcome"],  # forwarded, owner_unreachable
+)
+
+CLUSTER_REHYDRATIONS = Counter(
+    "chat_cluster_rehydrations_total",
+    "Conversations taken over from a node that left or died, reloaded from their CSV source",
+)
+
+FAST_PATH_TURNS = Counter(
+    "chat_fast_path_turns_total",
+    "CSV analysis questions matched by the LLM-free intent router",
+    ["intent", "outcome"],  # answered, fallback (template failed, the LLM answers instead)
+)
+
+LLM_PROMPT_TOKENS = Counter(
+    "chat_llm_prompt_tokens_total",
+    "Prompt tokens sent to the model, as reported in the API usage",
+    ["handler", "call"],
+)
+
+LLM_CACHED_PROMPT_TOKENS = Counter(
+    "chat_llm_cached_prompt_tokens_total",
+    "Prompt tokens the provider served from its prompt cache (usage.prompt_tokens_details.cached_tokens)",
+    ["handler", "call"],
+)
+
+CONTENT_TYPE = CONTENT_TYPE_LATEST
+
+stage = stage_timer(STAGE_LATENCY, "chat-service")  # with stage(handler, name): ...
+
+
+def observe_stage(handler: str, name: str, seconds: float):
+    """Record a stage duration measured elsewhere (e.g. inside the executor)"""
+    STAGE_LATENCY.labels(handler, name).observe(seconds)
+
+
+def observe_llm_usage(handler: str, call: str, usage) -> None:
+    """Count prompt and cache-hit tokens from a completion's usage (absent on some providers)"""
+    if usage is None:
+        return
+    LLM_PROMPT_TOKENS.labels(handler, call).inc(getattr(usage, "prompt_tokens", None) or 0)
+    details = getattr(usage, "prompt_tokens_details", None)
+    LLM_CACHED_PROMPT_TOKENS.labels(handler, call).inc(getattr(details, "cached_tokens", None) or 0)
+
+
+def register_executor_collectors(executors: Dict, dataframe_bytes: Callable[[], float]):
+    """Wire executor gauges to live state; evaluated lazily at scrape time"""
+    EXECUTORS_ACTIVE.set_function(lambda: len(executors))
+    EXECUTOR_DATAFRAME_BYTES.set_function(dataframe_bytes)
+
+
+def render_latest() -> bytes:
+    """Render all metrics in the Prometheus text exposition format"""
+    return generate_latest()
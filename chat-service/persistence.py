@@ -0,0 +1,85 @@
+"""
+Ordered background persistence of chat messages
+
+Messages are queued per conversation and written to storage-service by one
+worker per conversation, so a turn never waits on a write it does not need the
+result of, yet the user message is always stored before the assistant's
+answer. Failed writes are retried with backoff, and drain() lets shutdown
+flush whatever is still queued. Every submitted write is resolved, with None
+if it could not be stored, even if the worker stops on an unexpected error or
+is cancelled.
+"""
+
+import asyncio
+import logging
+import os
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Optional, Tuple
+
+import httpx
+
+from metrics import PERSIST_FAILURES, PERSIST_PENDING
+
+PERSIST_ATTEMPTS = int(os.getenv("PERSIST_ATTEMPTS", "3"))
+PERSIST_BACKOFF_SECONDS = float(os.getenv("PERSIST_BACKOFF_SECONDS", "0.5"))
+
+logger = logging.getLogger(__name__)
+
+
+class PersistenceQueue:
+    """Per-conversation FIFO of writes, each resolved with the stored record (or None)"""
+
+    def __init__(self, deliver: Callable[[int, dict], Awaitable[dict]]):
+        self._deliver = deliver
+        self._queues: Dict[int, Deque[Tuple[dict, asyncio.Future]]] = {}
+        self._workers: Dict[int, asyncio.Task] = {}
+        PERSIST_PENDING.set_function(lambda: sum(len(q) for q in list(self._queues.values())))
+
+    def submit(self, conversation_id: int, payload: dict) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(conversation_id, deque()).append((payload, future))
+        if conversation_id not in self._workers:
+            self._workers[conversation_id] = asyncio.create_task(self._run(conversation_id))
+        return future
+
+    async def _run(self, conversation_id: int):
+        queue = self._queues[conversation_id]
+        try:
+            while queue:
+                payload, future = queue[0]
+                result = await self._write(conversation_id, payload)
+                queue.popleft()
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            del self._workers[conversation_id]
+            # Only left non-empty by an unexpected error or cancellation: nobody would resolve them
+            while queue:
+                _, future = queue.popleft()
+                if not future.done():
+                    future.set_result(None)
+            del self._queues[conversation_id]
+
+    async def _write(self, conversation_id: int, payload: dict) -> Optional[dict]:
+        for attempt in range(PERSIST_ATTEMPTS):
+            try:
+                return await self._deliver(conversation_id, payload)
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code < 500:
+                    break  # e.g. the conversation was deleted; retrying will not help
+            except httpx.HTTPError:
+                pass
+            except Exception:  # e.g. an unreadable response body: retrying will not help
+                logger.exception("Unexpected error writing a message for conversation %s", conversation_id)
+                break
+            if attempt + 1 < PERSIST_ATTEMPTS:
+                await asyncio.sleep(PERSIST_BACKOFF_SECONDS * 2 ** attempt)
+        PERSIST_FAILURES.inc()
+        logger.warning("Dropping %s message for conversation %s after failed writes", payload.get("role"), conversation_id)
+        return None
+
+    async def drain(self, timeout: float):
+        """Wait for queued writes to finish (used at shutdown)"""
+        workers = list(self._workers.values())
+        if workers:
+            await asyncio.wait(workers, timeout=timeout)
@@ -0,0 +1,49 @@
+"""
+Prompt assembly for CSV analysis turns, ordered for provider prompt caching
+
+Providers cache prompts by exact prefix: a request that starts with the same
+bytes as a recent one (OpenAI: 1024+ tokens) is billed and served from cache
+up to the first differing byte. Messages are therefore ordered from the most
+stable to the most volatile:
+
+  1. the data analysis system prompt (fixed)
+  2. dataset profiles (fixed once a dataset is registered, see
+     CodeExecutor.dataset_profiles; adding a dataset changes them once)
+  3. the conversation history (append-only)
+  4. session state - which frames are loaded right now (changes as code runs)
+  5. the current user message
+  6. per-turn additions: retry prompts and the interpretation request
+
+so turn N+1 reuses everything turn N sent up to its own session state.
+Nothing before the history may contain timestamps, ids, timings or other
+per-turn values.
+"""
+
+import os
+from typing import List, Optional
+
+# OpenAI's prompt_cache_key routes requests with the same key to the same cache;
+# leave off for OpenAI-compatible servers that reject unknown parameters
+PROMPT_CACHE_KEY = os.getenv("PROMPT_CACHE_KEY", "0") == "1"
+
+
+def build_analysis_messages(system_prompt: str, profiles: Optional[str], history: List[dict], session_state: str) -> List[dict]:
+    """Messages of a CSV analysis turn; history ends with the current user message"""
+    messages = [{"role": "system", "content": system_prompt}]
+    if profiles:
+        messages.append({
+            "role": "system",
+            "content": f"The user has loaded these datasets, each available to your code as a DataFrame of the same name:\n\n{profiles}"
+        })
+    messages.extend(history[:-1])
+    if session_state:
+        messages.append({"role": "system", "content": f"Current session state:\n{session_state}"})
+    messages.extend(history[-1:])
+    return messages
+
+
+def cache_options(handler: str, conversation_id: int) -> dict:
+    """Extra create() arguments that pin a conversation's requests to one prompt cache"""
+    if not PROMPT_CACHE_KEY:
+        return {}
+    return {"extra_body": {"prompt_cache_key": f"{handler}-{conversation_id}"}}
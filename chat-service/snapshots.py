@@ -0,0 +1,220 @@
+"""
+Spill-to-disk snapshots of executor state
+
+After a CSV load or an execution that saves frames, the changed DataFrames of
+a conversation are written in the background to SNAPSHOT_DIR/<conversation>/
+as uncompressed Arrow IPC (Feather v2) files, plus a manifest. An executor
+that was evicted from memory, or lost in a restart, is restored on its next
+request by memory-mapping those files instead of re-parsing the CSV.
+
+A snapshot may be the only copy of an evicted executor's frames, so an
+executor is only evicted once its snapshot holds every one of its frames, and
+the disk budget only deletes snapshots of executors still in memory.
+
+Needs pyarrow (`pip install "chat-service[snapshots]"`); without it executors
+stay in memory only, as before.
+"""
+
+import importlib.util
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Collection, Dict, List, Optional, Tuple
+
+from metrics import stage
+
+SNAPSHOTS = os.getenv("SNAPSHOTS", "1") == "1"
+SNAPSHOT_DIR = Path(os.getenv("SNAPSHOT_DIR", os.path.join(tempfile.gettempdir(), "chat-service-snapshots")))
+# Least recently used conversations are deleted beyond this much disk
+SNAPSHOT_MAX_BYTES = int(os.getenv("SNAPSHOT_MAX_BYTES", str(20 * 1024 ** 3)))
+
+MANIFEST = "manifest.json"
+_FRAME_NAME_RE = re.compile(r"^\w+$")
+
+logger = logging.getLogger(__name__)
+
+# Serializes evictions with the disk budget, so a snapshot is never deleted
+# while the executor it belongs to is being dropped from memory
+_eviction_lock = threading.Lock()
+_over_budget = False
+
+
+def snapshots_available() -> bool:
+    """Whether snapshots are enabled and pyarrow is installed (checked without importing it)"""
+    return SNAPSHOTS and importlib.util.find_spec("pyarrow") is not None
+
+
+def _conversation_dir(conversation_id: int) -> Path:
+    return SNAPSHOT_DIR / str(conversation_id)
+
+
+def frame_path(conversation_id: int, name: str) -> str:
+    """Snapshot file of one frame (execution workers memory-map it)"""
+    return str(_conversation_dir(conversation_id) / f"{name}.arrow")
+
+
+def _read_manifest(directory: Path) -> Optional[dict]:
+    try:
+        with open(directory / MANIFEST) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _replace_atomically(path: Path, write):
+    temp_path = path.with_name(path.name + ".tmp")
+    try:
+        write(temp_path)
+        os.replace(temp_path, path)
+    finally:
+        temp_path.unlink(missing_ok=True)
+
+
+def write_snapshot(conversation_id: int, frames: Dict, datasets: Dict[str, str], df_count: int) -> List[str]:
+    """
+    Write changed frames, then the manifest that makes them visible; returns the names written
+
+    Frames Arrow cannot represent (e.g. mixed-type object columns) are left
+    out, and nothing is written if the disk fails; the caller keeps those
+    frames marked as changed, which also keeps their executor in memory.
+    """
+    directory = _conversation_dir(conversation_id)
+    try:
+        directory.mkdir(parents=True, exist_ok=True)
+        return _write_frames(conversation_id, directory, frames, datasets, df_count)
+    except OSError as e:  # e.g. disk full: the executor simply stays memory-only
+        logger.warning("Snapshot of conversation %s failed: %s", conversation_id, e)
+        return []
+
+
+def _write_frames(conversation_id: int, directory: Path, frames: Dict, datasets: Dict[str, str], df_count: int) -> List[str]:
+    import pyarrow as pa
+    from pyarrow import feather
+
+    manifest = _read_manifest(directory) or {"frames": {}}
+    written = []
+    with stage("snapshot", "write"):
+        for name, df in frames.items():
+            if not _FRAME_NAME_RE.match(name):
+                continue
+            try:
+                table = pa.Table.from_pandas(df, preserve_index=True)
+            except (pa.ArrowException, TypeError, ValueError) as e:
+                logger.info("Not snapshotting frame %s of conversation %s: %s", name, conversation_id, e)
+                manifest["frames"].pop(name, None)  # The file on disk is an older version
+                continue
+            path = Path(frame_path(conversation_id, name))
+            # Uncompressed and in one record batch, so each column of the restore is a
+            # single view of the mapping (pyarrow copies columns split across batches)
+            _replace_atomically(path, lambda temp: feather.write_feather(
+                table, temp, compression="uncompressed", chunksize=max(1, table.num_rows)
+            ))
+            manifest["frames"][name] = {"rows": len(df), "bytes": path.stat().st_size}
+            written.append(name)
+        manifest.update({"datasets": datasets, "df_count": df_count, "written_at": time.time()})
+        _replace_atomically(directory / MANIFEST, lambda temp: temp.write_text(json.dumps(manifest)))
+    return written
+
+
+def read_snapshot(conversation_id: int) -> Optional[Tuple[Dict, Dict[str, str], int]]:
+    """(frames, datasets, df_count) of a conversation's snapshot, or None if it has none"""
+    directory = _conversation_dir(conversation_id)
+    manifest = _read_manifest(directory)
+    if not manifest or not manifest["frames"] or not snapshots_available():
+        return None
+    from pyarrow import feather
+
+    frames = {}
+    with stage("snapshot", "restore"):
+        for name in manifest["frames"]:
+            try:
+                table = feather.read_table(frame_path(conversation_id, name), memory_map=True)
+            except OSError as e:
+                logger.warning("Snapshot frame %s of conversation %s is unreadable: %s", name, conversation_id, e)
+                continue
+            # Numeric columns stay zero-copy views of the read-only mapping (page cache,
+            # not process memory). Nothing writes to an executor's frames in place:
+            # executions get their own copies and saved results replace the entry.
+            frames[name] = table.to_pandas(split_blocks=True, self_destruct=True)
+    try:
+        os.utime(directory / MANIFEST)  # Recently used: last to be deleted by the disk budget
+    except OSError:
+        pass
+    return frames, manifest.get("datasets", {}), manifest.get("df_count", len(frames))
+
+
+def snapshot_frame_names(conversation_id: int) -> List[str]:
+    manifest = _read_manifest(_conversation_dir(conversation_id))
+    return list(manifest["frames"]) if manifest else []
+
+
+def delete_snapshot(conversation_id: int):
+    shutil.rmtree(_conversation_dir(conversation_id), ignore_errors=True)
+
+
+def evict_to_snapshot(conversation_id: int, frame_names: Collection[str], evict: Callable[[], None]) -> bool:
+    """
+    Call evict() if the conversation's snapshot holds all of frame_names (or it has none)
+
+    Refused while evicted conversations' snapshots alone exceed SNAPSHOT_MAX_BYTES:
+    their executors then stay in memory rather than grow the disk further.
+    """
+    with _eviction_lock:
+        if frame_names:
+            manifest = _read_manifest(_conversation_dir(conversation_id))
+            if _over_budget or manifest is None or not set(frame_names) <= manifest["frames"].keys():
+                return False
+        evict()
+        return True
+
+
+def enforce_disk_budget(is_resident: Callable[[int], bool]):
+    """
+    Delete least recently used snapshots while the total exceeds SNAPSHOT_MAX_BYTES
+
+    Only snapshots of executors still in memory are deleted, which keeps those
+    executors in memory; a snapshot of an evicted executor, or one left by an
+    earlier run, may be the only copy and is kept.
+    """
+    global _over_budget
+    snapshots = []
+    total = 0
+    for directory in SNAPSHOT_DIR.iterdir():
+        if directory.suffix == ".deleting":  # Left by an interrupted deletion
+            shutil.rmtree(directory, ignore_errors=True)
+            continue
+        try:
+            size = sum(f.stat().st_size for f in directory.iterdir())
+            last_used = (directory / MANIFEST).stat().st_mtime
+        except OSError:
+            continue  # Being written or deleted
+        snapshots.append((last_used, size, directory))
+        total += size
+    for _, size, directory in sorted(snapshots):
+        if total <= SNAPSHOT_MAX_BYTES:
+            break
+        with _eviction_lock:
+            if not directory.name.isdigit() or not is_resident(int(directory.name)):
+                continue
+            # Out of the manifest's place first, so no eviction can rely on it from here on
+            doomed = directory.with_name(directory.name + ".deleting")
+            try:
+                directory.rename(doomed)
+            except OSError:
+                continue
+        shutil.rmtree(doomed, ignore_errors=True)
+        total -= size
+    if (total > SNAPSHOT_MAX_BYTES) != _over_budget:
+        _over_budget = total > SNAPSHOT_MAX_BYTES
+        if _over_budget:
+            logger.warning(
+                "Snapshots of evicted executors use %d MiB, over SNAPSHOT_MAX_BYTES; "
+                "idle executors stay in memory meanwhile",
+                total // 1024 ** 2,
+            )
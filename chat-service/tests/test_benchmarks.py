@@ -0,0 +1,63 @@
+"""
+Benchmark harness: every hot-path case runs, and the baseline gate flags regressions (not new cases)
+
+Run from chat-service/: python -m pytest tests
+"""
+
+import importlib.util
+import json
+import os
+import sys
+
+import pytest
+
+# The benchmark imports main; same settings as the other tests that do
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("EXECUTOR_PREWARM", "0")
+os.environ.setdefault("SNAPSHOTS", "0")
+os.environ.setdefault("EXECUTION_WORKERS", "4")
+
+BENCHMARK = os.path.join(os.path.dirname(__file__), "..", "benchmarks", "bench_hot_paths.py")
+
+spec = importlib.util.spec_from_file_location("bench_hot_paths", BENCHMARK)
+bench = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(bench)
+
+
+def test_every_case_runs(monkeypatch, tmp_path):
+    monkeypatch.setattr(bench.snapshots, "SNAPSHOT_DIR", tmp_path)  # The suite points it at its temp directory
+    results = bench.run_suite([200], repeat=1, only="")
+    expected = {"parse/separate_text_and_code", "load_csv/200_rows", "execute/noop", "execute/plot", "sse/plot_frame"}
+    assert expected <= set(results)
+    assert all(result["min"] > 0 and result["calls"] >= 1 for result in results.values())
+
+
+def test_compare_flags_only_slowdowns_over_the_threshold():
+    baseline = {"results": {"fast": {"min": 1.0}, "slow": {"min": 1.0}}}
+    results = {"fast": {"min": 1.1}, "slow": {"min": 1.5}, "added": {"min": 9.0}}
+    assert bench.compare(results, baseline, threshold=0.2) == ["slow"]
+
+
+def test_saved_baseline_gates_the_next_run(monkeypatch, tmp_path, capsys):
+    baseline = tmp_path / "hot_paths.json"
+
+    def cli(*args):
+        monkeypatch.setattr(sys, "argv", ["bench_hot_paths.py", "--filter", "parse/", "--sizes", "200", "--repeat", "1",
+                                          "--baseline", str(baseline), *args])
+        bench.main_cli()
+
+    cli("--save-baseline")
+    saved = json.loads(baseline.read_text())
+    assert set(saved["results"]) == {"parse/separate_text_and_code", "parse/extract_python_code"}
+    assert saved["environment"]["isolation"] == bench.EXECUTOR_ISOLATION
+
+    cli("--compare", "--threshold", "100")
+    assert "No regressions" in capsys.readouterr().out
+
+    for result in saved["results"].values():
+        result["min"] /= 1000  # A baseline far faster than this machine
+    baseline.write_text(json.dumps(saved))
+    with pytest.raises(SystemExit) as exit_info:
+        cli("--compare")
+    assert exit_info.value.code == 1
+    assert "2 regression(s)" in capsys.readouterr().out
@@ -0,0 +1,102 @@
+"""
+Conversation-affine routing: hash-ring placement, sticky owners, failover when a node stops heartbeating
+
+Run from chat-service/: python -m pytest tests
+"""
+
+import asyncio
+import os
+import sys
+from collections import Counter
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from cluster import Cluster, HashRing, LocalRegistry  # noqa: E402
+
+KEYS = range(10_000)
+
+
+@pytest.fixture
+def registry_path(tmp_path):
+    return str(tmp_path / "cluster.db")
+
+
+def test_ring_spreads_keys_and_a_new_node_only_takes_its_share():
+    three = HashRing(["a", "b", "c"])
+    four = HashRing(["a", "b", "c", "d"])
+    shares = Counter(three.node_for(key) for key in KEYS)
+    assert all(2_800 < count < 3_900 for count in shares.values())
+    moved = [key for key in KEYS if three.node_for(key) != four.node_for(key)]
+    assert all(four.node_for(key) == "d" for key in moved)
+    assert 1_800 < len(moved) < 3_200  # About a quarter
+    assert HashRing(["c", "a", "b"]).node_for(42) == three.node_for(42)
+    assert HashRing([]).node_for(42) is None
+
+
+def test_placed_conversation_stays_on_its_node_and_fails_over_when_it_dies(registry_path):
+    async def run():
+        a = Cluster(LocalRegistry(registry_path), "node-a", "http://a")
+        b = Cluster(LocalRegistry(registry_path), "node-b", "http://b")
+        await a.start()
+        await b.start()
+        assert await a.is_live("node-b")  # Refreshes a's view, which now has b
+        try:
+            # A conversation the ring gives to b, but first used on a, stays on a
+            conversation_id = next(key for key in KEYS if b._ring.node_for(key) == "node-b")
+            assert await a.owner(conversation_id) == "node-b"
+            assert await a.claim(conversation_id, "/data/sales.csv") is None
+            assert await a.owner(conversation_id) == await b.owner(conversation_id) == "node-a"
+
+            # a stops heartbeating: b stops routing to it and takes the conversation over
+            a.registry._execute("UPDATE nodes SET last_seen = 0 WHERE node_id = 'node-a'")
+            assert not await b.is_live("node-a")
+            assert await b.owner(conversation_id) == "node-b"
+            previous = await b.claim(conversation_id, "/data/sales.csv")
+            assert previous == {"node_id": "node-a", "csv_path": "/data/sales.csv"}  # What to rehydrate from
+            assert await b.owner(conversation_id) == "node-b"
+        finally:
+            await b.stop()
+            await a.stop()
+
+    asyncio.run(run())
+
+
+def test_refused_connection_does_not_take_a_live_node_out(registry_path):
+    class Unreachable(LocalRegistry):
+        def live_nodes(self):
+            raise OSError("registry down")
+
+    async def run():
+        a = Cluster(LocalRegistry(registry_path), "node-a", "http://a")
+        await a.start()
+        b = Cluster(LocalRegistry(registry_path), "node-b", "http://b")
+        await b.start()
+        try:
+            assert await b.is_live("node-a")  # Still heartbeating
+            b.registry.__class__ = Unreachable
+            assert await b.is_live("node-a")  # Cannot tell: keep routing to it
+        finally:
+            b.registry.__class__ = LocalRegistry
+            await b.stop()
+            await a.stop()
+
+    asyncio.run(run())
+
+
+def test_stopped_node_leaves_at_once_and_its_conversations_are_re_placed(registry_path):
+    async def run():
+        a = Cluster(LocalRegistry(registry_path), "node-a", "http://a")
+        b = Cluster(LocalRegistry(registry_path), "node-b", "http://b")
+        await a.start()
+        await b.start()
+        await a.claim(7, None)
+        await a.stop()  # Waits for its heartbeat loop before closing the registry
+        try:
+            assert not await b.is_live("node-a")
+            assert await b.owner(7) == "node-b"
+        finally:
+            await b.stop()
+
+    asyncio.run(run())
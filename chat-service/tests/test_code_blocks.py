@@ -0,0 +1,53 @@
+"""
+A response's code blocks (schedule_code_blocks): concurrent and independent
+
+Run from chat-service/: python -m pytest tests
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("EXECUTOR_PREWARM", "0")
+os.environ.setdefault("SNAPSHOTS", "0")
+os.environ.setdefault("EXECUTION_WORKERS", "4")  # The default is one per CPU
+
+import pandas as pd  # noqa: E402
+
+import main  # noqa: E402
+from code_executor import CodeExecutor  # noqa: E402
+
+APPEND_ONE = "df = pd.concat([df, pd.DataFrame({'a': [len(df)]})], ignore_index=True)"
+
+
+def run_blocks(blocks):
+    executor = CodeExecutor()
+    executor.dataframes["df"] = pd.DataFrame({"a": [0]})
+
+    async def run():
+        progress = main.TurnProgress("csv_analysis")
+        progress.pending_executions = len(blocks)
+        return await asyncio.gather(*main.schedule_code_blocks(1, executor, blocks, progress))
+
+    try:
+        return asyncio.run(run()), executor
+    finally:
+        executor.close()
+
+
+def test_changes_and_variables_stay_in_their_block():
+    results, executor = run_blocks([APPEND_ONE, "x = 1\ndf['a'] += 1", "assert df['a'].tolist() == [0]\nx"])
+    assert results[0]["success"] and results[1]["success"]
+    assert "NameError" in results[2]["error"]  # Sees the original df, but not x
+    assert executor.dataframes["df"]["a"].tolist() == [0]
+
+
+def test_blocks_run_concurrently():
+    run_blocks(["pass"])  # Warm-up
+    start = time.perf_counter()
+    results, _ = run_blocks(["import time\ntime.sleep(0.5)"] * 3)
+    assert all(r["success"] for r in results)
+    assert time.perf_counter() - start < 1.2
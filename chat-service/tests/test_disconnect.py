@@ -0,0 +1,127 @@
+"""
+Client disconnects: a turn left without a reader past the grace period closes its LLM stream
+and keeps what was streamed; a reader returning in time keeps it going
+
+Run from chat-service/: python -m pytest tests
+"""
+
+import asyncio
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("EXECUTOR_PREWARM", "0")
+os.environ.setdefault("SNAPSHOTS", "0")
+
+import main  # noqa: E402
+import turns  # noqa: E402
+from persistence import PersistenceQueue  # noqa: E402
+from turns import TurnRegistry  # noqa: E402
+
+
+def chunk(content: str):
+    return SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=SimpleNamespace(content=content))])
+
+
+class FakeStream:
+    """An LLM stream that sends its chunks, then stalls until finish() or close()"""
+
+    def __init__(self, contents):
+        self.contents = contents
+        self.closed = False
+        self.release = asyncio.Event()
+
+    def __aiter__(self):
+        return self._chunks()
+
+    async def _chunks(self):
+        for content in self.contents:
+            yield chunk(content)
+        await self.release.wait()
+
+    def finish(self):
+        self.release.set()
+
+    async def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def chat(monkeypatch):
+    """Patch in a fake LLM and storage; returns (stream, saved messages)"""
+    saved = []
+    stream = None
+
+    async def create(**kwargs):
+        return stream
+
+    async def deliver(conversation_id, payload):
+        saved.append((conversation_id, payload["role"], payload["content"]))
+        return {"id": len(saved)}
+
+    async def no_history(conversation_id, user_message, progress):
+        return [{"role": "user", "content": user_message["content"]}]
+
+    def start(contents):
+        nonlocal stream
+        stream = FakeStream(contents)
+        monkeypatch.setattr(main, "persistence", PersistenceQueue(deliver))
+        return stream
+
+    monkeypatch.setattr(main, "client", SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create))))
+    monkeypatch.setattr(main, "get_conversation_history", no_history)
+    monkeypatch.setattr(turns, "DISCONNECT_GRACE_SECONDS", 0.1)
+    return start, saved
+
+
+async def read(events, count: int):
+    return [await events.__anext__() for _ in range(count)]
+
+
+def test_abandoned_turn_closes_the_llm_stream_and_saves_the_partial_answer(chat):
+    start, saved = chat
+
+    async def run():
+        stream = start(["Sales ", "rose"])
+        turn = TurnRegistry().start(7, main.stream_chat_response(7, "How did sales do?", "model"))
+        events = turn.events()
+        await read(events, 2)
+        await events.aclose()  # The client goes away
+        await asyncio.wait_for(turn.wait(), timeout=5)
+        await asyncio.sleep(0.05)  # The partial answer's write is queued
+        return stream
+
+    stream = asyncio.run(run())
+    assert stream.closed
+    assert saved == [(7, "assistant", "Sales rose" + main.INTERRUPTED_NOTE)]
+
+
+def test_reconnect_within_the_grace_period_keeps_the_turn_running(chat):
+    start, saved = chat
+
+    async def run():
+        stream = start(["Sales ", "rose"])
+        turn = TurnRegistry().start(7, main.stream_chat_response(7, "How did sales do?", "model"))
+        events = turn.events()
+        await read(events, 2)
+        await events.aclose()
+        await asyncio.sleep(0.02)
+
+        async def reconnect():
+            return [frame async for frame in turn.events(last_seq=1)]
+
+        resumed = asyncio.create_task(reconnect())  # Back before the grace period ends
+        await asyncio.sleep(0.2)
+        stream.finish()
+        rest = await asyncio.wait_for(resumed, timeout=5)
+        await asyncio.sleep(0.05)
+        return stream, turn, rest
+
+    stream, turn, rest = asyncio.run(run())
+    assert not stream.closed and turn.done
+    assert len(rest) == 1 and '"done": true' in rest[0]
+    assert saved == [(7, "assistant", "Sales rose")]
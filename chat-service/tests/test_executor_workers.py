@@ -0,0 +1,102 @@
+"""
+Isolated executions: a fresh worker per execution, standby workers, and recovery from a dead fork server
+
+Run from chat-service/: python -m pytest tests
+"""
+
+import os
+import signal
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("EXECUTOR_PREWARM", "0")
+
+import code_executor  # noqa: E402
+from code_executor import CodeExecutor  # noqa: E402
+
+pytestmark = pytest.mark.skipif(not code_executor._PROCESS_ISOLATION, reason="EXECUTOR_ISOLATION=process only")
+
+
+@pytest.fixture
+def executor():
+    executor = CodeExecutor()
+    yield executor
+    executor.close()
+
+
+def run(executor: CodeExecutor, code: str) -> dict:
+    result = executor.execute_code(code)
+    assert result["success"], result["error"]
+    return result
+
+
+def wait_for_standbys() -> int:
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        with code_executor._standby_lock:
+            count = len(code_executor._standby_workers)
+        if count >= code_executor.EXECUTOR_STANDBY_WORKERS:
+            return count
+        time.sleep(0.05)
+    return count
+
+
+def test_every_execution_gets_a_fresh_worker(executor):
+    first = run(executor, "import builtins, os\nbuiltins.leaked = 1\nprint(os.getpid())")
+    second = run(executor, "import builtins, os\nassert not hasattr(builtins, 'leaked')\nprint(os.getpid())")
+    assert first["stdout"] != second["stdout"]
+    assert int(first["stdout"]) != os.getpid()
+
+
+@pytest.mark.skipif(not code_executor.EXECUTOR_PREFORK, reason="EXECUTOR_PREFORK=0")
+def test_standbys_are_refilled_and_dead_ones_skipped(executor):
+    code_executor.warm_up()
+    assert wait_for_standbys() == code_executor.EXECUTOR_STANDBY_WORKERS
+    with code_executor._standby_lock:
+        standbys = list(code_executor._standby_workers)
+    for worker in standbys:
+        worker.kill()
+    time.sleep(0.2)  # Let their connections report the exit
+
+    result = run(executor, "import os\nprint(os.getpid())")
+    assert int(result["stdout"]) not in {worker.pid for worker in standbys}
+    assert wait_for_standbys() == code_executor.EXECUTOR_STANDBY_WORKERS
+
+
+def test_dead_fork_server_is_restarted(executor):
+    run(executor, "pass")
+    with code_executor._fork_server_lock:
+        process, _ = code_executor._ensure_fork_server()
+    # Standbys forked by the old server still work, so drop them to go through the server
+    if code_executor.EXECUTOR_PREFORK:
+        wait_for_standbys()  # No refill still forking from the old server
+    with code_executor._standby_lock:
+        standbys = list(code_executor._standby_workers)
+        code_executor._standby_workers.clear()
+    for worker in standbys:
+        worker.close()
+    process.send_signal(signal.SIGKILL)
+    process.wait()
+
+    assert run(executor, "print(1 + 1)")["stdout"] == "2\n"
+    with code_executor._fork_server_lock:
+        assert code_executor._fork_server[0].pid != process.pid
+
+
+def test_crashed_worker_reports_its_exit_code(executor):
+    result = executor.execute_code("import os\nos._exit(3)")
+    assert not result["success"]
+    assert "exit code 3" in result["error"]
+    assert run(executor, "print('still usable')")["stdout"] == "still usable\n"
+
+
+def test_wall_clock_timeout_kills_the_worker(executor, monkeypatch):
+    monkeypatch.setattr(code_executor, "EXECUTION_TIMEOUT_SECONDS", 0.5)
+    start = time.perf_counter()
+    result = executor.execute_code("import time\ntime.sleep(30)")
+    assert result["timed_out"] and "wall-clock" in result["error"]
+    assert time.perf_counter() - start < 10
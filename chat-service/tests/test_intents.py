@@ -0,0 +1,95 @@
+"""
+Fast path: which questions skip the LLM, which fall back to it, and that every template runs
+
+Run from chat-service/: python -m pytest tests
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("EXECUTOR_PREWARM", "0")
+
+import code_executor  # noqa: E402
+from code_executor import CodeExecutor  # noqa: E402
+from intents import route_intent  # noqa: E402
+
+SALES = "region,unit_price,units\nnorth,2.5,10\nsouth,3.0,\nnorth,4.5,7\n"
+STORES = "store,region,opened\nA,north,2019\nB,south,2021\n"
+
+
+@pytest.fixture
+def executor(tmp_path):
+    """One dataset, df"""
+    (tmp_path / "sales.csv").write_text(SALES)
+    executor = CodeExecutor()
+    assert executor.add_dataset(str(tmp_path / "sales.csv"), filename="sales.csv") == (True, "df")
+    yield executor
+    executor.close()
+
+
+@pytest.fixture
+def two_datasets(executor, tmp_path):
+    (tmp_path / "stores.csv").write_text(STORES)
+    assert executor.add_dataset(str(tmp_path / "stores.csv"), filename="stores.csv") == (True, "stores")
+    return executor
+
+
+@pytest.mark.parametrize("message, intent", [
+    ("Show basic statistics", "describe"),
+    ("can you describe the data?", "describe"),
+    ("Which columns have missing values?", "missing"),
+    ("how many rows are there", "shape"),
+    ("What are the columns and their types", "columns"),
+    ("show me the first 3 rows please", "head"),
+    ("Plot a histogram of unit price", "histogram"),
+    ("show the distribution of region", "value_counts"),
+])
+def test_common_questions_take_the_fast_path(executor, message, intent):
+    assert route_intent(message, executor).name == intent
+
+
+@pytest.mark.parametrize("message", [
+    "Which region sells the most units?",
+    "show basic statistics and then plot a trend",
+    "histogram of revenue",  # No such column
+    "describe the weather",
+])
+def test_other_questions_go_to_the_llm(executor, message):
+    assert route_intent(message, executor) is None
+
+
+def test_several_datasets_need_an_unambiguous_target(two_datasets):
+    assert route_intent("show basic statistics", two_datasets) is None
+    assert route_intent("show basic statistics of stores", two_datasets).dataset == "stores"
+    assert route_intent("missing values in df", two_datasets).dataset == "df"
+    # A column only one dataset has picks it; a column both have does not
+    assert route_intent("histogram of opened", two_datasets).dataset == "stores"
+    assert route_intent("show the distribution of region", two_datasets) is None
+    assert route_intent("show the distribution of region in stores", two_datasets).dataset == "stores"
+
+
+def test_head_rows_are_capped(executor):
+    assert "head(50)" in route_intent("show the first 5000 rows", executor).code
+
+
+@pytest.mark.parametrize("message, expected", [
+    ("show basic statistics", "Basic statistics:"),
+    ("which columns have missing values", "units"),
+    ("how many rows", "3 rows × 3 columns"),
+    ("list the columns", "unit_price"),
+    ("show the first 2 rows", "north"),
+    ("histogram of unit_price", "3 values, mean 3.333"),
+    ("show the distribution of region", "north"),
+])
+def test_templates_run(executor, message, expected):
+    intent = route_intent(message, executor)
+    # pytest swaps sys.stdout around each test phase, dropping the proxy threaded executions print through
+    code_executor._install_context_isolation()
+    result = executor.execute_code(intent.code)
+    assert result["success"], result["error"]
+    assert expected in result["stdout"]
+    assert bool(result["plots"]) == (intent.name in ("histogram", "value_counts"))
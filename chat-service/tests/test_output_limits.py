@@ -0,0 +1,90 @@
+"""
+Bounded execution output: stdout keeps its head and tail, plots are capped, history is bounded
+
+Run from chat-service/: python -m pytest tests
+"""
+
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("EXECUTOR_PREWARM", "0")
+
+import code_executor  # noqa: E402
+from code_executor import CodeExecutor, _BoundedOutput, summarize_output  # noqa: E402
+
+
+def test_bounded_output_keeps_head_and_tail_and_counts_the_rest():
+    out = _BoundedOutput(limit=100)
+    for n in range(1000):
+        out.write(f"row {n:04d}\n")
+    text = out.getvalue()
+    assert text.startswith("row 0000\n") and text.endswith("row 0999\n")
+    omitted = int(re.search(r"\[output truncated: (\d+) lines, ", text).group(1))
+    assert omitted + text.count("\n") - 1 == 1000  # Less the marker's own line
+    assert len(text.encode()) < 200
+
+
+def test_bounded_output_counts_bytes_not_characters():
+    out = _BoundedOutput(limit=10)
+    out.write("é" * 100)  # Two bytes each
+    text = out.getvalue()
+    assert "of 200 bytes omitted" in text
+    head, _, rest = text.partition("\n...")
+    assert len(head.encode()) <= 5 and rest.endswith("é" * 2)
+
+
+def test_short_output_is_unchanged():
+    out = _BoundedOutput(limit=100)
+    out.write("a\n")
+    out.write("b")
+    assert out.getvalue() == "a\nb"
+
+
+def test_summarize_output_keeps_whole_lines():
+    text = "".join(f"line {n}\n" for n in range(100))
+    summary = summarize_output(text, 120)
+    assert summary.startswith("line 0\n") and summary.endswith("line 99\n")
+    assert "lines (" in summary and len(summary) < 200
+    assert summarize_output("short", 120) == "short"
+    assert summarize_output("x" * 500, 100).startswith("x" * 100 + "\n[... 400 characters omitted")
+
+
+def test_large_print_is_truncated_in_the_result():
+    code_executor._ensure_data_stack()
+    # pytest swaps sys.stdout around each test phase, dropping the proxy threaded executions print through
+    code_executor._install_context_isolation()
+    executor = CodeExecutor()
+    try:
+        result = executor.execute_code("for n in range(200_000):\n    print('row', n)")
+        assert result["success"], result["error"]
+        assert len(result["stdout"].encode()) < code_executor.MAX_STDOUT_BYTES + 200
+        assert result["stdout"].startswith("row 0\n") and result["stdout"].endswith("row 199999\n")
+    finally:
+        executor.close()
+
+
+def test_plots_beyond_the_limit_are_omitted(monkeypatch):
+    monkeypatch.setattr(code_executor, "MAX_PLOTS", 2)
+    executor = CodeExecutor()
+    code_executor._ensure_data_stack()
+    # In this process, so the patched limit applies whatever the isolation mode
+    result, _ = executor._run("for n in range(4):\n    plt.figure()\n    plt.plot([n, n + 1])", None, copy_frames=True)
+    assert result["success"], result["error"]
+    assert len(result["plots"]) == 2
+    assert "[2 plot(s) omitted: limit is 2 plots" in result["stdout"]
+
+
+def test_execution_history_keeps_the_most_recent_entries():
+    executor = CodeExecutor()
+    try:
+        for n in range(code_executor.EXECUTION_HISTORY_SIZE + 5):
+            executor.execution_history.append({"action": "execute_code", "code": str(n), "success": True})
+        executor.execute_code("x = 1")
+        history = list(executor.execution_history)
+        assert len(history) == code_executor.EXECUTION_HISTORY_SIZE
+        assert history[0]["code"] == "6" and history[-1]["code"] == "x = 1"
+    finally:
+        executor.close()
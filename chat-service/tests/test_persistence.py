@@ -0,0 +1,106 @@
+"""
+PersistenceQueue: ordering, retries, and that every submitted write is resolved
+
+Run from chat-service/: python -m pytest tests
+"""
+
+import asyncio
+import os
+import sys
+
+import httpx
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import persistence  # noqa: E402
+from metrics import PERSIST_FAILURES  # noqa: E402
+from persistence import PersistenceQueue  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(persistence, "PERSIST_BACKOFF_SECONDS", 0)
+
+
+def server_error(status: int) -> httpx.HTTPStatusError:
+    request = httpx.Request("POST", "http://storage/api/conversations/1/messages")
+    return httpx.HTTPStatusError("error", request=request, response=httpx.Response(status, request=request))
+
+
+def failures() -> float:
+    return PERSIST_FAILURES._value.get()
+
+
+def test_writes_of_a_conversation_are_delivered_in_order():
+    delivered = []
+
+    async def deliver(conversation_id, payload):
+        await asyncio.sleep(0.01 if payload["n"] == 0 else 0)
+        delivered.append((conversation_id, payload["n"]))
+        return {"id": payload["n"]}
+
+    async def run():
+        queue = PersistenceQueue(deliver)
+        futures = [queue.submit(1, {"n": n}) for n in range(3)] + [queue.submit(2, {"n": 9})]
+        return await asyncio.gather(*futures)
+
+    results = asyncio.run(run())
+    assert results == [{"id": 0}, {"id": 1}, {"id": 2}, {"id": 9}]
+    assert [n for conversation_id, n in delivered if conversation_id == 1] == [0, 1, 2]
+
+
+def test_server_errors_are_retried_and_client_errors_are_not():
+    attempts = {"retry": 0, "gone": 0}
+
+    async def deliver(conversation_id, payload):
+        attempts[payload["kind"]] += 1
+        if payload["kind"] == "retry" and attempts["retry"] < 2:
+            raise server_error(503)
+        if payload["kind"] == "gone":
+            raise server_error(404)
+        return {"ok": True}
+
+    async def run():
+        queue = PersistenceQueue(deliver)
+        return await asyncio.gather(queue.submit(1, {"kind": "retry"}), queue.submit(1, {"kind": "gone"}))
+
+    assert asyncio.run(run()) == [{"ok": True}, None]
+    assert attempts == {"retry": 2, "gone": 1}
+
+
+def test_unexpected_error_resolves_the_write_and_the_queue_keeps_going():
+    before = failures()
+
+    async def deliver(conversation_id, payload):
+        if payload["n"] == 0:
+            raise ValueError("Expecting value: line 1 column 1 (char 0)")  # e.g. response.json() on a bad body
+        return {"id": payload["n"]}
+
+    async def run():
+        queue = PersistenceQueue(deliver)
+        futures = [queue.submit(1, {"n": n}) for n in range(3)]
+        return await asyncio.wait_for(asyncio.gather(*futures), timeout=5)
+
+    assert asyncio.run(run()) == [None, {"id": 1}, {"id": 2}]
+    assert failures() == before + 1
+
+
+def test_cancelled_worker_resolves_everything_still_queued():
+    started = None
+
+    async def deliver(conversation_id, payload):
+        started.set()
+        await asyncio.sleep(3600)
+
+    async def run():
+        nonlocal started
+        started = asyncio.Event()
+        queue = PersistenceQueue(deliver)
+        futures = [queue.submit(1, {"n": n}) for n in range(3)]
+        await started.wait()
+        queue._workers[1].cancel()
+        results = await asyncio.wait_for(asyncio.gather(*futures), timeout=5)
+        return results, dict(queue._queues), dict(queue._workers)
+
+    assert asyncio.run(run()) == ([None, None, None], {}, {})
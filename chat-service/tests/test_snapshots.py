@@ -0,0 +1,113 @@
+"""
+Snapshot restore: frames come back memory-mapped, and executions use the files without copying them
+
+Run from chat-service/: python -m pytest tests
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("EXECUTOR_PREWARM", "0")
+
+np = pytest.importorskip("numpy")
+pd = pytest.importorskip("pandas")
+pytest.importorskip("pyarrow")
+
+import code_executor  # noqa: E402
+import snapshots  # noqa: E402
+from code_executor import CodeExecutor  # noqa: E402
+
+ROWS = 2_000_000
+FRAME_BYTES = ROWS * 4 * 8  # Four float64 columns
+
+# Run inside the execution: anonymous (not file-backed) memory of the process, in bytes
+RSS_ANON = (
+    "rss_anon = [int(line.split()[1]) * 1024 for line in open('/proc/self/status') if line.startswith('RssAnon:')][0]\n"
+)
+
+
+@pytest.fixture(autouse=True)
+def snapshot_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(snapshots, "SNAPSHOTS", True)
+    monkeypatch.setattr(snapshots, "SNAPSHOT_DIR", tmp_path)
+
+
+def rss_anon() -> int:
+    with open("/proc/self/status") as f:
+        return next(int(line.split()[1]) * 1024 for line in f if line.startswith("RssAnon:"))
+
+
+def snapshotted_executor(conversation_id: int, frames: dict) -> CodeExecutor:
+    """An executor holding frames whose snapshot has been written, as after a load"""
+    executor = CodeExecutor()
+    executor.dataframes.update(frames)
+    executor._unsnapshotted.update(frames)
+    changed, datasets, df_count = executor.snapshot_changes()
+    written = snapshots.write_snapshot(conversation_id, changed, datasets, df_count)
+    executor.snapshot_written(changed, written, {name: snapshots.frame_path(conversation_id, name) for name in written})
+    assert sorted(written) == sorted(frames)
+    return executor
+
+
+def restored_executor(conversation_id: int) -> CodeExecutor:
+    """Restore the way main.restore_executor does"""
+    frames, datasets, df_count = snapshots.read_snapshot(conversation_id)
+    executor = CodeExecutor()
+    executor.restore(frames, datasets, df_count, {name: snapshots.frame_path(conversation_id, name) for name in frames})
+    return executor
+
+
+def test_restore_round_trips_and_executions_never_write_to_the_mapping():
+    original = pd.DataFrame({"a": np.arange(5.0), "b": list("vwxyz")})
+    snapshotted_executor(1, {"df": original, "other": pd.DataFrame({"c": [1]})}).close()
+
+    executor = restored_executor(1)
+    try:
+        pd.testing.assert_frame_equal(executor.dataframes["df"], original)
+        result = executor.execute_code("df.iloc[0, 0] = -1\ndf['a'] += 1\nassert df['a'].tolist() == [0, 2, 3, 4, 5]")
+        assert result["success"], result["error"]
+        pd.testing.assert_frame_equal(executor.dataframes["df"], original)
+
+        result = executor.execute_code("df = df[df['a'] > 2]", save_to_memory=["df"])
+        assert result["success"], result["error"]
+        assert executor.dataframes["df"]["a"].tolist() == [3.0, 4.0]
+        assert executor.has_unsnapshotted_changes()
+    finally:
+        executor.close()
+
+
+def test_execution_still_sees_a_frame_whose_snapshot_was_deleted():
+    executor = snapshotted_executor(2, {"df": pd.DataFrame({"a": [1, 2, 3]})})
+    try:
+        snapshots.delete_snapshot(2)  # e.g. by the disk budget
+        result = executor.execute_code("assert df['a'].sum() == 6")
+        assert result["success"], result["error"]
+    finally:
+        executor.close()
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/status"), reason="reads RssAnon from /proc")
+def test_restore_and_execution_keep_frames_out_of_anonymous_memory():
+    rng = np.random.default_rng(0)
+    frame = pd.DataFrame({name: rng.normal(size=ROWS) for name in "wxyz"})
+    snapshotted_executor(3, {"df": frame}).close()
+    del frame
+
+    code_executor._ensure_data_stack()  # Its imports are not what is measured
+    before = rss_anon()
+    executor = restored_executor(3)
+    try:
+        # Every column is read in full, so the worker touches all of the mapped pages
+        baseline = executor.execute_code(RSS_ANON + "print(rss_anon)")
+        result = executor.execute_code(RSS_ANON.replace("rss_anon = ", "total = df.sum().sum()\nrss_anon = ") + "print(rss_anon)")
+        assert baseline["success"] and result["success"], result["error"]
+        # The service holds the frame in the page cache, not in its own memory
+        assert rss_anon() - before < FRAME_BYTES // 4
+        if code_executor._PROCESS_ISOLATION:  # Nor does the worker, which maps the file too
+            assert int(result["stdout"]) - int(baseline["stdout"]) < FRAME_BYTES // 4
+    finally:
+        executor.close()
@@ -0,0 +1,51 @@
+"""
+stage(): histogram observation, and spans that record the stage's exceptions
+
+Run from chat-service/: python -m pytest tests
+"""
+
+import pytest
+from prometheus_client import CollectorRegistry, Histogram
+
+from app_shared.tracing import stage_timer
+
+pytest.importorskip("opentelemetry.sdk")
+
+from opentelemetry.sdk.trace import TracerProvider  # noqa: E402
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor  # noqa: E402
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter  # noqa: E402
+from opentelemetry.trace import StatusCode  # noqa: E402
+
+
+def observed(histogram) -> float:
+    return next(sample.value for sample in histogram.collect()[0].samples if sample.name.endswith("_count"))
+
+
+@pytest.fixture
+def traced():
+    exporter = InMemorySpanExporter()
+    provider = TracerProvider()
+    provider.add_span_processor(SimpleSpanProcessor(exporter))
+    histogram = Histogram("test_stage_seconds", "test", ["handler", "stage"], registry=CollectorRegistry())
+    return stage_timer(histogram, "test", tracer=provider.get_tracer("test")), histogram, exporter
+
+
+def test_stage_is_observed_and_spanned(traced):
+    stage, histogram, exporter = traced
+    with stage("chat", "llm"):
+        pass
+    (span,) = exporter.get_finished_spans()
+    assert span.name == "chat.llm" and span.status.status_code != StatusCode.ERROR
+    assert observed(histogram) == 1
+
+
+def test_exception_in_a_stage_is_recorded_on_its_span(traced):
+    stage, histogram, exporter = traced
+    with pytest.raises(ValueError):
+        with stage("chat", "execute"):
+            raise ValueError("boom")
+    (span,) = exporter.get_finished_spans()
+    assert span.status.status_code == StatusCode.ERROR
+    assert [event.name for event in span.events] == ["exception"]
+    assert span.events[0].attributes["exception.message"] == "boom"
+    assert observed(histogram) == 1
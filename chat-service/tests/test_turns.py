@@ -0,0 +1,103 @@
+"""
+Resumable turns: Last-Event-ID replay, live continuation, buffer limits and retention
+
+Run from chat-service/: python -m pytest tests
+"""
+
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import turns  # noqa: E402
+from turns import REPLAY_GAP_FRAME, TurnRegistry  # noqa: E402
+
+
+def frame(n: int) -> str:
+    return f"data: {n}\n\n"
+
+
+async def frames(count: int, gate: asyncio.Event = None):
+    for n in range(count):
+        if gate is not None and n == count // 2:
+            await gate.wait()
+        yield frame(n)
+
+
+async def collect(events) -> list:
+    return [item async for item in events]
+
+
+def test_reconnect_replays_what_was_missed_then_continues_live():
+    async def run():
+        registry = TurnRegistry()
+        gate = asyncio.Event()
+        turn = registry.start(1, frames(6, gate))
+        first = turn.events()
+        received = [await first.__anext__() for _ in range(2)]
+        await first.aclose()  # Dropped after frame 1
+
+        last_event_id = received[-1].split("\n", 1)[0][len("id: "):]
+        resumed_turn, last_seq = registry.resume(last_event_id, conversation_id=1)
+        resumed = asyncio.create_task(collect(resumed_turn.events(last_seq)))
+        await asyncio.sleep(0.01)
+        gate.set()  # The rest arrives while the client is attached again
+        return turn, received, await asyncio.wait_for(resumed, timeout=5)
+
+    turn, received, resumed = asyncio.run(run())
+    assert received == [f"id: {turn.id}:0\n{frame(0)}", f"id: {turn.id}:1\n{frame(1)}"]
+    assert resumed == [f"id: {turn.id}:{n}\n{frame(n)}" for n in range(2, 6)]
+
+
+def test_only_known_turns_of_the_same_conversation_resume():
+    async def run():
+        registry = TurnRegistry()
+        turn = registry.start(1, frames(2))
+        await turn.wait()
+        return registry, turn
+
+    registry, turn = asyncio.run(run())
+    assert registry.resume(f"{turn.id}:0", conversation_id=1)[1] == 0
+    assert registry.resume(f"{turn.id}:0", conversation_id=2) is None
+    assert registry.resume(f"{turn.id}:x") is None
+    assert registry.resume("unknown:0") is None
+    assert registry.resume(None) is None
+
+
+def test_replay_past_the_buffer_reports_a_gap(monkeypatch):
+    monkeypatch.setattr(turns, "REPLAY_BUFFER_EVENTS", 3)
+
+    async def run():
+        turn = TurnRegistry().start(1, frames(10))
+        await turn.wait()
+        return await collect(turn.events(last_seq=2)), await collect(turn.events(last_seq=6))
+
+    evicted, buffered = asyncio.run(run())
+    assert evicted == [REPLAY_GAP_FRAME]
+    assert [item.split("\n", 1)[1] for item in buffered] == [frame(7), frame(8), frame(9)]
+
+
+def test_finished_turns_are_kept_for_the_retention_period(monkeypatch):
+    async def run():
+        registry = TurnRegistry()
+        turn = registry.start(1, frames(1))
+        await turn.wait()
+        kept = registry.get(turn.id) is turn and not registry.running(1)
+        monkeypatch.setattr(turns, "TURN_RETENTION_SECONDS", -1)
+        return kept, registry.get(turn.id)
+
+    assert asyncio.run(run()) == (True, None)
+
+
+def test_shutdown_cancels_running_turns():
+    async def run():
+        registry = TurnRegistry()
+        turn = registry.start(1, frames(4, asyncio.Event()))  # Never released
+        await asyncio.sleep(0.01)
+        assert registry.running(1)
+        await asyncio.wait_for(registry.shutdown(), timeout=5)
+        return turn
+
+    turn = asyncio.run(run())
+    assert turn.done
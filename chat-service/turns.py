@@ -0,0 +1,167 @@
+"""
+In-flight chat turns with resumable SSE streams
+
+A turn runs its response generator as a background task that appends every
+frame to a bounded replay buffer. Clients read from the buffer, so a dropped
+connection does not stop the turn: reconnecting with `Last-Event-ID:
+<turn_id>:<seq>` replays what was missed and continues live. A turn with no
+client attached for DISCONNECT_GRACE_SECONDS is cancelled, which stops its
+upstream work.
+"""
+
+import asyncio
+import os
+import time
+import uuid
+from collections import deque
+from typing import AsyncIterator, Dict, Optional, Tuple
+
+from metrics import SSE_RESUMES, TURNS_ACTIVE
+
+REPLAY_BUFFER_EVENTS = int(os.getenv("REPLAY_BUFFER_EVENTS", "5000"))
+REPLAY_BUFFER_BYTES = int(os.getenv("REPLAY_BUFFER_BYTES", str(32 * 1024 * 1024)))
+DISCONNECT_GRACE_SECONDS = float(os.getenv("DISCONNECT_GRACE_SECONDS", "30"))
+TURN_RETENTION_SECONDS = float(os.getenv("TURN_RETENTION_SECONDS", "300"))  # Finished turns stay resumable
+SSE_KEEPALIVE_SECONDS = float(os.getenv("SSE_KEEPALIVE_SECONDS", "15"))
+
+REPLAY_GAP_FRAME = 'data: {"error": "The rest of this response is no longer available. Reload the conversation.", "done": true}\n\n'
+
+
+class Turn:
+    """One streamed response, decoupled from the connection(s) reading it"""
+
+    def __init__(self, conversation_id: int, frames: AsyncIterator[str], id_prefix: str = ""):
+        self.id = id_prefix + uuid.uuid4().hex
+        self.conversation_id = conversation_id
+        self.done = False
+        self.finished_at: Optional[float] = None
+        self._buffer: deque = deque()  # Frames next_seq - len(buffer) .. next_seq - 1
+        self._buffer_bytes = 0
+        self._next_seq = 0
+        self._subscribers = 0
+        self._wakeup = asyncio.Event()
+        self._grace_timer: Optional[asyncio.TimerHandle] = None
+        self._task = asyncio.create_task(self._produce(frames))
+
+    async def _produce(self, frames: AsyncIterator[str]):
+        try:
+            async for frame in frames:
+                self._append(frame)
+        finally:
+            await frames.aclose()
+            self.done = True
+            self.finished_at = time.monotonic()
+            self._notify()
+
+    def _append(self, frame: str):
+        self._buffer.append(frame)
+        self._buffer_bytes += len(frame)
+        self._next_seq += 1
+        # Keep at least the newest frame so live readers never miss it
+        while len(self._buffer) > 1 and (
+            len(self._buffer) > REPLAY_BUFFER_EVENTS or self._buffer_bytes > REPLAY_BUFFER_BYTES
+        ):
+            self._buffer_bytes -= len(self._buffer.popleft())
+        self._notify()
+
+    def _notify(self):
+        self._wakeup.set()
+        self._wakeup = asyncio.Event()
+
+    def _attach(self):
+        self._subscribers += 1
+        if self._grace_timer is not None:
+            self._grace_timer.cancel()
+            self._grace_timer = None
+
+    def _detach(self):
+        self._subscribers -= 1
+        if self._subscribers == 0 and not self.done:
+            loop = asyncio.get_running_loop()
+            self._grace_timer = loop.call_later(DISCONNECT_GRACE_SECONDS, self._abandon)
+
+    def _abandon(self):
+        self._grace_timer = None
+        if self._subscribers == 0 and not self.done:
+            self._task.cancel()
+
+    def cancel(self):
+        self._task.cancel()
+
+    async def wait(self):
+        await asyncio.gather(self._task, return_exceptions=True)
+
+    async def events(self, last_seq: Optional[int] = None) -> AsyncIterator[str]:
+        """SSE frames after last_seq (all frames if None), then live ones until the turn ends"""
+        next_seq = 0 if last_seq is None else last_seq + 1
+        self._attach()
+        try:
+            while True:
+                wakeup = self._wakeup
+                while next_seq < self._next_seq:
+                    oldest = self._next_seq - len(self._buffer)
+                    if next_seq < oldest:
+                        yield REPLAY_GAP_FRAME
+                        return
+                    yield f"id: {self.id}:{next_seq}\n{self._buffer[next_seq - oldest]}"
+                    next_seq += 1
+                    wakeup = self._wakeup
+                if self.done:
+                    return
+                try:
+                    await asyncio.wait_for(wakeup.wait(), SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    # Comment frame: keeps proxies from timing out and surfaces dead connections
+                    yield ": keepalive\n\n"
+        finally:
+            self._detach()
+
+
+class TurnRegistry:
+    """In-flight and recently finished turns by id"""
+
+    def __init__(self, id_prefix: str = ""):
+        self._turns: Dict[str, Turn] = {}
+        self._id_prefix = id_prefix  # Lets other cluster nodes tell which node runs a turn
+        TURNS_ACTIVE.set_function(lambda: sum(1 for turn in list(self._turns.values()) if not turn.done))
+
+    def _purge(self):
+        cutoff = time.monotonic() - TURN_RETENTION_SECONDS
+        for turn_id, turn in list(self._turns.items()):
+            if turn.done and turn.finished_at < cutoff:
+                del self._turns[turn_id]
+
+    def start(self, conversation_id: int, frames: AsyncIterator[str]) -> Turn:
+        self._purge()
+        turn = Turn(conversation_id, frames, self._id_prefix)
+        self._turns[turn.id] = turn
+        return turn
+
+    def get(self, turn_id: str) -> Optional[Turn]:
+        self._purge()
+        return self._turns.get(turn_id)
+
+    def running(self, conversation_id: int) -> bool:
+        """Whether a turn of the conversation is still producing output"""
+        return any(turn.conversation_id == conversation_id and not turn.done for turn in self._turns.values())
+
+    def resume(self, last_event_id: Optional[str], conversation_id: Optional[int] = None) -> Optional[Tuple[Turn, int]]:
+        """Turn and sequence number a `Last-Event-ID` refers to, if it can still be resumed"""
+        if not last_event_id:
+            return None
+        turn_id, _, seq = last_event_id.partition(":")
+        turn = self.get(turn_id)
+        if turn is None or not seq.isdigit() or (
+            conversation_id is not None and turn.conversation_id != conversation_id
+        ):
+            SSE_RESUMES.labels("expired").inc()
+            return None
+        SSE_RESUMES.labels("resumed").inc()
+        return turn, int(seq)
+
+    async def shutdown(self):
+        """Cancel running turns so they persist their partial answers"""
+        running = [turn for turn in self._turns.values() if not turn.done]
+        for turn in running:
+            turn.cancel()
+        await asyncio.gather(*(turn.wait() for turn in running))
@@ -17,8 +17,7 @@ export default function Home() {
   const [isLoading, setIsLoading] = useState(false);
   const [isStreaming, setIsStreaming] = useState(false);
   const [csvMode, setCsvMode] = useState(false);
-  const [csvPath, setCsvPath] = useState<string | null>(null);
-  const [csvFilename, setCsvFilename] = useState<string | null>(null);
+  const [csvDatasets, setCsvDatasets] = useState<{ csv_path: string; filename: string }[]>([]);
   const [messagePlots, setMessagePlots] = useState<Record<number, string[]>>({});
   const [sidebarOpen, setSidebarOpen] = useState(false);
   const messagesEndRef = useRef<HTMLDivElement>(null);
@@ -40,7 +39,7 @@ export default function Home() {
 
   const loadConversations = async () => {
     try {
-      const response = await fetch(`${STORAGE_SERVICE_URL}/api/conversations`);
+      const response = await fetch(`${STORAGE_SERVICE_URL}/api/conversations/summaries`);
       const data = await response.json();
       setConversations(data);
       
@@ -70,8 +69,7 @@ export default function Home() {
       setConversationId(newConv.id);
       setMessages([]);
       setCsvMode(false);
-      setCsvPath(null);
-      setCsvFilename(null);
+      setCsvDatasets([]);
       setMessagePlots({});
       firstMessageSentRef.current = false;
       setSidebarOpen(false); // Close sidebar on mobile
@@ -85,8 +83,7 @@ export default function Home() {
       setConversationId(convId);
       await loadMessages(convId);
       setCsvMode(false);
-      setCsvPath(null);
-      setCsvFilename(null);
+      setCsvDatasets([]);
       setSidebarOpen(false); // Close sidebar on mobile
     } catch (error) {
       console.error('Error loading conversation:', error);
@@ -172,8 +169,8 @@ export default function Home() {
   };
 
   const handleCSVUpload = (path: string, filename: string) => {
-    setCsvPath(path);
-    setCsvFilename(filename);
+    // Every upload adds a dataset; the backend loads each one only when the analysis uses it
+    setCsvDatasets((prev) => (prev.some((d) => d.csv_path === path) ? prev : [...prev, { csv_path: path, filename }]));
     setCsvMode(true);
     
     // Add system message
@@ -198,12 +195,11 @@ export default function Home() {
       }
     }
     setCsvMode(false);
-    setCsvPath(null);
-    setCsvFilename(null);
+    setCsvDatasets([]);
   };
 
   const handleSendCSVMessage = async (content: string) => {
-    if (!conversationId || !csvPath || !content.trim()) return;
+    if (!conversationId || csvDatasets.length === 0 || !content.trim()) return;
 
     const userMessage: Message = {
       id: Date.now(),
@@ -231,7 +227,7 @@ export default function Home() {
         body: JSON.stringify({
           conversation_id: conversationId,
           message: content.trim(),
-          csv_path: csvPath,
+          datasets: csvDatasets,
         }),
       });
 
@@ -496,7 +492,7 @@ export default function Home() {
               <div className="flex-1 ml-0 md:ml-0">
                 <h1 className="text-2xl font-bold">Chat Application</h1>
                 <p className="text-sm text-blue-100">
-                  {csvMode ? `📊 CSV Analysis: ${csvFilename}` : 'Multi-turn conversation with AI'}
+                  {csvMode ? `📊 CSV Analysis: ${csvDatasets.map((d) => d.filename).join(', ')}` : 'Multi-turn conversation with AI'}
                 </p>
               </div>
               {csvMode && (
@@ -511,7 +507,7 @@ export default function Home() {
           </div>
 
           {/* CSV Upload Section */}
-          {!csvMode && conversationId && (
+          {conversationId && (
             <div className="p-4 border-b">
               <CSVUpload onUpload={handleCSVUpload} disabled={isLoading} />
             </div>
@@ -1,5 +1,71 @@
 import { useState, useRef } from 'react';
 
+const STORAGE_URL = 'http://localhost:8002';
+// Files above this size use the resumable chunked upload API
+const CHUNKED_UPLOAD_THRESHOLD = 32 * 1024 * 1024;
+const CHUNK_SIZE = 8 * 1024 * 1024;
+const PARALLEL_CHUNKS = 4;
+const CHUNK_RETRIES = 3;
+
+const toHex = (buffer: ArrayBuffer) =>
+  Array.from(new Uint8Array(buffer)).map((b) => b.toString(16).padStart(2, '0')).join('');
+
+// Upload in parallel chunks with per-chunk checksums. The session id is kept in
+// localStorage so retrying the same file resumes from the chunks already stored.
+async function uploadInChunks(file: File) {
+  const resumeKey = `csv-upload:${file.name}:${file.size}:${file.lastModified}`;
+  let status = null;
+  const savedId = localStorage.getItem(resumeKey);
+  if (savedId) {
+    const response = await fetch(`${STORAGE_URL}/api/uploads/${savedId}`);
+    if (response.ok) status = await response.json();
+  }
+  if (!status) {
+    const response = await fetch(`${STORAGE_URL}/api/uploads`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ filename: file.name, size: file.size, chunk_size: CHUNK_SIZE }),
+    });
+    if (!response.ok) throw new Error('Failed to start upload');
+    status = await response.json();
+    localStorage.setItem(resumeKey, status.upload_id);
+  }
+
+  const received = new Set<number>(status.received);
+  const pending = Array.from({ length: status.total_chunks }, (_, i) => i).filter((i) => !received.has(i));
+
+  const sendChunk = async (index: number) => {
+    const blob = file.slice(index * status.chunk_size, (index + 1) * status.chunk_size);
+    const body = await blob.arrayBuffer();
+    const checksum = toHex(await crypto.subtle.digest('SHA-256', body));
+    for (let attempt = 0; ; attempt++) {
+      try {
+        const response = await fetch(`${STORAGE_URL}/api/uploads/${status.upload_id}/chunks/${index}`, {
+          method: 'PUT',
+          headers: { 'X-Chunk-SHA256': checksum },
+          body,
+        });
+        if (response.ok) return;
+        throw new Error(`Chunk ${index} failed`);
+      } catch (err) {
+        if (attempt >= CHUNK_RETRIES) throw err;
+      }
+    }
+  };
+
+  const workers = Array.from({ length: PARALLEL_CHUNKS }, async () => {
+    while (pending.length) {
+      await sendChunk(pending.shift()!);
+    }
+  });
+  await Promise.all(workers);
+
+  const response = await fetch(`${STORAGE_URL}/api/uploads/${status.upload_id}/complete`, { method: 'POST' });
+  if (!response.ok) throw new Error('Failed to upload CSV');
+  localStorage.removeItem(resumeKey);
+  return response.json();
+}
+
 interface CSVUploadProps {
   onUpload: (csvPath: string, filename: string) => void;
   disabled?: boolean;
@@ -24,19 +90,24 @@ export default function CSVUpload({ onUpload, disabled }: CSVUploadProps) {
     setError(null);
 
     try {
-      const formData = new FormData();
-      formData.append('file', file);
-
-      const response = await fetch('http://localhost:8002/api/upload-csv', {
-        method: 'POST',
-        body: formData,
-      });
-
-      if (!response.ok) {
-        throw new Error('Failed to upload CSV');
+      let data;
+      if (file.size > CHUNKED_UPLOAD_THRESHOLD) {
+        data = await uploadInChunks(file);
+      } else {
+        const formData = new FormData();
+        formData.append('file', file);
+
+        const response = await fetch(`${STORAGE_URL}/api/upload-csv`, {
+          method: 'POST',
+          body: formData,
+        });
+
+        if (!response.ok) {
+          throw new Error('Failed to upload CSV');
+        }
+
+        data = await response.json();
       }
-
-      const data = await response.json();
       onUpload(data.csv_path, data.filename);
       
       // Reset file input
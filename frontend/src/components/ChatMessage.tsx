@@ -11,6 +11,12 @@ interface ChatMessageProps {
 
 const STORAGE_SERVICE_URL = process.env.NEXT_PUBLIC_STORAGE_SERVICE_URL || 'http://localhost:8002';
 
+// Content-addressed uploads have a small thumbnail generated by storage-service
+const thumbnailUrl = (imageUrl: string) => {
+  const match = imageUrl.match(/^\/uploads\/([0-9a-f]{64})\.[A-Za-z0-9]+$/);
+  return match ? `/uploads/${match[1]}.thumb.jpg` : imageUrl;
+};
+
 export default function ChatMessage({ message, plots, onFeedback }: ChatMessageProps) {
   const isUser = message.role === 'user';
   const timestamp = format(new Date(message.timestamp), 'HH:mm');
@@ -87,7 +93,11 @@ export default function ChatMessage({ message, plots, onFeedback }: ChatMessageP
           {message.image_url && (
             <div className="mb-3">
               <img 
-                src={`${STORAGE_SERVICE_URL}${message.image_url}`}
+                src={`${STORAGE_SERVICE_URL}${thumbnailUrl(message.image_url)}`}
+                onError={(e) => {
+                  const original = `${STORAGE_SERVICE_URL}${message.image_url}`;
+                  if (e.currentTarget.src !== original) e.currentTarget.src = original;
+                }}
                 alt="Uploaded image"
                 className="max-w-full rounded-lg max-h-64 object-contain"
               />
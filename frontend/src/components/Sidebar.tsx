@@ -88,8 +88,15 @@ export default function Sidebar({
                     <h3 className="text-sm font-medium truncate">
                       {conv.title}
                     </h3>
+                    {conv.last_message_preview && (
+                      <p className="text-xs text-gray-500 mt-1 truncate">
+                        {conv.last_message_preview}
+                      </p>
+                    )}
                     <p className="text-xs text-gray-400 mt-1">
-                      {formatTime(conv.updated_at)}
+                      {formatTime(conv.last_message_at || conv.updated_at)}
+                      {!!conv.message_count && ` · ${conv.message_count} messages`}
+                      {!!conv.plot_count && ' · 📊'}
                     </p>
                   </div>
                   
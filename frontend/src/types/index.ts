@@ -14,4 +14,12 @@ export interface Conversation {
   title: string;
   created_at: string;
   updated_at: string;
+  // Sidebar aggregates, present on /api/conversations/summaries results
+  message_count?: number;
+  last_message_at?: string | null;
+  last_message_preview?: string | null;
+  like_count?: number;
+  dislike_count?: number;
+  image_count?: number;
+  plot_count?: number;
 }
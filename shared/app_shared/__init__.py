@@ -0,0 +1,7 @@
+"""
+Code used by both chat-service and storage-service: response compression and
+per-stage latency spans
+
+Installed into each service (`-e ../shared` in requirements.txt, a path source
+in pyproject.toml, an extra build context in Docker), so there is one copy.
+"""
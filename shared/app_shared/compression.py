@@ -0,0 +1,216 @@
+"""
+Response compression middleware: zstd, brotli or gzip, negotiated per request
+
+The encoding is the first of COMPRESSION_ENCODINGS (server preference) that the
+client accepts and that is installed; gzip is always available, brotli and
+zstd need the optional `brotli` / `zstandard` packages. Only media types in
+COMPRESSION_TYPES are compressed, so PNG uploads and other already-compressed
+formats pass through, as does anything that already has a Content-Encoding
+(e.g. precompressed /uploads variants or a proxied response).
+
+Responses whose Content-Length is below COMPRESSION_MIN_BYTES are sent as is;
+streams of unknown length are always compressed. text/event-stream chunks are
+flushed (gzip Z_SYNC_FLUSH, brotli flush, zstd FLUSH_BLOCK) so every event is
+decodable as soon as it arrives, at the cost of a few bytes per event. Other
+streams (NDJSON exports) are left to fill compression blocks.
+"""
+
+import os
+import zlib
+from typing import List, Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import brotli
+except ImportError:  # Brotli is optional
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional
+    zstandard = None
+
+COMPRESSION = os.getenv("COMPRESSION", "1") == "1"
+COMPRESSION_MIN_BYTES = int(os.getenv("COMPRESSION_MIN_BYTES", "1024"))
+# Server preference, most preferred first
+COMPRESSION_ENCODINGS = [e.strip() for e in os.getenv("COMPRESSION_ENCODINGS", "zstd,br,gzip").split(",") if e.strip()]
+# Media types to compress; entries ending in "/" match a whole family
+COMPRESSION_TYPES = [t.strip() for t in os.getenv(
+    "COMPRESSION_TYPES",
+    "text/,application/json,application/x-ndjson,application/javascript,image/svg+xml",
+).split(",") if t.strip()]
+
+# Levels tuned for on-the-fly compression, not the smallest output
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4
+ZSTD_LEVEL = 3
+
+
+class _Gzip:
+    def __init__(self):
+        self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+class _Brotli:
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush()
+
+    def finish(self) -> bytes:
+        return self._compressor.finish()
+
+
+class _Zstd:
+    def __init__(self):
+        self._compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+COMPRESSORS = {"gzip": _Gzip}
+if brotli is not None:
+    COMPRESSORS["br"] = _Brotli
+if zstandard is not None:
+    COMPRESSORS["zstd"] = _Zstd
+
+
+def available_encodings() -> List[str]:
+    """Configured encodings that are installed, in preference order"""
+    return [encoding for encoding in COMPRESSION_ENCODINGS if encoding in COMPRESSORS]
+
+
+def choose_encoding(accept_encoding: str, encodings: Optional[List[str]] = None) -> Optional[str]:
+    """The preferred encoding the client accepts (quality > 0), or None for identity"""
+    accepted, wildcard = set(), False
+    for part in accept_encoding.split(","):
+        token, _, params = part.strip().partition(";")
+        token = token.strip().lower()
+        params = params.strip().replace(" ", "")
+        quality = 1.0
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if quality <= 0:
+            continue
+        if token == "*":
+            wildcard = True
+        elif token:
+            accepted.add(token)
+    for encoding in available_encodings() if encodings is None else encodings:
+        if encoding in accepted or wildcard:
+            return encoding
+    return None
+
+
+def compressible(content_type: str) -> bool:
+    media_type = content_type.partition(";")[0].strip().lower()
+    return any(
+        media_type.startswith(allowed) if allowed.endswith("/") else media_type == allowed
+        for allowed in COMPRESSION_TYPES
+    )
+
+
+class CompressionMiddleware:
+    """ASGI middleware compressing eligible responses with the negotiated encoding"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not COMPRESSION or scope["method"] == "HEAD":
+            await self.app(scope, receive, send)
+            return
+        encoding = choose_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        compressor = None
+        held_start = None  # Start message waiting for the compressed Content-Length
+        flush_chunks = False
+        passthrough = False
+
+        async def send_wrapper(message):
+            nonlocal compressor, held_start, flush_chunks, passthrough
+            if passthrough:
+                await send(message)
+                return
+
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(raw=message["headers"])
+                content_length = headers.get("content-length")
+                if (
+                    message["status"] < 200 or message["status"] in (204, 206, 304)
+                    or "content-encoding" in headers
+                    or not compressible(headers.get("content-type", ""))
+                    or (content_length is not None and int(content_length) < COMPRESSION_MIN_BYTES)
+                ):
+                    passthrough = True
+                    await send(message)
+                    return
+                compressor = COMPRESSORS[encoding]()
+                flush_chunks = headers.get("content-type", "").startswith("text/event-stream")
+                headers["Content-Encoding"] = encoding
+                headers.add_vary_header("Accept-Encoding")
+                etag = headers.get("etag")
+                if etag and not etag.startswith("W/"):
+                    headers["ETag"] = "W/" + etag  # No longer byte-identical to the identity representation
+                if content_length is None:
+                    await send(message)  # Streams get their headers right away, as without compression
+                else:
+                    held_start = message
+                return
+
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if held_start is not None:
+                headers = MutableHeaders(raw=held_start["headers"])
+                if more_body:
+                    del headers["content-length"]
+                    await send(held_start)
+                else:
+                    compressed = compressor.compress(body) + compressor.finish()
+                    headers["Content-Length"] = str(len(compressed))
+                    await send(held_start)
+                    await send({"type": "http.response.body", "body": compressed})
+                    held_start = None
+                    return
+                held_start = None
+
+            chunk = compressor.compress(body)
+            if not more_body:
+                chunk += compressor.finish()
+            elif flush_chunks:
+                chunk += compressor.flush()
+            if chunk or not more_body:
+                await send({"type": "http.response.body", "body": chunk, "more_body": more_body})
+
+        await self.app(scope, receive, send_wrapper)
@@ -0,0 +1,58 @@
+"""
+Per-stage latency: a Prometheus histogram observation, plus an OpenTelemetry span
+
+Spans are only exported when an OTLP endpoint is configured
+(OTEL_EXPORTER_OTLP_ENDPOINT) and the SDK is installed, so by default the hot
+path is a histogram observe only.
+"""
+
+import os
+import time
+from contextlib import contextmanager
+from typing import Callable, ContextManager
+
+
+def _otlp_tracer(service_name: str):
+    """A tracer exporting over OTLP, or None when not configured or not installed"""
+    if not os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT"):
+        return None
+    try:
+        from opentelemetry import trace
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    except ImportError:
+        return None
+    provider = TracerProvider(
+        resource=Resource.create({"service.name": os.getenv("OTEL_SERVICE_NAME", service_name)})
+    )
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    trace.set_tracer_provider(provider)
+    return trace.get_tracer(service_name)
+
+
+def stage_timer(histogram, service_name: str, tracer=None) -> Callable[[str, str], ContextManager[None]]:
+    """
+    Build a service's stage(handler, name) context manager over its stage histogram
+
+    The span, if any, is entered with `with`, so an exception raised in the
+    stage is recorded on it and sets its status to error.
+    """
+    if tracer is None:
+        tracer = _otlp_tracer(service_name)
+
+    @contextmanager
+    def stage(handler: str, name: str):
+        """Time a stage and record it in the stage histogram (and a span if tracing)"""
+        start = time.perf_counter()
+        try:
+            if tracer is None:
+                yield
+            else:
+                with tracer.start_as_current_span(f"{handler}.{name}"):
+                    yield
+        finally:
+            histogram.labels(handler, name).observe(time.perf_counter() - start)
+
+    return stage
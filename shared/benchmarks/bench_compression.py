@@ -0,0 +1,283 @@
+"""
+Benchmark: response compression trade-offs, for both services
+
+  - sse: replays a synthetic chat-service analysis turn - --tokens streamed
+    text deltas, a code output block, --plots base64 PNG frames and the final
+    frame, shaped like the frames of turns.Turn.events - through
+    CompressionMiddleware, once per available encoding and once uncompressed.
+    For each it reports:
+      - wire bytes and the ratio to identity
+      - added latency per frame: time from the app sending a frame to the
+        middleware passing its bytes on (median and max)
+      - frames decodable on arrival: how many frames a client can fully decode
+        from the bytes received so far. With per-frame flushing this is all of
+        them; the "no flush" rows show what a plain streaming compressor would
+        hold back (and the bytes the flushes cost).
+  - storage: fills a throwaway storage-service SQLite database (in a temp
+    directory) with a CSV analysis conversation of --messages answers, every
+    --plot-every-th one carrying a base64 PNG chart, and requests through
+    FastAPI's TestClient:
+      - conversation: GET /api/conversations/{id} (messages and plots)
+      - messages: GET /api/conversations/{id}/messages on a text-only conversation
+      - export: GET /api/export (NDJSON stream)
+    with each available Content-Encoding and identity. For every case it
+    reports the bytes on the wire, the server time of the fastest of --repeat
+    requests (compression included, client-side decoding excluded), and the
+    estimated time to deliver the response over each --mbps link: server time
+    + wire bytes / bandwidth. Compression pays off where that total drops
+    below identity's. Needs storage-service's dependencies.
+
+Usage (from the repository root):
+    python shared/benchmarks/bench_compression.py
+    python shared/benchmarks/bench_compression.py sse --tokens 2000 --plots 3
+    python shared/benchmarks/bench_compression.py storage --messages 200 --mbps 5 50 1000
+"""
+
+import argparse
+import asyncio
+import base64
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import zlib
+from typing import Callable, Dict, List
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+sys.path.insert(0, os.path.join(REPO_DIR, "shared"))
+
+from app_shared import compression  # noqa: E402
+from app_shared.compression import COMPRESSORS, CompressionMiddleware, available_encodings  # noqa: E402
+
+WORDS = (
+    "the revenue grew steadily in the north region while south stayed flat and "
+    "average order value increased by percent over the quarter compared to last year"
+).split()
+
+
+def analysis_frames(tokens: int, plots: int) -> List[bytes]:
+    """SSE frames of one analysis turn, as the turn replay buffer emits them"""
+    rng = random.Random(0)
+    payloads = [{"content": f" {rng.choice(WORDS)}", "done": False} for _ in range(tokens)]
+    table = "\n".join(f"{region:<8}{rng.uniform(1e4, 1e6):>14.2f}" for region in ("north", "south", "east", "west") * 10)
+    payloads.append({"content": f"\n\n**Output:**\n```\n{table}\n```\n\n", "done": False})
+    for _ in range(plots):
+        png = bytes(rng.getrandbits(8) for _ in range(60_000))  # PNG data is already compressed
+        payloads.append({"type": "image", "data": base64.b64encode(png).decode(), "done": False})
+    payloads.append({"content": "", "done": True})
+    turn_id = "6f1c2a9e4b7d4e21a8c03f5d9b2e7a41"
+    return [f"id: {turn_id}:{seq}\ndata: {json.dumps(payload)}\n\n".encode() for seq, payload in enumerate(payloads)]
+
+
+def decoder(encoding: str) -> Callable[[bytes], bytes]:
+    if encoding == "gzip":
+        return zlib.decompressobj(31).decompress
+    if encoding == "br":
+        return compression.brotli.Decompressor().process
+    if encoding == "zstd":
+        return compression.zstandard.ZstdDecompressor().decompressobj().decompress
+    return lambda data: data
+
+
+def decodable_on_arrival(chunks: List[bytes], frames: List[bytes], encoding: str) -> int:
+    """Frames whose bytes were fully decodable right after the chunk carrying them"""
+    decode = decoder(encoding)
+    decoded, count = b"", 0
+    for chunk, frame_end in zip(chunks, _frame_ends(frames)):
+        decoded += decode(chunk)
+        count += len(decoded) >= frame_end
+    return count
+
+
+def _frame_ends(frames: List[bytes]) -> List[int]:
+    ends, total = [], 0
+    for frame in frames:
+        total += len(frame)
+        ends.append(total)
+    return ends
+
+
+async def through_middleware(frames: List[bytes], encoding: str) -> Dict[str, object]:
+    """Send the frames through CompressionMiddleware; chunks out and per-frame added latency"""
+    sent_at: List[float] = []
+    chunks: List[bytes] = []
+    delays: List[float] = []
+
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"text/event-stream; charset=utf-8")]})
+        for frame in frames:
+            sent_at.append(time.perf_counter())
+            await send({"type": "http.response.body", "body": frame, "more_body": True})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    async def send(message):
+        if message["type"] == "http.response.body" and message.get("more_body"):
+            delays.append(time.perf_counter() - sent_at[-1])
+            chunks.append(message["body"])
+        elif message["type"] == "http.response.body":
+            chunks.append(message["body"])
+
+    async def receive():
+        return {"type": "http.disconnect"}
+
+    scope = {"type": "http", "method": "GET", "path": "/api/chat/stream", "headers": [(b"accept-encoding", encoding.encode())]}
+    await CompressionMiddleware(app)(scope, receive, send)
+    return {"chunks": chunks, "delays": delays}
+
+
+def without_flush(frames: List[bytes], encoding: str) -> List[bytes]:
+    """The same stream from a compressor that is never flushed before the end"""
+    compressor = COMPRESSORS[encoding]()
+    chunks = [compressor.compress(frame) for frame in frames]
+    chunks.append(compressor.finish())
+    return chunks
+
+
+def run_sse(tokens: int, plots: int):
+    frames = analysis_frames(tokens, plots)
+    print(f"chat-service SSE compression ({len(frames)} frames)")
+    print(f"\n| {'encoding':<16} | {'wire bytes':>11} | {'ratio':>6} | {'added/frame p50':>15} | {'max':>9} | {'decodable on arrival':>20} |")
+    print(f"|{'-' * 18}|{'-' * 13}|{'-' * 8}|{'-' * 17}|{'-' * 11}|{'-' * 22}|")
+    identity_bytes = None
+    for encoding in ["identity", *available_encodings()]:
+        result = asyncio.run(through_middleware(frames, encoding))
+        wire = sum(len(chunk) for chunk in result["chunks"])
+        identity_bytes = identity_bytes or wire
+        delays = result["delays"]
+        print(
+            f"| {encoding:<16} | {wire:>11,} | {wire / identity_bytes:>6.2f} "
+            f"| {statistics.median(delays) * 1e6:>12.1f} µs | {max(delays) * 1e6:>6.0f} µs "
+            f"| {decodable_on_arrival(result['chunks'], frames, encoding):>12} / {len(frames):<5} |",
+            flush=True,
+        )
+        if encoding != "identity":
+            chunks = without_flush(frames, encoding)
+            wire = sum(len(chunk) for chunk in chunks)
+            print(
+                f"| {encoding + ' (no flush)':<16} | {wire:>11,} | {wire / identity_bytes:>6.2f} "
+                f"| {'-':>15} | {'-':>9} | {decodable_on_arrival(chunks, frames, encoding):>12} / {len(frames):<5} |",
+                flush=True,
+            )
+
+
+def chart_png(seed: int) -> str:
+    """A line chart-like PNG (already deflate-compressed, like real plots), base64 encoded"""
+    from PIL import Image, ImageDraw
+
+    rng = random.Random(seed)
+    image = Image.new("RGB", (1000, 600), "white")
+    draw = ImageDraw.Draw(image)
+    for x in range(80, 960, 80):
+        draw.line([(x, 40), (x, 540)], fill=(230, 230, 230))
+    points = [(80 + i * 4, 300 + rng.randint(-200, 200)) for i in range(220)]
+    draw.line(points, fill=(70, 130, 180), width=2)
+    draw.rectangle([(80, 40), (960, 540)], outline="black")
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+def fill_database(messages: int, plot_every: int) -> Dict[str, int]:
+    """An analysis conversation with plots and a text-only one; returns their ids"""
+    import models
+    from database import SessionLocal
+
+    db = SessionLocal()
+    try:
+        with_plots = models.Conversation(title="analysis with plots")
+        text_only = models.Conversation(title="text only")
+        db.add_all([with_plots, text_only])
+        db.flush()
+        for i in range(messages):
+            role = "user" if i % 2 == 0 else "assistant"
+            content = (
+                f"Question {i}: what is the revenue trend by region?" if role == "user"
+                else f"Answer {i}: revenue grew steadily in the north while the south stayed flat. " * 8
+            )
+            plots = [chart_png(i)] if role == "assistant" and i % plot_every == 1 else None
+            db.add(models.Message(conversation_id=with_plots.id, role=role, content=content, plots=plots))
+            db.add(models.Message(conversation_id=text_only.id, role=role, content=content))
+        db.commit()
+        return {"with_plots": with_plots.id, "text_only": text_only.id}
+    finally:
+        db.close()
+
+
+def measure(client, path: str, encoding: str, repeat: int) -> Dict[str, float]:
+    """Wire bytes and the fastest server time of a GET with the given Accept-Encoding"""
+    def request() -> int:
+        with client.stream("GET", path, headers={"Accept-Encoding": encoding}) as response:
+            response.raise_for_status()
+            served = response.headers.get("content-encoding", "identity")
+            if served != encoding:
+                raise RuntimeError(f"{path}: asked for {encoding}, got {served}")
+            return sum(len(chunk) for chunk in response.iter_raw())
+
+    wire_bytes = request()  # Warm-up
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        request()
+        runs.append(time.perf_counter() - start)
+    return {"bytes": wire_bytes, "seconds": min(runs)}
+
+
+def run_storage(messages: int, plot_every: int, repeat: int, mbps: List[float]):
+    from fastapi.testclient import TestClient
+
+    import main
+
+    ids = fill_database(messages, plot_every)
+    client = TestClient(main.app)
+    cases = {
+        "conversation": f"/api/conversations/{ids['with_plots']}",
+        "messages": f"/api/conversations/{ids['text_only']}/messages",
+        "export": "/api/export",
+    }
+    encodings = ["identity", *available_encodings()]
+    links = "".join(f" | {f'@{rate:g} Mbit/s':>14}" for rate in mbps)
+    print(f"\n| {'case':<13} | {'encoding':<8} | {'wire bytes':>11} | {'ratio':>6} | {'server':>9}{links} |")
+    print(f"|{'-' * 15}|{'-' * 10}|{'-' * 13}|{'-' * 8}|{'-' * 11}" + f"|{'-' * 16}" * len(mbps) + "|")
+    for name, path in cases.items():
+        identity_bytes = None
+        for encoding in encodings:
+            result = measure(client, path, encoding, repeat)
+            identity_bytes = identity_bytes or result["bytes"]
+            totals = "".join(
+                f" | {(result['seconds'] + result['bytes'] * 8 / (rate * 1e6)) * 1000:>11.1f} ms"
+                for rate in mbps
+            )
+            print(
+                f"| {name:<13} | {encoding:<8} | {result['bytes']:>11,} | {result['bytes'] / identity_bytes:>6.2f} "
+                f"| {result['seconds'] * 1000:>6.1f} ms{totals} |",
+                flush=True,
+            )
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("suite", nargs="?", choices=["sse", "storage"], help="run only this suite")
+    parser.add_argument("--tokens", type=int, default=800, help="sse: streamed text deltas")
+    parser.add_argument("--plots", type=int, default=2, help="sse: plot frames (~80 KB of base64 each)")
+    parser.add_argument("--messages", type=int, default=100, help="storage: messages per conversation")
+    parser.add_argument("--plot-every", type=int, default=4, help="storage: one answer in N carries a plot")
+    parser.add_argument("--repeat", type=int, default=5, help="storage: requests per case")
+    parser.add_argument("--mbps", type=float, nargs="+", default=[10, 100, 1000], help="storage: link bandwidths to estimate")
+    args = parser.parse_args()
+
+    if args.suite in (None, "sse"):
+        run_sse(args.tokens, args.plots)
+    if args.suite in (None, "storage"):
+        print(f"\nstorage-service response compression (best of {args.repeat})")
+        sys.path.insert(0, os.path.join(REPO_DIR, "storage-service"))
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)  # The database and upload directories are relative to the working directory
+            run_storage(args.messages, args.plot_every, args.repeat, args.mbps)
+
+
+if __name__ == "__main__":
+    main_cli()
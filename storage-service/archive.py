@@ -0,0 +1,318 @@
+"""
+Cold-conversation archive: messages moved out of SQLite into gzipped NDJSON
+
+Archiving a conversation writes its messages to ARCHIVE_DIR/<id>.ndjson.gz, in
+the export format of transfer.py, then deletes them from the database in small
+batches. The conversation row stays, summary aggregates included, so the
+sidebar is unchanged; archived_at marks it and archived_uploads keeps the
+image URLs its messages reference, so upload garbage collection keeps them.
+Each batch deleted leaves its text (not plots or images) in archived_messages,
+in the same transaction, so archived messages stay searchable (see search.py).
+
+The first request that needs the messages (reading, appending, voting)
+restores them with their original ids and clears archived_at, dropping their
+archived_messages rows. Exports read them from the archive file without
+restoring.
+"""
+
+import gzip
+import json
+import os
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional
+
+from sqlalchemy import delete, inspect, insert, select, text, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+import models
+
+ARCHIVE_DIR = Path(os.getenv("ARCHIVE_DIR", "archive"))
+ARCHIVE_BATCH_ROWS = int(os.getenv("ARCHIVE_BATCH_ROWS", "200"))
+
+conversations_table = models.Conversation.__table__
+messages_table = models.Message.__table__
+archived_messages_table = models.ArchivedMessage.__table__
+
+# Columns added after the first release: name -> DDL type
+_ARCHIVE_COLUMNS = {
+    "archived_at": "DATETIME",
+    "restored_at": "DATETIME",
+    "archived_uploads": "JSON",
+}
+
+
+def encode_json(obj):
+    """json.dumps default for database rows: UTC timestamps with a 'Z' suffix"""
+    if isinstance(obj, datetime):
+        if obj.tzinfo is None:
+            obj = obj.replace(tzinfo=timezone.utc)
+        return obj.isoformat().replace('+00:00', 'Z')
+    raise TypeError(f"Object of type {type(obj)} is not JSON serializable")
+
+
+def parse_timestamp(value: Optional[str]) -> datetime:
+    if not value:
+        return datetime.now(timezone.utc)
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def ndjson_line(kind: str, row) -> str:
+    return json.dumps({"type": kind, **row}, default=encode_json, ensure_ascii=False) + "\n"
+
+
+def init_archive(engine: Engine):
+    """Add the archive columns to databases created before them"""
+    existing = {column["name"] for column in inspect(engine).get_columns("conversations")}
+    with engine.begin() as conn:
+        for name, ddl in _ARCHIVE_COLUMNS.items():
+            if name not in existing:
+                conn.execute(text(f"ALTER TABLE conversations ADD COLUMN {name} {ddl}"))
+        if engine.dialect.name == "sqlite":  # However the conversation is deleted (API, retention)
+            conn.execute(text(
+                """CREATE TRIGGER IF NOT EXISTS archived_messages_conversation_ad AFTER DELETE ON conversations BEGIN
+                    DELETE FROM archived_messages WHERE conversation_id = old.id;
+                END"""
+            ))
+    ARCHIVE_DIR.mkdir(exist_ok=True)
+
+
+def archive_path(conversation_id: int) -> Path:
+    return ARCHIVE_DIR / f"{conversation_id}.ndjson.gz"
+
+
+def archived_lines(conversation_id: int, missing_ok: bool = True) -> Iterator[bytes]:
+    """The message records of an archived conversation, as export lines"""
+    try:
+        f = gzip.open(archive_path(conversation_id), "rb")
+    except FileNotFoundError:
+        if missing_ok:
+            return
+        raise
+    with f:
+        yield from f
+
+
+def archive_conversation(engine: Engine, conversation_id: int, still_cold, pause: Callable[[], None]) -> Optional[int]:
+    """
+    Move a conversation's messages into its archive file; returns the file size, or None if skipped
+
+    still_cold is a SQL condition on conversations re-checked when committing,
+    and pause() runs between batches. Messages are read in id order, ARCHIVE_BATCH_ROWS
+    at a time in separate short reads, so no lock is held while the file is written.
+    The archive only takes effect if no message was added, removed or voted on meanwhile.
+    """
+    c, m = conversations_table, messages_table
+    path = archive_path(conversation_id)
+    temp_path = path.with_name(path.name + ".tmp")
+    seen: Dict[int, Optional[str]] = {}  # id -> feedback, to detect changes while writing
+    image_urls: List[str] = []
+    try:
+        with gzip.open(temp_path, "wt", encoding="utf-8") as out:
+            last_id = 0
+            while True:
+                with Session(engine) as db:
+                    rows = db.execute(
+                        select(m)
+                        .where(m.c.conversation_id == conversation_id, m.c.id > last_id)
+                        .order_by(m.c.id)
+                        .limit(ARCHIVE_BATCH_ROWS)
+                    ).mappings().all()
+                if not rows:
+                    break
+                for row in rows:
+                    out.write(ndjson_line("message", row))
+                    seen[row["id"]] = row["feedback"]
+                    if row["image_url"]:
+                        image_urls.append(row["image_url"])
+                last_id = rows[-1]["id"]
+                pause()
+        if not seen:
+            temp_path.unlink()
+            return None
+        os.replace(temp_path, path)
+
+        with Session(engine) as db:
+            # The UPDATE takes the write lock first, so the check below cannot race a write
+            claimed = db.execute(
+                update(c)
+                .where(c.c.id == conversation_id, c.c.archived_at.is_(None), still_cold)
+                .values(archived_at=models.utcnow(), archived_uploads=image_urls, updated_at=c.c.updated_at)
+            ).rowcount
+            current = dict(db.execute(
+                select(m.c.id, m.c.feedback).where(m.c.conversation_id == conversation_id)
+            ).all())
+            if not claimed or current != seen:
+                db.rollback()
+                path.unlink(missing_ok=True)
+                return None
+            db.commit()
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+
+    delete_archived_messages(engine, conversation_id, pause)
+    return path.stat().st_size if path.exists() else None
+
+
+def delete_archived_messages(engine: Engine, conversation_id: int, pause: Callable[[], None]):
+    """
+    Delete an archived conversation's messages in batches, keeping their text in
+    archived_messages; a restore in between stops this
+    """
+    c, m = conversations_table, messages_table
+    archived = select(c.c.id).where(c.c.id == conversation_id, c.c.archived_at.is_not(None))
+    while True:
+        with Session(engine) as db:
+            batch = select(m.c.id).where(m.c.conversation_id == conversation_id).limit(ARCHIVE_BATCH_ROWS)
+            deleted = db.execute(
+                delete(m)
+                .where(m.c.id.in_(batch), m.c.conversation_id.in_(archived))
+                .returning(m.c.id, m.c.role, m.c.content, m.c.timestamp)
+            ).all()
+            if deleted:
+                db.execute(insert(archived_messages_table), [
+                    {"message_id": row.id, "conversation_id": conversation_id, "role": row.role,
+                     "content": row.content, "timestamp": row.timestamp}
+                    for row in deleted
+                ])
+            db.commit()
+        if not deleted:
+            return
+        pause()
+
+
+def unindexed_archived_ids(db: Session) -> List[int]:
+    """Archived conversations without archived_messages rows (archived before they existed)"""
+    c, a = conversations_table, archived_messages_table
+    return list(db.execute(
+        select(c.c.id).where(
+            c.c.archived_at.is_not(None),
+            ~select(a.c.id).where(a.c.conversation_id == c.c.id).exists(),
+        )
+    ).scalars())
+
+
+def index_archive_file(engine: Engine, conversation_id: int, pause: Callable[[], None]):
+    """Fill archived_messages from an archive file, in batches; a restore in between stops this"""
+    c, m = conversations_table, messages_table
+    batch: List[dict] = []
+
+    def flush() -> bool:
+        with Session(engine) as db:
+            # Takes the write lock, so the conversation cannot be restored before the commit
+            still_archived = db.execute(
+                update(c)
+                .where(c.c.id == conversation_id, c.c.archived_at.is_not(None))
+                .values(updated_at=c.c.updated_at)
+            ).rowcount
+            if not still_archived:
+                return False
+            # Messages an interrupted archive has not deleted yet are still searchable as they are
+            present = set(db.execute(
+                select(m.c.id).where(m.c.id.in_([row["message_id"] for row in batch]), m.c.conversation_id == conversation_id)
+            ).scalars())
+            rows = [row for row in batch if row["message_id"] not in present]
+            if rows:
+                db.execute(insert(archived_messages_table), rows)
+            db.commit()
+        batch.clear()
+        pause()
+        return True
+
+    for raw in archived_lines(conversation_id):
+        record = json.loads(raw)
+        batch.append({
+            "message_id": record["id"],
+            "conversation_id": conversation_id,
+            "role": record["role"],
+            "content": record["content"],
+            "timestamp": parse_timestamp(record.get("timestamp")),
+        })
+        if len(batch) >= ARCHIVE_BATCH_ROWS and not flush():
+            return
+    if batch:
+        flush()
+
+
+def partially_archived_ids(db: Session) -> List[int]:
+    """Archived conversations that still have messages in the database (deletion was interrupted)"""
+    c, m = conversations_table, messages_table
+    return list(db.execute(
+        select(c.c.id).where(
+            c.c.archived_at.is_not(None),
+            select(m.c.id).where(m.c.conversation_id == c.c.id).exists(),
+        )
+    ).scalars())
+
+
+def restore_archived(db: Session, conversation_id: int) -> int:
+    """Move an archived conversation's messages back into the database; returns how many were missing"""
+    c, m = conversations_table, messages_table
+    claimed = db.execute(
+        update(c)
+        .where(c.c.id == conversation_id, c.c.archived_at.is_not(None))
+        .values(archived_at=None, archived_uploads=None, restored_at=models.utcnow(), updated_at=c.c.updated_at)
+    ).rowcount
+    if not claimed:  # Restored by a concurrent request
+        db.rollback()
+        return 0
+    db.execute(delete(archived_messages_table).where(archived_messages_table.c.conversation_id == conversation_id))
+
+    # Messages not deleted yet (an interrupted archive) are kept as they are
+    present = set(db.execute(select(m.c.id).where(m.c.conversation_id == conversation_id)).scalars())
+    restored = 0
+    batch: List[dict] = []
+
+    def flush():
+        nonlocal restored
+        # An id reused by another conversation meanwhile gets a new one
+        taken = set(db.execute(select(m.c.id).where(m.c.id.in_([row["id"] for row in batch]))).scalars())
+        rows = [row for row in batch if row["id"] not in taken]
+        renumbered = [{k: v for k, v in row.items() if k != "id"} for row in batch if row["id"] in taken]
+        for chunk in (rows, renumbered):
+            if chunk:
+                db.execute(insert(m), chunk)
+        restored += len(batch)
+        batch.clear()
+
+    for raw in archived_lines(conversation_id):
+        record = json.loads(raw)
+        if record["id"] in present:
+            continue
+        batch.append({
+            "id": record["id"],
+            "conversation_id": conversation_id,
+            "role": record["role"],
+            "content": record["content"],
+            "image_url": record.get("image_url"),
+            "plots": record.get("plots"),
+            "timestamp": parse_timestamp(record.get("timestamp")),
+            "feedback": record.get("feedback"),
+        })
+        if len(batch) >= ARCHIVE_BATCH_ROWS:
+            flush()
+    if batch:
+        flush()
+    db.commit()
+    archive_path(conversation_id).unlink(missing_ok=True)
+    return restored
+
+
+def restore_if_archived(db: Session, conversation_id: int) -> bool:
+    """Restore the conversation's messages if it is archived; True if it was"""
+    archived_at = db.execute(
+        select(conversations_table.c.archived_at).where(conversations_table.c.id == conversation_id)
+    ).scalar()
+    if archived_at is None:
+        return False
+    restore_archived(db, conversation_id)
+    return True
+
+
+def archived_conversation_ids(db: Session, conversation_id: Optional[int] = None) -> List[int]:
+    statement = select(conversations_table.c.id).where(conversations_table.c.archived_at.is_not(None))
+    if conversation_id is not None:
+        statement = statement.where(conversations_table.c.id == conversation_id)
+    return list(db.execute(statement.order_by(conversations_table.c.id)).scalars())
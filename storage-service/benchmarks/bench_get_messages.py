@@ -0,0 +1,167 @@
+"""
+Benchmark: storage-service get_messages, with a saved baseline and a regression gate
+
+Fills a throwaway SQLite database (in a temp directory) with one conversation
+per --sizes entry, then times for each:
+  - get_messages/query_<n>: the ORM query of the handler
+  - get_messages/endpoint_<n>: the full request, including response
+    validation and JSON rendering, through FastAPI's TestClient
+
+The fastest of --repeat runs is compared against the baseline. Baselines are
+per machine (see .gitignore).
+
+Usage:
+    python benchmarks/bench_get_messages.py --save-baseline
+    python benchmarks/bench_get_messages.py --compare --threshold 0.2
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List
+
+SERVICE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+DEFAULT_BASELINE = os.path.join(SERVICE_DIR, "benchmarks", "baselines", "get_messages.json")
+
+
+def time_case(fn: Callable[[], object], repeat: int) -> Dict[str, float]:
+    fn()  # Warm-up (statement and page caches)
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        runs.append(time.perf_counter() - start)
+    return {"min": min(runs), "median": statistics.median(runs), "calls": repeat}
+
+
+def fill_database(sizes: List[int]) -> Dict[int, int]:
+    """One conversation of n messages per size; returns {n: conversation_id}"""
+    import models
+    from database import SessionLocal
+    from sqlalchemy import insert
+
+    db = SessionLocal()
+    conversations = {}
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    try:
+        for size in sizes:
+            conversation = models.Conversation(title=f"{size} messages")
+            db.add(conversation)
+            db.flush()
+            for offset in range(0, size, 10_000):
+                db.execute(insert(models.Message.__table__), [
+                    {
+                        "conversation_id": conversation.id,
+                        "role": "user" if i % 2 == 0 else "assistant",
+                        "content": f"Message {i}: " + "some typical chat content about the data. " * 6,
+                        "timestamp": start + timedelta(seconds=i),
+                    }
+                    for i in range(offset, min(size, offset + 10_000))
+                ])
+            conversations[size] = conversation.id
+        db.commit()
+    finally:
+        db.close()
+    return conversations
+
+
+def run_suite(sizes: List[int], repeat: int) -> Dict[str, Dict[str, float]]:
+    from fastapi.testclient import TestClient
+
+    import main
+    from database import SessionLocal
+
+    conversations = fill_database(sizes)
+    client = TestClient(main.app)
+    results = {}
+    for size, conversation_id in conversations.items():
+        def query(conversation_id=conversation_id):
+            db = SessionLocal()
+            try:
+                return main.get_messages(conversation_id, db)
+            finally:
+                db.close()
+
+        def endpoint(conversation_id=conversation_id):
+            response = client.get(f"/api/conversations/{conversation_id}/messages")
+            response.raise_for_status()
+
+        for name, fn in ((f"get_messages/query_{size}", query), (f"get_messages/endpoint_{size}", endpoint)):
+            results[name] = time_case(fn, repeat)
+            print(f"  {name:<34} {results[name]['min'] * 1000:>10.1f} ms", flush=True)
+    return results
+
+
+def environment() -> Dict[str, str]:
+    import sqlalchemy
+    import sqlite3
+
+    return {
+        "python": platform.python_version(),
+        "sqlalchemy": sqlalchemy.__version__,
+        "sqlite": sqlite3.sqlite_version,
+        "machine": platform.machine(),
+    }
+
+
+def compare(results: Dict[str, Dict[str, float]], baseline: dict, threshold: float) -> List[str]:
+    """Print current vs baseline and return the cases slower than the threshold allows"""
+    for key, value in baseline.get("environment", {}).items():
+        if environment().get(key) != value:
+            print(f"warning: baseline {key} was {value}, now {environment().get(key)}")
+    regressions = []
+    print(f"\n| {'case':<34} | {'baseline':>11} | {'current':>11} | {'change':>7} |")
+    print(f"|{'-' * 36}|{'-' * 13}|{'-' * 13}|{'-' * 9}|")
+    for name, current in results.items():
+        previous = baseline["results"].get(name)
+        if previous is None:
+            print(f"| {name:<34} | {'-':>11} | {current['min'] * 1000:>8.1f} ms | {'new':>7} |")
+            continue
+        change = current["min"] / previous["min"] - 1
+        flag = " !" if change > threshold else ""
+        print(f"| {name:<34} | {previous['min'] * 1000:>8.1f} ms | {current['min'] * 1000:>8.1f} ms | {change:>+6.0%}{flag} |")
+        if change > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000], help="messages per conversation")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="write the results as the new baseline")
+    parser.add_argument("--compare", action="store_true", help="exit 1 if a case regressed beyond --threshold")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown (0.2 = 20%%)")
+    args = parser.parse_args()
+    baseline_path = os.path.abspath(args.baseline)
+
+    print(f"storage-service get_messages (best of {args.repeat})")
+    sys.path.insert(0, SERVICE_DIR)
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)  # The database and upload directories are relative to the working directory
+        results = run_suite(sorted(args.sizes), args.repeat)
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(baseline_path), exist_ok=True)
+        with open(baseline_path, "w") as f:
+            json.dump({"environment": environment(), "results": results}, f, indent=2)
+        print(f"\nBaseline saved to {baseline_path}")
+    if args.compare:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) over {args.threshold:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+        print(f"\nNo regressions over {args.threshold:.0%}")
+
+
+if __name__ == "__main__":
+    main_cli()
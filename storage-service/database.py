@@ -1,14 +1,39 @@
-from sqlalchemy import create_engine
+import os
+
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
+from archive import init_archive
 from models import Base
+from search import init_search_index
+from summaries import init_summaries
 
 DATABASE_URL = "sqlite:///./chat_history.db"
+# How long a write waits for another writer's transaction before "database is locked"
+SQLITE_BUSY_TIMEOUT_SECONDS = float(os.getenv("SQLITE_BUSY_TIMEOUT_SECONDS", "10"))
+WAL_SIZE_LIMIT_BYTES = int(os.getenv("WAL_SIZE_LIMIT_BYTES", str(64 * 1024 * 1024)))
 
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+engine = create_engine(
+    DATABASE_URL,
+    connect_args={"check_same_thread": False, "timeout": SQLITE_BUSY_TIMEOUT_SECONDS},
+)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+@event.listens_for(engine, "connect")
+def configure_connection(dbapi_connection, connection_record):
+    # WAL: readers, such as a streaming export, no longer block writers (nor writers readers)
+    cursor = dbapi_connection.cursor()
+    # Lets maintenance return free pages in small steps; only takes effect before the first
+    # table exists (or at the next VACUUM), so it comes before WAL mode creates the file
+    cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    cursor.execute("PRAGMA journal_mode = WAL")
+    cursor.execute(f"PRAGMA journal_size_limit = {WAL_SIZE_LIMIT_BYTES}")  # Truncate the WAL after checkpoints
+    cursor.close()
+
 def init_db():
     Base.metadata.create_all(bind=engine)
+    init_summaries(engine)
+    init_search_index(engine)
+    init_archive(engine)
 
 def get_db():
     db = SessionLocal()
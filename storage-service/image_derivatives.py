@@ -0,0 +1,93 @@
+"""
+Upload-time image derivatives
+
+Every content-addressed image upload gets two re-encoded JPEG siblings:
+  - <sha256>.vision.jpg: downscaled to the largest resolution vision models
+    actually use (longest side VISION_MAX_SIDE, shortest side VISION_SHORT_SIDE)
+  - <sha256>.thumb.jpg: a small preview for the UI
+Both are derived from immutable content, so they are generated once and cached
+forever by the /uploads mount.
+"""
+
+import os
+from pathlib import Path
+
+from PIL import Image, ImageOps
+
+from upload_store import UPLOAD_DIR, new_temp_path
+
+# OpenAI high-detail vision fits images in 2048x2048 and then scales the
+# shortest side to 768px; anything larger is discarded by the provider anyway
+VISION_MAX_SIDE = int(os.getenv("VISION_MAX_SIDE", "2048"))
+VISION_SHORT_SIDE = int(os.getenv("VISION_SHORT_SIDE", "768"))
+VISION_JPEG_QUALITY = int(os.getenv("VISION_JPEG_QUALITY", "85"))
+THUMBNAIL_SIZE = int(os.getenv("THUMBNAIL_SIZE", "512"))
+THUMBNAIL_JPEG_QUALITY = int(os.getenv("THUMBNAIL_JPEG_QUALITY", "75"))
+
+# Guard against decompression bombs in user uploads
+Image.MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", str(100_000_000)))
+
+
+def vision_filename(sha256: str) -> str:
+    return f"{sha256}.vision.jpg"
+
+
+def thumbnail_filename(sha256: str) -> str:
+    return f"{sha256}.thumb.jpg"
+
+
+def _to_rgb(image: Image.Image) -> Image.Image:
+    """Flatten transparency onto white so the image can be stored as JPEG"""
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        return background
+    return image.convert("RGB")
+
+
+def _vision_scale(width: int, height: int) -> float:
+    return min(1.0, VISION_MAX_SIDE / max(width, height), VISION_SHORT_SIDE / min(width, height))
+
+
+def _save_jpeg(image: Image.Image, destination: Path, quality: int):
+    temp_path = new_temp_path()
+    try:
+        image.save(temp_path, format="JPEG", quality=quality, optimize=True, progressive=True)
+        os.replace(temp_path, destination)
+    finally:
+        temp_path.unlink(missing_ok=True)
+
+
+def generate_derivatives(source: Path, sha256: str) -> dict:
+    """Write the vision and thumbnail derivatives (if missing) and return their URLs"""
+    vision_path = UPLOAD_DIR / vision_filename(sha256)
+    thumbnail_path = UPLOAD_DIR / thumbnail_filename(sha256)
+
+    if not (vision_path.exists() and thumbnail_path.exists()):
+        with Image.open(source) as original:
+            # The scale is symmetric in width/height, so EXIF rotation does not change it
+            scale = _vision_scale(*original.size)
+            target = (max(1, round(original.width * scale)), max(1, round(original.height * scale)))
+            # Let the JPEG decoder skip detail we are about to throw away
+            original.draft("RGB", target)
+            image = _to_rgb(ImageOps.exif_transpose(original))
+
+        if (image.width > image.height) != (target[0] > target[1]):
+            target = (target[1], target[0])  # Rotated by EXIF
+        if image.width * image.height > target[0] * target[1]:
+            vision = image.resize(target, Image.Resampling.LANCZOS)
+        else:
+            vision = image
+        if not vision_path.exists():
+            _save_jpeg(vision, vision_path, VISION_JPEG_QUALITY)
+
+        if not thumbnail_path.exists():
+            thumbnail = vision.copy()
+            thumbnail.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE), Image.Resampling.LANCZOS)
+            _save_jpeg(thumbnail, thumbnail_path, THUMBNAIL_JPEG_QUALITY)
+
+    return {
+        "vision_url": f"/uploads/{vision_filename(sha256)}",
+        "thumbnail_url": f"/uploads/{thumbnail_filename(sha256)}",
+    }
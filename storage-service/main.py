@@ -1,25 +1,44 @@
-from fastapi import FastAPI, Depends, HTTPException, UploadFile, File
+from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, Request, Header
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from sqlalchemy.orm import Session
-from typing import List
+from typing import List, Literal, Optional
+from contextlib import asynccontextmanager
 from datetime import datetime, timezone
 import os
-import shutil
 from pathlib import Path
-import uuid
 import json
+import asyncio
 
 import models
 import schemas
+import search
+import summaries
+from archive import archive_path, restore_archived, restore_if_archived
 from database import engine, get_db, init_db
+from app_shared.compression import CompressionMiddleware
+from static_files import UploadStaticFiles, precompress_pool, schedule_precompress
+from transfer import NDJSON_MEDIA_TYPE, ImportFormatError, export_ndjson, import_ndjson, spool_request_body
+from image_derivatives import generate_derivatives
+from maintenance import MaintenanceScheduler
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, MetricsMiddleware, render_latest, stage
+from upload_store import (
+    MAX_UPLOAD_BYTES,
+    UPLOAD_DIR,
+    ChunkedUploadError,
+    UploadTooLarge,
+    abort_chunked_upload,
+    complete_chunked_upload,
+    create_chunked_upload,
+    load_manifest,
+    received_chunks,
+    safe_extension,
+    store_chunk,
+    store_upload,
+)
 
 init_db()
 
-UPLOAD_DIR = Path("uploads")
-UPLOAD_DIR.mkdir(exist_ok=True)
-
 # Custom JSON encoder to ensure UTC timestamps have 'Z' suffix
 class CustomJSONResponse(JSONResponse):
     def render(self, content) -> bytes:
@@ -43,13 +62,23 @@ class CustomJSONResponse(JSONResponse):
             return obj.isoformat().replace('+00:00', 'Z')
         raise TypeError(f"Object of type {type(obj)} is not JSON serializable")
 
+maintenance = MaintenanceScheduler(engine)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    maintenance.start()
+    yield
+    await asyncio.to_thread(maintenance.stop)  # Finish the current batch
+    await asyncio.to_thread(precompress_pool.shutdown, wait=True, cancel_futures=True)
+
 app = FastAPI(
     title="Storage Service", 
     version="1.0.0",
-    default_response_class=CustomJSONResponse
+    default_response_class=CustomJSONResponse,
+    lifespan=lifespan
 )
 
-app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
+app.mount("/uploads", UploadStaticFiles(directory="uploads"), name="uploads")
 
 app.add_middleware(
     CORSMiddleware,
@@ -58,11 +87,18 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(MetricsMiddleware)
 
 @app.get("/health")
 def health_check():
     return {"status": "healthy", "service": "storage"}
 
+@app.get("/metrics")
+def metrics():
+    """Prometheus scrape endpoint"""
+    return Response(content=render_latest(), media_type=METRICS_CONTENT_TYPE)
+
 @app.post("/api/conversations", response_model=schemas.Conversation)
 def create_conversation(
     conversation: schemas.ConversationCreate,
@@ -85,6 +121,18 @@ def list_conversations(
     ).offset(skip).limit(limit).all()
     return conversations
 
+@app.get("/api/conversations/summaries", response_model=List[schemas.ConversationSummary])
+def list_conversation_summaries(
+    skip: int = 0,
+    limit: int = 1000,
+    db: Session = Depends(get_db)
+):
+    """Conversations with message counts, last activity and feedback tallies, for the sidebar"""
+    if limit < 1 or limit > summaries.SUMMARY_LIST_MAX or skip < 0:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {summaries.SUMMARY_LIST_MAX}, skip at least 0")
+    with stage("list_summaries", "query"):
+        return summaries.list_summaries(db, limit, skip)
+
 @app.get("/api/conversations/{conversation_id}", response_model=schemas.ConversationWithMessages)
 def get_conversation(
     conversation_id: int,
@@ -95,6 +143,9 @@ def get_conversation(
     ).first()
     if not conversation:
         raise HTTPException(status_code=404, detail="Conversation not found")
+    if conversation.archived_at is not None:
+        with stage("get_conversation", "restore"):
+            restore_archived(db, conversation_id)
     return conversation
 
 @app.post("/api/conversations/{conversation_id}/messages", response_model=schemas.Message)
@@ -108,6 +159,8 @@ def add_message(
     ).first()
     if not conversation:
         raise HTTPException(status_code=404, detail="Conversation not found")
+    if conversation.archived_at is not None:
+        restore_archived(db, conversation_id)
     
     db_message = models.Message(
         conversation_id=conversation_id,
@@ -116,8 +169,10 @@ def add_message(
     db.add(db_message)
     
     conversation.updated_at = datetime.now(timezone.utc)
+    summaries.record_message(conversation, db_message)
     
-    db.commit()
+    with stage("add_message", "commit"):
+        db.commit()
     db.refresh(db_message)
     return db_message
 
@@ -126,11 +181,86 @@ def get_messages(
     conversation_id: int,
     db: Session = Depends(get_db)
 ):
-    messages = db.query(models.Message).filter(
-        models.Message.conversation_id == conversation_id
-    ).order_by(models.Message.timestamp).all()
+    with stage("get_messages", "restore"):
+        restore_if_archived(db, conversation_id)
+    with stage("get_messages", "query"):
+        messages = db.query(models.Message).filter(
+            models.Message.conversation_id == conversation_id
+        ).order_by(models.Message.timestamp).all()
     return messages
 
+@app.get("/api/conversations/{conversation_id}/export")
+def export_conversation(
+    conversation_id: int,
+    db: Session = Depends(get_db)
+):
+    """Stream one conversation and its messages as NDJSON"""
+    exists = db.query(models.Conversation.id).filter(
+        models.Conversation.id == conversation_id
+    ).first()
+    if not exists:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    return StreamingResponse(
+        export_ndjson(conversation_id),
+        media_type=NDJSON_MEDIA_TYPE,
+        headers={"Content-Disposition": f'attachment; filename="conversation-{conversation_id}.ndjson"'},
+    )
+
+@app.get("/api/export")
+def export_all():
+    """Stream every conversation and message as NDJSON (constant memory)"""
+    return StreamingResponse(
+        export_ndjson(),
+        media_type=NDJSON_MEDIA_TYPE,
+        headers={"Content-Disposition": 'attachment; filename="conversations.ndjson"'},
+    )
+
+@app.post("/api/import")
+async def import_conversations(request: Request):
+    """Import an NDJSON export in batches, all or nothing; conversations are given new ids"""
+    temp_path = await spool_request_body(request)
+    try:
+        with stage("import", "insert"):
+            counts = await asyncio.to_thread(import_ndjson, temp_path)
+    except ImportFormatError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    finally:
+        temp_path.unlink(missing_ok=True)
+    return counts
+
+@app.get("/api/search", response_model=schemas.SearchResults)
+def search_history(
+    q: str,
+    limit: int = 20,
+    offset: int = 0,
+    conversation_id: Optional[int] = None,
+    order: Literal["relevance", "recent"] = "relevance",
+    db: Session = Depends(get_db)
+):
+    """Ranked full-text search over message content and conversation titles"""
+    if not search.search_available:
+        raise HTTPException(status_code=503, detail="Full-text search is not available")
+    limit = max(1, min(limit, 100))
+    offset = max(0, offset)
+    if not search.query_terms(q):
+        return {"query": q, "order": order}
+    
+    with stage("search", "query"):
+        # One extra row tells whether there is a next page
+        messages, truncated = search.search_messages(db, q, limit + 1, offset, conversation_id, order)
+        conversations = []
+        if offset == 0 and conversation_id is None:
+            conversations = search.search_conversations(db, q, limit)
+    return {
+        "query": q,
+        "conversations": conversations,
+        "messages": messages[:limit],
+        "next_offset": offset + limit if len(messages) > limit else None,
+        "order": order,
+        "truncated": truncated,
+        "rank_window": search.SEARCH_RANK_WINDOW if truncated else None,
+    }
+
 @app.delete("/api/conversations/{conversation_id}")
 def delete_conversation(
     conversation_id: int,
@@ -144,6 +274,7 @@ def delete_conversation(
     
     db.delete(conversation)
     db.commit()
+    archive_path(conversation_id).unlink(missing_ok=True)
     return {"message": "Conversation deleted"}
 
 @app.patch("/api/conversations/{conversation_id}")
@@ -186,39 +317,61 @@ def update_message_feedback(
     # Validate feedback value
     if feedback_update.feedback not in [None, "like", "dislike"]:
         raise HTTPException(status_code=400, detail="Feedback must be 'like', 'dislike', or null")
+    if db_message.conversation.archived_at is not None:  # Being archived right now
+        restore_archived(db, db_message.conversation_id)
     
+    summaries.record_feedback(db_message.conversation, db_message.feedback, feedback_update.feedback)
     db_message.feedback = feedback_update.feedback
     db.commit()
     db.refresh(db_message)
     return db_message
 
+def check_upload_size(request: Request):
+    """Reject oversized uploads from Content-Length before reading the body"""
+    content_length = request.headers.get("content-length")
+    # Allow some slack for multipart boundaries and headers
+    if content_length and content_length.isdigit() and int(content_length) > MAX_UPLOAD_BYTES + 64 * 1024:
+        raise HTTPException(status_code=413, detail=f"File exceeds the {MAX_UPLOAD_BYTES // 1024**2} MB upload limit")
+
 @app.post("/api/upload-image")
 async def upload_image(
+    request: Request,
     file: UploadFile = File(...),
     db: Session = Depends(get_db)
 ):
     # Validate file type
     if not file.content_type or not file.content_type.startswith('image/'):
         raise HTTPException(status_code=400, detail="File must be an image (PNG, JPG, etc.)")
+    check_upload_size(request)
     
-    # Generate unique filename
-    file_extension = file.filename.split('.')[-1] if '.' in file.filename else 'png'
-    unique_filename = f"{uuid.uuid4()}.{file_extension}"
-    file_path = UPLOAD_DIR / unique_filename
-    
-    # Save file
+    # Stream to a content-addressed file; identical re-uploads return the existing one
     try:
-        with file_path.open("wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        with stage("upload_image", "write_file"):
+            stored = await store_upload(file, safe_extension(file.filename, 'png'))
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error saving file: {str(e)}")
     
+    # Downscaled vision copy and UI thumbnail; decoding is CPU-bound, keep it off the loop
+    try:
+        with stage("upload_image", "derivatives"):
+            derivatives = await asyncio.to_thread(generate_derivatives, stored.path, stored.sha256)
+    except Exception:
+        derivatives = {"vision_url": None, "thumbnail_url": None}  # Consumers fall back to the original
+    
     # Return URL
-    image_url = f"/uploads/{unique_filename}"
-    return {"image_url": image_url}
+    return {
+        "image_url": stored.url,
+        **derivatives,
+        "sha256": stored.sha256,
+        "size": stored.size,
+        "deduplicated": stored.deduplicated
+    }
 
 @app.post("/api/upload-csv")
 async def upload_csv(
+    request: Request,
     file: UploadFile = File(...),
     db: Session = Depends(get_db)
 ):
@@ -226,27 +379,89 @@ async def upload_csv(
     # Validate file type
     if not file.filename.endswith('.csv'):
         raise HTTPException(status_code=400, detail="File must be a CSV file")
+    check_upload_size(request)
     
-    # Generate unique filename
-    unique_filename = f"{uuid.uuid4()}.csv"
-    file_path = UPLOAD_DIR / unique_filename
-    
-    # Save file
+    # Stream to a content-addressed file; identical re-uploads return the existing one
     try:
-        with file_path.open("wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        with stage("upload_csv", "write_file"):
+            stored = await store_upload(file, 'csv')
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error saving file: {str(e)}")
+    # A precompressed sibling lets /uploads serve CSV previews as br/gzip
+    schedule_precompress(stored.path)
     
     # Return file path (absolute path for code executor)
-    csv_path = str(file_path.absolute())
-    csv_url = f"/uploads/{unique_filename}"
     return {
-        "csv_path": csv_path,
-        "csv_url": csv_url,
-        "filename": file.filename
+        "csv_path": str(stored.path.absolute()),
+        "csv_url": stored.url,
+        "filename": file.filename,
+        "sha256": stored.sha256,
+        "size": stored.size,
+        "deduplicated": stored.deduplicated
+    }
+
+@app.post("/api/uploads", response_model=schemas.ChunkedUploadStatus)
+def init_chunked_upload(upload: schemas.ChunkedUploadCreate):
+    """Start a resumable chunked CSV upload"""
+    if not upload.filename.endswith('.csv'):
+        raise HTTPException(status_code=400, detail="File must be a CSV file")
+    try:
+        manifest = create_chunked_upload(upload.filename, upload.size, upload.chunk_size, upload.sha256)
+    except ChunkedUploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    return {**manifest, "received": []}
+
+@app.get("/api/uploads/{upload_id}", response_model=schemas.ChunkedUploadStatus)
+def get_chunked_upload(upload_id: str):
+    """Upload status; `received` lists the chunks already stored so clients can resume"""
+    try:
+        return {**load_manifest(upload_id), "received": received_chunks(upload_id)}
+    except ChunkedUploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+
+@app.put("/api/uploads/{upload_id}/chunks/{index}")
+async def put_chunk(
+    upload_id: str,
+    index: int,
+    request: Request,
+    x_chunk_sha256: Optional[str] = Header(None)
+):
+    """Store one chunk (raw request body). Chunks may be sent in parallel and re-sent safely."""
+    try:
+        with stage("put_chunk", "write_file"):
+            return await store_chunk(upload_id, index, request.stream(), x_chunk_sha256)
+    except ChunkedUploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+
+@app.post("/api/uploads/{upload_id}/complete")
+async def complete_upload(upload_id: str):
+    """Assemble the chunks; returns the same contract as /api/upload-csv"""
+    try:
+        with stage("complete_upload", "assemble"):
+            manifest, stored = await complete_chunked_upload(upload_id)
+    except ChunkedUploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    schedule_precompress(stored.path)
+    return {
+        "csv_path": str(stored.path.absolute()),
+        "csv_url": stored.url,
+        "filename": manifest["filename"],
+        "sha256": stored.sha256,
+        "size": stored.size,
+        "deduplicated": stored.deduplicated
     }
 
+@app.delete("/api/uploads/{upload_id}")
+def abort_upload(upload_id: str):
+    """Abandon a chunked upload and delete its chunks"""
+    try:
+        abort_chunked_upload(upload_id)
+    except ChunkedUploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    return {"message": "Upload aborted"}
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8002)
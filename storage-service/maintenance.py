@@ -0,0 +1,473 @@
+"""
+Background maintenance: upload garbage collection, retention, archiving and vacuum
+
+MaintenanceScheduler runs these jobs one after another on a background thread,
+MAINTENANCE_STARTUP_DELAY_SECONDS after startup and then every
+MAINTENANCE_INTERVAL_SECONDS:
+
+  - retention: with RETENTION_DAYS, deletes conversations inactive for longer
+  - archive: with ARCHIVE_AFTER_DAYS, moves the messages of conversations
+    inactive for longer into compressed archive files (see archive.py)
+  - uploads: deletes image uploads that no message references (with their
+    derivatives and precompressed siblings) once they are older than
+    ORPHAN_GRACE_SECONDS, plus stale temp files and abandoned chunked uploads.
+    chat-service reads datasets straight from disk, so no row references them;
+    they are only deleted with DATASET_RETENTION_DAYS, counted from the last upload
+  - vacuum: returns free database pages to the filesystem with incremental
+    vacuum, refreshes query planner statistics and merges search index segments
+
+Jobs work in small batches: MAINTENANCE_BATCH files or rows, one conversation,
+or VACUUM_STEP_PAGES pages. After each batch a job sleeps
+MAINTENANCE_PAUSE_SECONDS and then waits until no request is in flight. The
+wait is capped at MAINTENANCE_IDLE_WAIT_SECONDS, so a busy service is still
+maintained. SQLite's write lock is held for milliseconds at a time.
+"""
+
+import logging
+import mimetypes
+import os
+import shutil
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Dict, List, Optional, Set
+
+from sqlalchemy import and_, delete, or_, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+import models
+import search
+from archive import (
+    ARCHIVE_DIR,
+    archive_conversation,
+    archive_path,
+    delete_archived_messages,
+    index_archive_file,
+    partially_archived_ids,
+    unindexed_archived_ids,
+)
+from metrics import (
+    MAINTENANCE_DEFERRED_SECONDS,
+    MAINTENANCE_DURATION,
+    MAINTENANCE_FAILURES,
+    MAINTENANCE_ITEMS,
+    MAINTENANCE_RECLAIMED_BYTES,
+    requests_inflight,
+)
+from summaries import refresh_summaries
+from upload_store import CHUNKED_DIR, CONTENT_NAME_RE, UPLOAD_DIR, UPLOAD_TMP_DIR, is_completing
+
+logger = logging.getLogger(__name__)
+
+MAINTENANCE = os.getenv("MAINTENANCE", "1") == "1"
+MAINTENANCE_INTERVAL_SECONDS = float(os.getenv("MAINTENANCE_INTERVAL_SECONDS", "3600"))
+MAINTENANCE_STARTUP_DELAY_SECONDS = float(os.getenv("MAINTENANCE_STARTUP_DELAY_SECONDS", "300"))
+MAINTENANCE_BATCH = int(os.getenv("MAINTENANCE_BATCH", "200"))
+MAINTENANCE_PAUSE_SECONDS = float(os.getenv("MAINTENANCE_PAUSE_SECONDS", "0.05"))
+MAINTENANCE_IDLE_WAIT_SECONDS = float(os.getenv("MAINTENANCE_IDLE_WAIT_SECONDS", "30"))
+
+# Images are uploaded before the message that references them is saved
+ORPHAN_GRACE_SECONDS = float(os.getenv("ORPHAN_GRACE_SECONDS", str(24 * 3600)))
+UPLOAD_SESSION_TTL_SECONDS = float(os.getenv("UPLOAD_SESSION_TTL_SECONDS", str(7 * 24 * 3600)))
+DATASET_RETENTION_DAYS = float(os.getenv("DATASET_RETENTION_DAYS", "0"))  # 0 keeps datasets forever
+RETENTION_DAYS = float(os.getenv("RETENTION_DAYS", "0"))  # 0 keeps conversations forever
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", "0"))  # 0 disables archiving
+
+VACUUM_STEP_PAGES = int(os.getenv("VACUUM_STEP_PAGES", "1000"))
+# Databases created before incremental auto-vacuum need one full VACUUM, which blocks
+# every request while it runs; it is only done automatically below this size
+VACUUM_FULL_MAX_BYTES = int(os.getenv("VACUUM_FULL_MAX_BYTES", str(64 * 1024**2)))
+FTS_MERGE_PAGES = 500
+FTS_MERGE_MAX_STEPS = 100
+
+PRECOMPRESSED_SUFFIXES = (".gz", ".br")
+REFERENCE_SCAN_ROWS = 5000
+
+conversations_table = models.Conversation.__table__
+messages_table = models.Message.__table__
+
+
+class _Stopped(Exception):
+    """The scheduler is shutting down"""
+
+
+class JobRun:
+    """One run of a job: throttling between batches and the metrics of what it freed"""
+
+    def __init__(self, job: str, stop: threading.Event):
+        self.job = job
+        self._stop = stop
+        self._ticks = 0
+        self.items = 0
+        self.reclaimed = 0
+
+    def record(self, items: int = 1, reclaimed: int = 0):
+        self.items += items
+        self.reclaimed += reclaimed
+        MAINTENANCE_ITEMS.labels(self.job).inc(items)
+        if reclaimed > 0:
+            MAINTENANCE_RECLAIMED_BYTES.labels(self.job).inc(reclaimed)
+
+    def pause(self):
+        """Between batches: a short sleep, then wait for in-flight requests to finish"""
+        if self._stop.wait(MAINTENANCE_PAUSE_SECONDS):
+            raise _Stopped()
+        self.wait_for_idle()
+
+    def tick(self):
+        """Count one unit of file work; pause every MAINTENANCE_BATCH units"""
+        self._ticks += 1
+        if self._ticks % MAINTENANCE_BATCH == 0:
+            self.pause()
+
+    def wait_for_idle(self):
+        start = time.monotonic()
+        while requests_inflight() > 0 and time.monotonic() - start < MAINTENANCE_IDLE_WAIT_SECONDS:
+            if self._stop.wait(0.01):
+                raise _Stopped()
+        waited = time.monotonic() - start
+        if waited >= 0.01:
+            MAINTENANCE_DEFERRED_SECONDS.inc(waited)
+
+
+def _days_ago(days: float) -> datetime:
+    return datetime.now(timezone.utc) - timedelta(days=days)
+
+
+def _inactive_since(cutoff: datetime):
+    """Conversations with no new message or restore since cutoff"""
+    c = conversations_table
+    return and_(c.c.updated_at < cutoff, or_(c.c.restored_at.is_(None), c.c.restored_at < cutoff))
+
+
+# --- Retention ---------------------------------------------------------------
+
+def apply_retention(engine: Engine, run: JobRun):
+    """Delete conversations inactive for RETENTION_DAYS, messages in batches"""
+    if RETENTION_DAYS <= 0:
+        return
+    c, m = conversations_table, messages_table
+    cutoff = _days_ago(RETENTION_DAYS)
+    last_id = 0
+    while True:
+        with Session(engine) as db:
+            ids = db.execute(
+                select(c.c.id).where(c.c.id > last_id, _inactive_since(cutoff)).order_by(c.c.id).limit(MAINTENANCE_BATCH)
+            ).scalars().all()
+        if not ids:
+            return
+        for conversation_id in ids:
+            # Every batch re-checks the conversation, so one that becomes active again is kept
+            still_inactive = select(c.c.id).where(c.c.id == conversation_id, _inactive_since(cutoff))
+            deleted_any = False
+            while True:
+                with Session(engine) as db:
+                    batch = select(m.c.id).where(m.c.conversation_id == conversation_id).limit(MAINTENANCE_BATCH)
+                    deleted = db.execute(
+                        delete(m).where(m.c.id.in_(batch), m.c.conversation_id.in_(still_inactive))
+                    ).rowcount
+                    db.commit()
+                if not deleted:
+                    break
+                deleted_any = True
+                run.pause()
+            with Session(engine) as db:
+                removed = db.execute(delete(c).where(c.c.id == conversation_id, _inactive_since(cutoff))).rowcount
+                if not removed and deleted_any:
+                    refresh_summaries(db, [conversation_id])  # Kept after all: recount what is left
+                db.commit()
+            if removed:
+                path = archive_path(conversation_id)
+                size = path.stat().st_size if path.exists() else 0
+                path.unlink(missing_ok=True)
+                run.record(1, size)
+            run.pause()
+        last_id = ids[-1]
+
+
+# --- Archive -----------------------------------------------------------------
+
+def archive_cold_conversations(engine: Engine, run: JobRun):
+    """Move conversations inactive for ARCHIVE_AFTER_DAYS into archive files"""
+    c = conversations_table
+    with Session(engine) as db:
+        archived = set(db.execute(select(c.c.id).where(c.c.archived_at.is_not(None))).scalars())
+        unfinished = partially_archived_ids(db)
+        unindexed = unindexed_archived_ids(db)
+    # Files of conversations deleted or restored meanwhile, and writes cut short
+    for path in ARCHIVE_DIR.iterdir():
+        name = path.name
+        stray = name.endswith(".tmp") or (
+            name.endswith(".ndjson.gz") and name.split(".", 1)[0].isdigit() and int(name.split(".", 1)[0]) not in archived
+        )
+        if stray and path.is_file():
+            size = path.stat().st_size
+            path.unlink(missing_ok=True)
+            run.record(1, size)
+            run.tick()
+    for conversation_id in unindexed:
+        index_archive_file(engine, conversation_id, run.pause)
+    for conversation_id in unfinished:
+        delete_archived_messages(engine, conversation_id, run.pause)
+
+    if ARCHIVE_AFTER_DAYS <= 0:
+        return
+    cutoff = _days_ago(ARCHIVE_AFTER_DAYS)
+    last_id = 0
+    while True:
+        with Session(engine) as db:
+            ids = db.execute(
+                select(c.c.id)
+                .where(c.c.id > last_id, c.c.archived_at.is_(None), c.c.message_count > 0, _inactive_since(cutoff))
+                .order_by(c.c.id)
+                .limit(MAINTENANCE_BATCH)
+            ).scalars().all()
+        if not ids:
+            return
+        for conversation_id in ids:
+            if archive_conversation(engine, conversation_id, _inactive_since(cutoff), run.pause) is not None:
+                run.record(1)  # The freed pages are returned by the vacuum job
+            run.pause()
+        last_id = ids[-1]
+
+
+# --- Uploads -----------------------------------------------------------------
+
+def _strip_precompressed(name: str) -> str:
+    for suffix in PRECOMPRESSED_SUFFIXES:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def upload_root(name: str) -> str:
+    """The original a stored file belongs to: the hash of content-addressed files, else the file name"""
+    name = _strip_precompressed(name)
+    return name[:64] if CONTENT_NAME_RE.match(name) else name
+
+
+def _is_image(name: str) -> bool:
+    media_type = mimetypes.guess_type(_strip_precompressed(name))[0] or ""
+    return media_type.startswith("image/")
+
+
+def _referenced_upload_roots(engine: Engine, run: JobRun) -> Set[str]:
+    """Roots of every upload a message refers to, archived messages included, read in short batches"""
+    c, m = conversations_table, messages_table
+    urls: List[str] = []
+    last_id = 0
+    while True:
+        with Session(engine) as db:
+            rows = db.execute(
+                select(m.c.id, m.c.image_url).where(m.c.id > last_id).order_by(m.c.id).limit(REFERENCE_SCAN_ROWS)
+            ).all()
+        if not rows:
+            break
+        urls.extend(url for _, url in rows if url)
+        last_id = rows[-1][0]
+        run.pause()
+    with Session(engine) as db:
+        for archived_urls in db.execute(select(c.c.archived_uploads).where(c.c.archived_uploads.is_not(None))).scalars():
+            urls.extend(archived_urls or [])
+    return {upload_root(url.rsplit("/", 1)[-1]) for url in urls}
+
+
+def _newest_mtime(paths: List[Path]) -> Optional[float]:
+    mtimes = []
+    for path in paths:
+        try:
+            mtimes.append(path.stat().st_mtime)
+        except FileNotFoundError:
+            continue
+    return max(mtimes) if mtimes else None
+
+
+def _remove(paths: List[Path]) -> int:
+    freed = 0
+    for path in paths:
+        try:
+            size = path.stat().st_size
+            path.unlink()
+            freed += size
+        except FileNotFoundError:
+            continue
+    return freed
+
+
+def _directory_bytes(directory: Path) -> int:
+    return sum(path.stat().st_size for path in directory.rglob("*") if path.is_file())
+
+
+def collect_uploads(engine: Engine, run: JobRun):
+    """Delete orphaned images, expired datasets, stale temp files and abandoned chunked uploads"""
+    referenced = _referenced_upload_roots(engine, run)
+    groups: Dict[str, List[Path]] = {}
+    for entry in os.scandir(UPLOAD_DIR):
+        if entry.is_file() and not entry.name.startswith("."):
+            groups.setdefault(upload_root(entry.name), []).append(Path(entry.path))
+
+    for root, paths in groups.items():
+        if all(_is_image(path.name) for path in paths):
+            if root in referenced:
+                continue
+            max_age = ORPHAN_GRACE_SECONDS
+        elif DATASET_RETENTION_DAYS > 0:
+            max_age = DATASET_RETENTION_DAYS * 86400
+        else:
+            continue
+        newest = _newest_mtime(paths)
+        # A re-upload of the same content refreshes the age (see upload_store.finalize)
+        if newest is None or time.time() - newest < max_age:
+            continue
+        run.record(1, _remove(paths))
+        run.tick()
+
+    for entry in os.scandir(UPLOAD_TMP_DIR):
+        if not entry.is_file():
+            continue
+        newest = _newest_mtime([Path(entry.path)])
+        if newest is not None and time.time() - newest > UPLOAD_SESSION_TTL_SECONDS:
+            run.record(1, _remove([Path(entry.path)]))
+            run.tick()
+    for entry in os.scandir(CHUNKED_DIR):
+        if not entry.is_dir() or is_completing(entry.name):
+            continue
+        session_dir = Path(entry.path)
+        try:
+            newest = _newest_mtime([session_dir, *session_dir.iterdir()])
+            if newest is None or time.time() - newest <= UPLOAD_SESSION_TTL_SECONDS:
+                continue
+            size = _directory_bytes(session_dir)
+        except FileNotFoundError:  # Completed or aborted meanwhile
+            continue
+        shutil.rmtree(session_dir, ignore_errors=True)
+        run.record(1, size)
+        run.tick()
+
+
+# --- Vacuum ------------------------------------------------------------------
+
+_warned = {"full_vacuum": False}
+
+
+def _database_bytes(engine: Engine) -> int:
+    try:
+        return os.path.getsize(engine.url.database)
+    except (OSError, TypeError):
+        return 0
+
+
+def vacuum(engine: Engine, run: JobRun):
+    """Incremental vacuum in VACUUM_STEP_PAGES steps, then planner statistics and FTS segment merges"""
+    before = _database_bytes(engine)
+    with engine.connect() as conn:
+        auto_vacuum = conn.exec_driver_sql("PRAGMA auto_vacuum").scalar()
+        if auto_vacuum != 2:  # Not INCREMENTAL
+            if conn.exec_driver_sql("PRAGMA freelist_count").scalar() and before <= VACUUM_FULL_MAX_BYTES:
+                run.wait_for_idle()
+                logger.info("Converting the database to incremental auto-vacuum (one full VACUUM)")
+                conn.exec_driver_sql("PRAGMA auto_vacuum = INCREMENTAL")
+                conn.exec_driver_sql("VACUUM")
+            elif before > VACUUM_FULL_MAX_BYTES and not _warned["full_vacuum"]:
+                _warned["full_vacuum"] = True
+                logger.warning(
+                    "Database is not in incremental auto-vacuum mode and too large to convert automatically; "
+                    "run 'PRAGMA auto_vacuum = INCREMENTAL; VACUUM;' during a maintenance window"
+                )
+        else:
+            # sqlite3's execute() steps this pragma once, freeing one page; executescript() runs it to the end
+            raw = conn.connection.driver_connection
+            free_pages = conn.exec_driver_sql("PRAGMA freelist_count").scalar()
+            while free_pages:
+                raw.executescript(f"PRAGMA incremental_vacuum({VACUUM_STEP_PAGES});")
+                remaining = conn.exec_driver_sql("PRAGMA freelist_count").scalar()
+                run.record(free_pages - remaining)
+                if remaining >= free_pages:
+                    break
+                free_pages = remaining
+                run.pause()
+        # Freed pages are cut from the file when the WAL is checkpointed; PASSIVE never waits for readers
+        conn.exec_driver_sql("PRAGMA wal_checkpoint(PASSIVE)").fetchall()
+
+        # Re-analyze only tables whose statistics are stale, sampling at most 400 rows per index
+        run.wait_for_idle()
+        conn.exec_driver_sql("PRAGMA analysis_limit = 400")
+        conn.exec_driver_sql("PRAGMA optimize").fetchall()
+        conn.commit()
+
+        if search.search_available:
+            for fts_table in search.FTS_TABLES:
+                for _ in range(FTS_MERGE_MAX_STEPS):
+                    changes = conn.exec_driver_sql("SELECT total_changes()").scalar()
+                    conn.exec_driver_sql(f"INSERT INTO {fts_table}({fts_table}, rank) VALUES ('merge', {FTS_MERGE_PAGES})")
+                    conn.commit()
+                    # Fewer than two changes means there was nothing left to merge
+                    if conn.exec_driver_sql("SELECT total_changes()").scalar() - changes < 2:
+                        break
+                    run.pause()
+
+    freed = before - _database_bytes(engine)
+    if freed > 0:
+        run.record(0, freed)
+
+
+JOBS = (
+    ("retention", apply_retention),
+    ("archive", archive_cold_conversations),
+    ("uploads", collect_uploads),  # After the jobs that can orphan uploads
+    ("vacuum", vacuum),  # Last, to return the pages the others freed
+)
+
+
+class MaintenanceScheduler:
+    """Runs the maintenance jobs periodically on a daemon thread"""
+
+    def __init__(self, engine: Engine):
+        self.engine = engine
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if not MAINTENANCE or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._loop, name="storage-maintenance", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10):
+        """Stop after the current batch"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _loop(self):
+        if self._stop.wait(MAINTENANCE_STARTUP_DELAY_SECONDS):
+            return
+        while True:
+            self.run_once()
+            if self._stop.wait(MAINTENANCE_INTERVAL_SECONDS):
+                return
+
+    def run_once(self, jobs: Optional[List[str]] = None):
+        """Run every job (or the named ones) once; failures are logged and do not stop the others"""
+        for name, job in JOBS:
+            if jobs is not None and name not in jobs:
+                continue
+            run = JobRun(name, self._stop)
+            start = time.perf_counter()
+            try:
+                job(self.engine, run)
+            except _Stopped:
+                return
+            except Exception:
+                MAINTENANCE_FAILURES.labels(name).inc()
+                logger.exception("Maintenance job %s failed", name)
+            finally:
+                elapsed = time.perf_counter() - start
+                MAINTENANCE_DURATION.labels(name).observe(elapsed)
+                if run.items or run.reclaimed:
+                    logger.info(
+                        "Maintenance %s: %d items, %.1f MB reclaimed in %.1fs",
+                        name, run.items, run.reclaimed / 1024**2, elapsed,
+                    )
@@ -0,0 +1,115 @@
+"""
+Prometheus metrics and per-stage latency spans for the storage service
+"""
+
+import time
+
+from app_shared.tracing import stage_timer
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+REQUEST_LATENCY = Histogram(
+    "storage_request_duration_seconds",
+    "HTTP request latency by route template",
+    ["method", "route", "status"],
+    buckets=STAGE_BUCKETS,
+)
+
+STAGE_LATENCY = Histogram(
+    "storage_stage_duration_seconds",
+    "Time spent in each stage of a storage request",
+    ["handler", "stage"],
+    buckets=STAGE_BUCKETS,
+)
+
+REQUESTS_INFLIGHT = Gauge(
+    "storage_requests_inflight",
+    "HTTP requests currently being served",
+)
+
+MAINTENANCE_RECLAIMED_BYTES = Counter(
+    "storage_maintenance_reclaimed_bytes_total",
+    "Disk space freed by maintenance jobs (uploads, archives, database pages)",
+    ["job"],
+)
+
+MAINTENANCE_ITEMS = Counter(
+    "storage_maintenance_items_total",
+    "Files, conversations or database pages processed by maintenance jobs",
+    ["job"],
+)
+
+MAINTENANCE_DURATION = Histogram(
+    "storage_maintenance_duration_seconds",
+    "Wall time of a maintenance job run, pauses included",
+    ["job"],
+    buckets=(0.1, 1.0, 10.0, 60.0, 300.0, 1800.0, 3600.0),
+)
+
+MAINTENANCE_FAILURES = Counter(
+    "storage_maintenance_failures_total",
+    "Maintenance job runs that raised",
+    ["job"],
+)
+
+MAINTENANCE_DEFERRED_SECONDS = Counter(
+    "storage_maintenance_deferred_seconds_total",
+    "Time maintenance jobs waited for in-flight requests to finish",
+)
+
+_inflight = 0  # Same as REQUESTS_INFLIGHT, readable without prometheus_client internals
+
+CONTENT_TYPE = CONTENT_TYPE_LATEST
+
+stage = stage_timer(STAGE_LATENCY, "storage-service")  # with stage(handler, name): ...
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording request latency keyed by route template, not raw path"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        global _inflight
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        REQUESTS_INFLIGHT.inc()
+        _inflight += 1
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            REQUESTS_INFLIGHT.dec()
+            _inflight -= 1
+            route = scope.get("route")
+            if route is not None:
+                route_name = getattr(route, "path", "unmatched")
+            elif scope["path"].startswith("/uploads/"):
+                route_name = "/uploads"
+            else:
+                route_name = "unmatched"
+            REQUEST_LATENCY.labels(scope["method"], route_name, str(status_code)).observe(
+                time.perf_counter() - start
+            )
+
+
+def requests_inflight() -> int:
+    """HTTP requests currently being served (safe to read from any thread)"""
+    return _inflight
+
+
+def render_latest() -> bytes:
+    """Render all metrics in the Prometheus text exposition format"""
+    return generate_latest()
@@ -15,7 +15,19 @@ class Conversation(Base):
     id = Column(Integer, primary_key=True, index=True)
     title = Column(String(255), default="New Conversation")
     created_at = Column(DateTime, default=utcnow)
-    updated_at = Column(DateTime, default=utcnow, onupdate=utcnow)
+    updated_at = Column(DateTime, default=utcnow, onupdate=utcnow, index=True)
+    # Aggregates for the sidebar, maintained with every message write (see summaries.py)
+    message_count = Column(Integer, nullable=False, default=0, server_default="0")
+    last_message_at = Column(DateTime, nullable=True)
+    last_message_preview = Column(String(120), nullable=True)
+    like_count = Column(Integer, nullable=False, default=0, server_default="0")
+    dislike_count = Column(Integer, nullable=False, default=0, server_default="0")
+    image_count = Column(Integer, nullable=False, default=0, server_default="0")
+    plot_count = Column(Integer, nullable=False, default=0, server_default="0")
+    # Set while the messages live in the archive file (see archive.py)
+    archived_at = Column(DateTime, nullable=True)
+    restored_at = Column(DateTime, nullable=True)
+    archived_uploads = Column(JSON, nullable=True)  # Image URLs of the archived messages
     
     messages = relationship("Message", back_populates="conversation", cascade="all, delete-orphan")
 
@@ -32,3 +44,14 @@ class Message(Base):
     feedback = Column(String(20), nullable=True)  # 'like', 'dislike', or None
     
     conversation = relationship("Conversation", back_populates="messages")
+
+# Searchable text of the messages moved into archive files (see archive.py)
+class ArchivedMessage(Base):
+    __tablename__ = "archived_messages"
+    
+    id = Column(Integer, primary_key=True)
+    message_id = Column(Integer, nullable=False)  # Its id in messages, reused on restore if still free
+    conversation_id = Column(Integer, nullable=False, index=True)
+    role = Column(String(50), nullable=False)
+    content = Column(Text, nullable=False)
+    timestamp = Column(DateTime, nullable=True)
@@ -52,7 +52,79 @@ class Conversation(ConversationBase):
             dt = dt.replace(tzinfo=timezone.utc)
         return dt.isoformat().replace('+00:00', 'Z')
 
+class ConversationSummary(Conversation):
+    message_count: int = 0
+    last_message_at: Optional[datetime] = None
+    last_message_preview: Optional[str] = None
+    like_count: int = 0
+    dislike_count: int = 0
+    image_count: int = 0  # Messages with an attached image
+    plot_count: int = 0  # Answers with plots (CSV analyses)
+    
+    @field_serializer('last_message_at')
+    def serialize_last_message_at(self, dt: Optional[datetime], _info) -> Optional[str]:
+        """Ensure datetime is UTC and has 'Z' suffix"""
+        if dt is None:
+            return None
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+        return dt.isoformat().replace('+00:00', 'Z')
+
 class ConversationWithMessages(Conversation):
     messages: List[Message] = []
     
     model_config = ConfigDict(from_attributes=True)
+
+class ChunkedUploadCreate(BaseModel):
+    filename: str
+    size: int  # Total file size in bytes
+    chunk_size: Optional[int] = None  # Defaults to the server's DEFAULT_CHUNK_BYTES
+    sha256: Optional[str] = None  # Optional whole-file checksum verified on completion
+
+class ChunkedUploadStatus(BaseModel):
+    upload_id: str
+    filename: str
+    size: int
+    chunk_size: int
+    total_chunks: int
+    received: List[int] = []  # Indices of chunks already stored, for resuming
+
+class ConversationSearchHit(BaseModel):
+    conversation_id: int
+    title: str  # HTML-escaped, matches wrapped in <mark>
+    updated_at: datetime
+    
+    @field_serializer('updated_at')
+    def serialize_datetime(self, dt: datetime, _info) -> str:
+        """Ensure datetime is UTC and has 'Z' suffix"""
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+        return dt.isoformat().replace('+00:00', 'Z')
+
+class MessageSearchHit(BaseModel):
+    message_id: int
+    conversation_id: int
+    conversation_title: Optional[str] = None
+    role: str
+    timestamp: datetime
+    snippet: str  # HTML-escaped excerpt, matches wrapped in <mark>
+    rank: float  # bm25 score; lower is more relevant
+    archived: bool = False  # In an archived conversation; opening it restores the messages
+    
+    @field_serializer('timestamp')
+    def serialize_timestamp(self, dt: datetime, _info) -> str:
+        """Ensure timestamp is UTC and has 'Z' suffix"""
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+        return dt.isoformat().replace('+00:00', 'Z')
+
+class SearchResults(BaseModel):
+    query: str
+    conversations: List[ConversationSearchHit] = []  # Title matches, first page only
+    messages: List[MessageSearchHit] = []
+    next_offset: Optional[int] = None  # Pass as offset for the next page; None on the last page
+    order: str = "relevance"
+    # Relevance order only: more messages matched than the rank_window most recent ones
+    # that were ranked, so older matches are missing; order=recent lists all of them
+    truncated: bool = False
+    rank_window: Optional[int] = None
@@ -0,0 +1,265 @@
+"""
+Full-text search over messages and conversation titles (SQLite FTS5)
+
+messages_fts and conversations_fts are external-content FTS5 tables over
+messages.content and conversations.title. Triggers keep them in sync inside
+the same transaction as every insert, update and delete, so add_message and
+update_conversation need no extra work. An index created against an existing
+database is backfilled once with FTS5's 'rebuild'.
+
+archived_messages_fts does the same for the text of archived conversations
+(see archive.py), so message search covers them too; their hits say archived.
+"""
+
+import html
+import logging
+import os
+import re
+import unicodedata
+from typing import List, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger(__name__)
+
+# Control characters mark matches so the surrounding text can be HTML-escaped safely
+_MATCH_OPEN, _MATCH_CLOSE = "\x02", "\x03"
+SNIPPET_TOKENS = 16
+# Relevance order ranks only the most recent N matches: scoring every match of a
+# common term across millions of messages takes seconds, scoring a window takes
+# milliseconds. Queries with fewer matches are ranked in full; for the others the
+# results say so, and order=recent pages through every match.
+SEARCH_RANK_WINDOW = int(os.getenv("SEARCH_RANK_WINDOW", "2000"))
+
+_INDEXES = {
+    "messages_fts": ("messages", "content"),
+    "archived_messages_fts": ("archived_messages", "content"),
+    "conversations_fts": ("conversations", "title"),
+}
+FTS_TABLES = tuple(_INDEXES)
+
+search_available = False
+
+
+def _index_ddl(fts_table: str, table: str, column: str) -> List[str]:
+    return [
+        f"""CREATE VIRTUAL TABLE IF NOT EXISTS {fts_table} USING fts5(
+            {column}, content='{table}', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )""",
+        f"""CREATE TRIGGER IF NOT EXISTS {fts_table}_ai AFTER INSERT ON {table} BEGIN
+            INSERT INTO {fts_table}(rowid, {column}) VALUES (new.id, new.{column});
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {fts_table}_ad AFTER DELETE ON {table} BEGIN
+            INSERT INTO {fts_table}({fts_table}, rowid, {column}) VALUES ('delete', old.id, old.{column});
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {fts_table}_au AFTER UPDATE OF {column} ON {table} BEGIN
+            INSERT INTO {fts_table}({fts_table}, rowid, {column}) VALUES ('delete', old.id, old.{column});
+            INSERT INTO {fts_table}(rowid, {column}) VALUES (new.id, new.{column});
+        END""",
+    ]
+
+
+def init_search_index(engine: Engine):
+    """Create the FTS5 tables and triggers if missing, backfilling new indexes"""
+    global search_available
+    if engine.dialect.name != "sqlite":
+        logger.warning("Full-text search needs SQLite FTS5; /api/search is disabled for %s", engine.dialect.name)
+        return
+    try:
+        with engine.begin() as conn:
+            for fts_table, (table, column) in _INDEXES.items():
+                exists = conn.execute(
+                    text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                    {"name": fts_table},
+                ).first()
+                for statement in _index_ddl(fts_table, table, column):
+                    conn.execute(text(statement))
+                if not exists:
+                    conn.execute(text(f"INSERT INTO {fts_table}({fts_table}) VALUES ('rebuild')"))
+    except Exception as e:  # SQLite built without FTS5
+        logger.warning("Full-text search unavailable: %s", e)
+        return
+    search_available = True
+
+
+def query_terms(query: str) -> List[str]:
+    return re.findall(r"\w+", query)
+
+
+def build_match_query(query: str) -> Optional[str]:
+    """
+    Turn free text into an FTS5 query: every word must match, the last one as a
+    prefix (search-as-you-type). Words are quoted so FTS5 syntax is never
+    interpreted.
+    """
+    terms = query_terms(query)
+    if not terms:
+        return None
+    quoted = [f'"{term}"' for term in terms]
+    quoted[-1] += "*"
+    return " ".join(quoted)
+
+
+def _highlight(fragment: Optional[str]) -> str:
+    escaped = html.escape(fragment or "")
+    return escaped.replace(_MATCH_OPEN, "<mark>").replace(_MATCH_CLOSE, "</mark>")
+
+
+def _fold(value: str) -> str:
+    """Case- and accent-fold one character at a time, so offsets match the original"""
+    return "".join((unicodedata.normalize("NFKD", ch)[:1] or ch).lower() for ch in value)
+
+
+def make_snippet(content: str, terms: List[str]) -> str:
+    """
+    HTML-escaped excerpt around the first match, matches wrapped in <mark>
+
+    Built in Python for the rows of one page: FTS5's snippet() re-runs the
+    (prefix) query for every row it is called on, which dominates search time.
+    Folding mirrors the index's unicode61/remove_diacritics tokenizer.
+    """
+    folded_terms = [_fold(term) for term in terms]
+    # Whole words, except the last term which is matched as a prefix like the FTS query
+    alternatives = [re.escape(term) + r"\b" for term in folded_terms[:-1]] + [re.escape(folded_terms[-1]) + r"\w*"]
+    pattern = re.compile(r"\b(?:" + "|".join(alternatives) + ")")
+    matches = list(pattern.finditer(_fold(content)))
+    words = list(re.finditer(r"\S+", content))
+    if not words:
+        return ""
+    first = matches[0].start() if matches else 0
+    centre = next((i for i, word in enumerate(words) if word.end() > first), 0)
+    start_word = max(0, centre - SNIPPET_TOKENS // 4)
+    end_word = min(len(words), start_word + SNIPPET_TOKENS)
+    start, end = words[start_word].start(), words[end_word - 1].end()
+
+    parts, position = [], start
+    for match in matches:
+        if match.end() <= start or match.start() >= end:
+            continue
+        match_start, match_end = max(match.start(), start), min(match.end(), end)
+        parts.append(content[position:match_start])
+        parts.append(_MATCH_OPEN + content[match_start:match_end] + _MATCH_CLOSE)
+        position = match_end
+    parts.append(content[position:end])
+    excerpt = "".join(parts)
+    if start_word > 0:
+        excerpt = "…" + excerpt
+    if end_word < len(words):
+        excerpt += "…"
+    return _highlight(excerpt)
+
+
+def search_conversations(db: Session, query: str, limit: int) -> List[dict]:
+    rows = db.execute(
+        text(
+            """
+            SELECT c.id, c.updated_at, highlight(conversations_fts, 0, :open, :close) AS title
+            FROM conversations_fts
+            JOIN conversations c ON c.id = conversations_fts.rowid
+            WHERE conversations_fts MATCH :match
+            ORDER BY conversations_fts.rank
+            LIMIT :limit
+            """
+        ),
+        {"match": build_match_query(query), "open": _MATCH_OPEN, "close": _MATCH_CLOSE, "limit": limit},
+    ).all()
+    return [
+        {"conversation_id": row.id, "title": _highlight(row.title), "updated_at": row.updated_at}
+        for row in rows
+    ]
+
+
+# Message search reads both indexes: (FTS table, its content table, archived flag)
+_MESSAGE_SOURCES = (("messages_fts", "messages", 0), ("archived_messages_fts", "archived_messages", 1))
+
+
+def _matches(fts_table: str, table: str, archived: int, conversation_id: Optional[int], columns: str) -> str:
+    scope = (
+        f"JOIN {table} scoped ON scoped.id = {fts_table}.rowid AND scoped.conversation_id = :conversation_id"
+        if conversation_id is not None else ""
+    )
+    columns = columns.format(fts=fts_table, archived=archived)
+    return f"SELECT {columns} FROM {fts_table} {scope} WHERE {fts_table} MATCH :match"
+
+
+def search_messages(
+    db: Session,
+    query: str,
+    limit: int,
+    offset: int,
+    conversation_id: Optional[int] = None,
+    order: str = "relevance",
+) -> Tuple[List[dict], bool]:
+    """
+    One page of matching messages and whether the ranking was truncated
+
+    order="relevance" ranks by bm25 among the SEARCH_RANK_WINDOW most recent
+    matches of live and of archived messages (truncated is True when either
+    has more); order="recent" pages through every match, newest first, live
+    messages before archived ones. Snippets are only built for the rows on
+    the page.
+    """
+    terms = query_terms(query)
+    params = {"match": build_match_query(query), "limit": limit, "offset": offset, "conversation_id": conversation_id}
+    ranked = "{archived} AS archived, {fts}.rowid AS id, {fts}.rank AS rank"
+    truncated = False
+    if order == "recent":
+        page_order = "page.archived, page.id DESC"
+        params["depth"] = offset + limit
+    else:
+        window = max(SEARCH_RANK_WINDOW, offset + limit)
+        # Counting rowids reads the index without scoring, so this is cheap next to the ranking
+        for source in _MESSAGE_SOURCES:
+            matched = db.execute(
+                text(
+                    f"""
+                    SELECT count(*) FROM (
+                        {_matches(*source, conversation_id, "{fts}.rowid")} LIMIT :window_plus_one
+                    )
+                    """
+                ),
+                {**params, "window_plus_one": window + 1},
+            ).scalar()
+            truncated = truncated or matched > window
+        page_order = "page.rank, page.archived, page.id DESC"
+        params["depth"] = window
+    # Each source contributes its newest matches, read in rowid order from its index:
+    # offset + limit of them for order=recent, the ranking window for relevance
+    arms = [
+        f"SELECT * FROM ({_matches(*source, conversation_id, ranked)} ORDER BY {source[0]}.rowid DESC LIMIT :depth)"
+        for source in _MESSAGE_SOURCES
+    ]
+    page = " UNION ALL ".join(arms) + f" ORDER BY {page_order.replace('page.', '')} LIMIT :limit OFFSET :offset"
+    rows = db.execute(
+        text(
+            f"""
+            WITH page AS ({page})
+            SELECT coalesce(m.id, a.message_id) AS id, c.id AS conversation_id, c.title,
+                   coalesce(m.role, a.role) AS role, coalesce(m.timestamp, a.timestamp) AS timestamp,
+                   coalesce(m.content, a.content) AS content, page.rank, page.archived
+            FROM page
+            LEFT JOIN messages m ON page.archived = 0 AND m.id = page.id
+            LEFT JOIN archived_messages a ON page.archived = 1 AND a.id = page.id
+            JOIN conversations c ON c.id = coalesce(m.conversation_id, a.conversation_id)
+            ORDER BY {page_order}
+            """
+        ),
+        params,
+    ).all()
+    hits = [
+        {
+            "message_id": row.id,
+            "conversation_id": row.conversation_id,
+            "conversation_title": row.title,
+            "role": row.role,
+            "timestamp": row.timestamp,
+            "snippet": make_snippet(row.content, terms),
+            "rank": row.rank,
+            "archived": bool(row.archived),
+        }
+        for row in rows
+    ]
+    return hits, truncated
@@ -0,0 +1,193 @@
+"""
+Static file serving for /uploads with strong caching
+
+Content-addressed uploads (<sha256>.<ext> and their derivatives) never change,
+so they get a strong ETag derived from the hash and `Cache-Control: immutable`.
+Legacy uuid-named files keep Starlette's ETag and must revalidate. Conditional
+GETs return 304, byte ranges are handled by FileResponse, and precompressed
+.br/.gz siblings are served when the client accepts them, with their own ETag.
+The siblings are not addressable themselves: their bytes are only ever served
+as a Content-Encoding of the original.
+
+With PRECOMPRESS_UPLOADS=1, compressible uploads get one sibling (brotli if
+installed, else gzip), written by a single background thread so compressing
+a large file never ties up the request threadpool.
+"""
+
+import gzip
+import logging
+import mimetypes
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from starlette.datastructures import Headers
+from starlette.exceptions import HTTPException
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+from starlette.types import Scope
+
+from upload_store import CONTENT_NAME_RE, new_temp_path
+
+try:
+    import brotli
+except ImportError:  # Brotli variants are optional
+    brotli = None
+
+PRECOMPRESS_UPLOADS = os.getenv("PRECOMPRESS_UPLOADS", "0") == "1"
+PRECOMPRESS_MIN_BYTES = int(os.getenv("PRECOMPRESS_MIN_BYTES", str(16 * 1024)))
+# Larger files are left to on-the-fly compression (or none) rather than occupy the compression thread
+PRECOMPRESS_MAX_BYTES = int(os.getenv("PRECOMPRESS_MAX_BYTES", str(64 * 1024 * 1024)))
+# Uploads arriving while this many are waiting are not precompressed
+PRECOMPRESS_MAX_PENDING = int(os.getenv("PRECOMPRESS_MAX_PENDING", "16"))
+PRECOMPRESSIBLE_EXTENSIONS = {"csv", "json", "txt", "svg"}
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+# Preferred order when the client accepts several encodings
+PRECOMPRESSED_ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+logger = logging.getLogger(__name__)
+
+precompress_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="precompress")
+_pending = 0
+_pending_lock = threading.Lock()
+
+
+def _precompressible(name: str, size: int) -> bool:
+    """Whether precompress() writes siblings for this file (so responses vary by Accept-Encoding)"""
+    extension = name.rsplit(".", 1)[-1].lower() if "." in name else ""
+    return (PRECOMPRESS_UPLOADS and extension in PRECOMPRESSIBLE_EXTENSIONS
+            and PRECOMPRESS_MIN_BYTES <= size <= PRECOMPRESS_MAX_BYTES)
+
+
+def _is_precompressed_sibling(full_path) -> bool:
+    full_path = os.fspath(full_path)
+    return any(
+        full_path.endswith(suffix) and os.path.isfile(full_path[:-len(suffix)])
+        for _, suffix in PRECOMPRESSED_ENCODINGS
+    )
+
+
+def _accepted_encodings(headers: Headers) -> set:
+    """Encodings listed in Accept-Encoding with a non-zero quality"""
+    accepted = set()
+    for part in headers.get("accept-encoding", "").split(","):
+        token, _, params = part.strip().partition(";")
+        quality = 1.0
+        params = params.strip().replace(" ", "")
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if token and quality > 0:
+            accepted.add(token.lower())
+    return accepted
+
+
+class UploadStaticFiles(StaticFiles):
+    """StaticFiles with hash-based ETags, immutable caching and precompressed variants"""
+
+    def file_response(
+        self,
+        full_path,
+        stat_result: os.stat_result,
+        scope: Scope,
+        status_code: int = 200,
+    ) -> Response:
+        if _is_precompressed_sibling(full_path):
+            raise HTTPException(status_code=404)
+        request_headers = Headers(scope=scope)
+        name = os.path.basename(full_path)
+        content_addressed = bool(CONTENT_NAME_RE.match(name))
+        media_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+
+        served_path, served_stat, encoding = full_path, stat_result, None
+        # Ranges address the identity representation, so only negotiate for full GETs
+        if "range" not in request_headers:
+            accepted = _accepted_encodings(request_headers)
+            for candidate, suffix in PRECOMPRESSED_ENCODINGS:
+                if candidate in accepted:
+                    try:
+                        served_stat = os.stat(f"{full_path}{suffix}")
+                    except OSError:
+                        continue
+                    served_path, encoding = f"{full_path}{suffix}", candidate
+                    break
+
+        response = FileResponse(
+            served_path,
+            status_code=status_code,
+            stat_result=served_stat,
+            media_type=media_type,
+        )
+        if content_addressed:
+            digest = name.split(".", 1)[0]
+            response.headers["etag"] = f'"{digest}-{encoding}"' if encoding else f'"{digest}"'
+            response.headers["cache-control"] = IMMUTABLE_CACHE_CONTROL
+        else:
+            response.headers["cache-control"] = REVALIDATE_CACHE_CONTROL
+        if encoding:
+            response.headers["content-encoding"] = encoding
+        # Also before the siblings are written (in the background), so caches key on it from the first response
+        if encoding or _precompressible(name, stat_result.st_size) or any(
+            os.path.exists(f"{full_path}{suffix}") for _, suffix in PRECOMPRESSED_ENCODINGS
+        ):
+            response.headers["vary"] = "Accept-Encoding"
+
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
+
+
+def schedule_precompress(path: Path):
+    """Queue precompress(path) on the compression thread, unless it is not needed or the queue is full"""
+    global _pending
+    if not _precompressible(path.name, path.stat().st_size):
+        return
+    with _pending_lock:
+        if _pending >= PRECOMPRESS_MAX_PENDING:
+            logger.info("Precompression queue full, not precompressing %s", path.name)
+            return
+        _pending += 1
+    precompress_pool.submit(_precompress_job, path)
+
+
+def _precompress_job(path: Path):
+    global _pending
+    try:
+        precompress(path)
+    except OSError as e:  # e.g. deleted meanwhile or disk full: served uncompressed
+        logger.warning("Precompressing %s failed: %s", path.name, e)
+    finally:
+        with _pending_lock:
+            _pending -= 1
+
+
+def precompress(path: Path):
+    """Write one precompressed sibling for a compressible upload: .br when brotli is installed, else .gz"""
+    if not _precompressible(path.name, path.stat().st_size):
+        return
+
+    if brotli is not None:
+        br_path = path.with_name(path.name + ".br")
+        if not br_path.exists():
+            temp_path = new_temp_path()
+            compressor = brotli.Compressor(quality=5)
+            with path.open("rb") as src, temp_path.open("wb") as dst:
+                while data := src.read(1024 * 1024):
+                    dst.write(compressor.process(data))
+                dst.write(compressor.finish())
+            os.replace(temp_path, br_path)
+        return
+
+    gz_path = path.with_name(path.name + ".gz")
+    if not gz_path.exists():
+        temp_path = new_temp_path()
+        with path.open("rb") as src, gzip.open(temp_path, "wb", compresslevel=6) as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        os.replace(temp_path, gz_path)
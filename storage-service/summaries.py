@@ -0,0 +1,166 @@
+"""
+Per-conversation aggregates for the sidebar, denormalized onto conversations
+
+message_count, last_message_at, last_message_preview, like_count,
+dislike_count, image_count and plot_count are kept up to date in the same
+transaction as the writes that change them (add_message,
+update_message_feedback, imports), so GET /api/conversations/summaries reads
+thousands of conversations from one indexed query without touching messages.
+Deleting a conversation deletes its row, aggregates included.
+
+Databases created before these columns existed are migrated on startup with
+ALTER TABLE and backfilled from the messages once.
+"""
+
+import logging
+import os
+from typing import Iterable, List, Optional
+
+from sqlalchemy import String, bindparam, case, func, inspect, select, text, type_coerce, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+import models
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PREVIEW_CHARS = 120
+SUMMARY_LIST_MAX = int(os.getenv("SUMMARY_LIST_MAX", "5000"))  # Conversations per summaries request
+REFRESH_BATCH = 500
+
+conversations_table = models.Conversation.__table__
+messages_table = models.Message.__table__
+
+# Columns added after the first release: name -> DDL type and default
+_SUMMARY_COLUMNS = {
+    "message_count": "INTEGER NOT NULL DEFAULT 0",
+    "last_message_at": "DATETIME",
+    "last_message_preview": f"VARCHAR({SUMMARY_PREVIEW_CHARS})",
+    "like_count": "INTEGER NOT NULL DEFAULT 0",
+    "dislike_count": "INTEGER NOT NULL DEFAULT 0",
+    "image_count": "INTEGER NOT NULL DEFAULT 0",
+    "plot_count": "INTEGER NOT NULL DEFAULT 0",
+}
+
+
+def preview(content: str) -> str:
+    """First SUMMARY_PREVIEW_CHARS characters of a message on one line"""
+    flat = " ".join(content.split())
+    if len(flat) <= SUMMARY_PREVIEW_CHARS:
+        return flat
+    return flat[:SUMMARY_PREVIEW_CHARS - 1] + "…"
+
+
+def init_summaries(engine: Engine):
+    """Add missing aggregate columns and the list index, backfilling existing conversations"""
+    existing = {column["name"] for column in inspect(engine).get_columns("conversations")}
+    missing = [name for name in _SUMMARY_COLUMNS if name not in existing]
+    with engine.begin() as conn:
+        for name in missing:
+            conn.execute(text(f"ALTER TABLE conversations ADD COLUMN {name} {_SUMMARY_COLUMNS[name]}"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_conversations_updated_at ON conversations (updated_at)"))
+    if missing:
+        logger.info("Backfilling conversation summaries (%s)", ", ".join(missing))
+        with Session(engine) as db:
+            refresh_summaries(db)
+            db.commit()
+
+
+def record_message(conversation: models.Conversation, message: models.Message):
+    """Fold a new message into its conversation's aggregates (as SQL increments, safe under concurrency)"""
+    conversation.message_count = models.Conversation.message_count + 1
+    if message.timestamp is None:  # Set now rather than by the column default, so both times agree
+        message.timestamp = models.utcnow()
+    conversation.last_message_at = message.timestamp
+    conversation.last_message_preview = preview(message.content)
+    if message.image_url:
+        conversation.image_count = models.Conversation.image_count + 1
+    if message.plots:
+        conversation.plot_count = models.Conversation.plot_count + 1
+    record_feedback(conversation, None, message.feedback)
+
+
+def record_feedback(conversation: models.Conversation, old: Optional[str], new: Optional[str]):
+    """Move a message's vote between the like and dislike tallies"""
+    if old == new:
+        return
+    conversation.updated_at = models.Conversation.updated_at  # A vote is not activity: keep the sidebar order
+    for value, delta in ((old, -1), (new, 1)):
+        if value == "like":
+            conversation.like_count = models.Conversation.like_count + delta
+        elif value == "dislike":
+            conversation.dislike_count = models.Conversation.dislike_count + delta
+
+
+def refresh_summaries(db: Session, conversation_ids: Optional[Iterable[int]] = None):
+    """Recompute aggregates from the messages, for all conversations or the given ones"""
+    if conversation_ids is None:
+        _refresh(db, None)
+        return
+    ids = list(conversation_ids)
+    for start in range(0, len(ids), REFRESH_BATCH):  # Bounded IN lists
+        _refresh(db, ids[start:start + REFRESH_BATCH])
+
+
+def _refresh(db: Session, ids: Optional[List[int]]):
+    c, m = conversations_table, messages_table
+    # updated_at is set to itself so its onupdate does not reorder the sidebar
+    reset = update(c).values(
+        updated_at=c.c.updated_at,
+        **{name: None if name.startswith("last_") else 0 for name in _SUMMARY_COLUMNS},
+    )
+    totals = select(
+        m.c.conversation_id,
+        func.count().label("message_count"),
+        func.count(case((m.c.feedback == "like", 1))).label("like_count"),
+        func.count(case((m.c.feedback == "dislike", 1))).label("dislike_count"),
+        func.count(func.nullif(m.c.image_url, "")).label("image_count"),
+        # JSON null and empty lists are stored as text, not SQL NULL
+        func.count(case((type_coerce(m.c.plots, String).notin_(["null", "[]"]), 1))).label("plot_count"),
+        func.max(m.c.id).label("latest_id"),
+    ).group_by(m.c.conversation_id)
+    if ids is not None:
+        reset = reset.where(c.c.id.in_(ids))
+        totals = totals.where(m.c.conversation_id.in_(ids))
+    db.execute(reset)
+
+    # One pass over the messages, joined to each conversation's latest message for the preview
+    totals = totals.subquery()
+    rows = db.execute(
+        select(totals, m.c.timestamp, m.c.content).join(m, m.c.id == totals.c.latest_id)
+    ).mappings().all()
+    if rows:
+        db.execute(
+            update(c).where(c.c.id == bindparam("target_id")).values(
+                updated_at=c.c.updated_at,
+                **{name: bindparam(f"new_{name}") for name in _SUMMARY_COLUMNS},
+            ),
+            [
+                {
+                    "target_id": row["conversation_id"],
+                    "new_message_count": row["message_count"],
+                    "new_last_message_at": row["timestamp"],
+                    "new_last_message_preview": preview(row["content"]),
+                    "new_like_count": row["like_count"],
+                    "new_dislike_count": row["dislike_count"],
+                    "new_image_count": row["image_count"],
+                    "new_plot_count": row["plot_count"],
+                }
+                for row in rows
+            ],
+        )
+
+
+def list_summaries(db: Session, limit: int, offset: int) -> list:
+    """Conversations with their aggregates, most recently updated first (served by the updated_at index)"""
+    c = conversations_table
+    rows = db.execute(
+        select(
+            c.c.id, c.c.title, c.c.created_at, c.c.updated_at,
+            *(c.c[name] for name in _SUMMARY_COLUMNS),
+        )
+        .order_by(c.c.updated_at.desc())
+        .limit(limit)
+        .offset(offset)
+    ).mappings().all()
+    return [dict(row) for row in rows]
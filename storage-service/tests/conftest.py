@@ -0,0 +1,24 @@
+"""
+The service keeps its database, uploads and archive under the working directory,
+so tests import it from a scratch one
+
+Run from storage-service/: python -m pytest tests
+"""
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.chdir(tempfile.mkdtemp(prefix="storage-tests-"))
+
+
+@pytest.fixture(scope="session")
+def client():
+    from fastapi.testclient import TestClient
+
+    import main
+
+    return TestClient(main.app)  # Not entered, so the maintenance scheduler does not start
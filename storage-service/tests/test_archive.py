@@ -0,0 +1,184 @@
+"""
+Cold-conversation archive and maintenance: archiving, restore on access (ids renumbered
+when taken meanwhile), archived search hits, retention and upload garbage collection
+
+Run from storage-service/: python -m pytest tests
+"""
+
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+import archive
+import main  # noqa: F401  Creates the tables and search indexes
+import maintenance
+import search
+from database import engine
+from upload_store import UPLOAD_DIR, UPLOAD_TMP_DIR
+
+DAY = 86400
+
+
+@pytest.fixture(autouse=True)
+def settings(monkeypatch):
+    monkeypatch.setattr(maintenance, "ARCHIVE_AFTER_DAYS", 1)
+    monkeypatch.setattr(maintenance, "MAINTENANCE_PAUSE_SECONDS", 0)
+
+
+def run_job(job, name: str):
+    run = maintenance.JobRun(name, threading.Event())
+    run.wait_for_idle = lambda: None  # The test client's own request counts as in flight
+    job(engine, run)
+    return run
+
+
+def cold_conversation(client, title: str, *contents: str, image_url: str = None) -> int:
+    """A conversation last active five days ago"""
+    conversation_id = client.post("/api/conversations", json={"title": title}).json()["id"]
+    for n, content in enumerate(contents):
+        fields = {"image_url": image_url} if image_url and n == 0 else {}
+        response = client.post(f"/api/conversations/{conversation_id}/messages", json={"role": "user", "content": content, **fields})
+        assert response.status_code == 200
+    with Session(engine) as db:
+        db.execute(text("UPDATE conversations SET updated_at = :old WHERE id = :id"),
+                   {"old": datetime.utcnow() - timedelta(days=5), "id": conversation_id})
+        db.commit()
+    return conversation_id
+
+
+def stored(conversation_id: int):
+    """(archived, messages in the database, archived_messages rows)"""
+    with Session(engine) as db:
+        return (
+            db.execute(text("SELECT archived_at IS NOT NULL FROM conversations WHERE id = :id"), {"id": conversation_id}).scalar(),
+            db.execute(text("SELECT count(*) FROM messages WHERE conversation_id = :id"), {"id": conversation_id}).scalar(),
+            db.execute(text("SELECT count(*) FROM archived_messages WHERE conversation_id = :id"), {"id": conversation_id}).scalar(),
+        )
+
+
+def messages(client, conversation_id: int) -> list:
+    response = client.get(f"/api/conversations/{conversation_id}/messages")
+    assert response.status_code == 200
+    return [(message["id"], message["content"]) for message in response.json()]
+
+
+def archive_rows(conversation_id: int):
+    with Session(engine) as db:
+        return db.execute(
+            text("SELECT message_id AS id, content FROM archived_messages WHERE conversation_id = :id ORDER BY message_id"),
+            {"id": conversation_id},
+        ).all()
+
+
+def test_cold_conversation_is_archived_and_restored_on_access(client):
+    conversation_id = cold_conversation(client, "Archived quarter", "first question", "second question")
+    before = messages(client, conversation_id)
+
+    run_job(maintenance.archive_cold_conversations, "archive")
+    assert stored(conversation_id) == (True, 0, 2)
+    assert archive.archive_path(conversation_id).exists()
+    summary = next(item for item in client.get("/api/conversations/summaries").json() if item["id"] == conversation_id)
+    assert summary["message_count"] == 2  # The sidebar is unchanged
+
+    assert messages(client, conversation_id) == before
+    assert stored(conversation_id) == (False, 2, 0)
+    assert not archive.archive_path(conversation_id).exists()
+
+
+def test_restore_renumbers_ids_taken_meanwhile(client):
+    conversation_id = cold_conversation(client, "Renumbered", "reused id", "kept id")
+    run_job(maintenance.archive_cold_conversations, "archive")
+    first_id, second_id = [row.id for row in archive_rows(conversation_id)]
+
+    # SQLite gives the next message one more than the highest id left, the first archived one
+    other = client.post("/api/conversations", json={"title": "Took the id"}).json()["id"]
+    taken = client.post(f"/api/conversations/{other}/messages", json={"role": "user", "content": "newer"}).json()["id"]
+    assert taken == first_id
+
+    restored = messages(client, conversation_id)
+    assert (second_id, "kept id") in restored
+    renumbered = next(message_id for message_id, content in restored if content == "reused id")
+    assert renumbered not in (first_id, second_id)
+    assert messages(client, other) == [(taken, "newer")]
+
+
+@pytest.mark.skipif(not search.search_available, reason="SQLite built without FTS5")
+def test_archived_messages_stay_searchable_and_are_indexed_from_older_archives(client):
+    conversation_id = cold_conversation(client, "Searchable archive", "zanzibarite forecast")
+    run_job(maintenance.archive_cold_conversations, "archive")
+
+    def hits():
+        response = client.get("/api/search", params={"q": "zanzibarite", "order": "recent"})
+        return [(hit["conversation_id"], hit["archived"]) for hit in response.json()["messages"]]
+
+    assert hits() == [(conversation_id, True)]
+    # Archived before archived_messages existed: the next run indexes the file
+    with Session(engine) as db:
+        db.execute(text("DELETE FROM archived_messages WHERE conversation_id = :id"), {"id": conversation_id})
+        db.commit()
+        assert conversation_id in archive.unindexed_archived_ids(db)
+    assert hits() == []
+    run_job(maintenance.archive_cold_conversations, "archive")
+    assert hits() == [(conversation_id, True)]
+
+    assert client.delete(f"/api/conversations/{conversation_id}").status_code == 200
+    assert hits() == []
+    assert archive_rows(conversation_id) == []
+
+
+def test_stray_archive_files_are_removed(client):
+    orphan = archive.ARCHIVE_DIR / "999999.ndjson.gz"
+    interrupted = archive.ARCHIVE_DIR / "999998.ndjson.gz.tmp"
+    for path in (orphan, interrupted):
+        path.write_bytes(b"x")
+    run_job(maintenance.archive_cold_conversations, "archive")
+    assert not orphan.exists() and not interrupted.exists()
+
+
+def test_retention_deletes_inactive_conversations_and_their_archives(client, monkeypatch):
+    archived = cold_conversation(client, "Expired archive", "old")
+    run_job(maintenance.archive_cold_conversations, "archive")
+    expired = cold_conversation(client, "Expired", "old")
+    active = client.post("/api/conversations", json={"title": "Active"}).json()["id"]
+
+    monkeypatch.setattr(maintenance, "RETENTION_DAYS", 2)
+    run = run_job(maintenance.apply_retention, "retention")
+    assert run.items >= 2
+    ids = {item["id"] for item in client.get("/api/conversations").json()}
+    assert active in ids and archived not in ids and expired not in ids
+    assert not archive.archive_path(archived).exists()
+    assert stored(expired)[1] == 0 and archive_rows(archived) == []
+
+
+def test_uploads_gc_keeps_referenced_and_recent_files(client):
+    def upload(name: str, age_days: float = 0, directory=UPLOAD_DIR):
+        path = directory / name
+        path.write_bytes(b"\x89PNG")
+        mtime = time.time() - age_days * DAY
+        os.utime(path, (mtime, mtime))
+        return path
+
+    orphan = upload("gc-orphan.png", age_days=2)
+    orphan_sibling = upload("gc-orphan.png.gz", age_days=2)
+    recent = upload("gc-recent.png")
+    referenced = upload("gc-referenced.png", age_days=2)
+    in_archive = upload("gc-archived.png", age_days=2)
+    dataset = upload("gc-sales.csv", age_days=400)
+    stale_temp = upload("gc-partial", age_days=30, directory=UPLOAD_TMP_DIR)
+
+    conversation_id = client.post("/api/conversations", json={"title": "Uploads"}).json()["id"]
+    client.post(f"/api/conversations/{conversation_id}/messages",
+                json={"role": "user", "content": "look", "image_url": "/uploads/gc-referenced.png"})
+    cold_conversation(client, "Archived upload", "see image", image_url="/uploads/gc-archived.png")
+    run_job(maintenance.archive_cold_conversations, "archive")
+
+    run = run_job(maintenance.collect_uploads, "uploads")
+    assert not orphan.exists() and not orphan_sibling.exists() and not stale_temp.exists()
+    assert recent.exists() and referenced.exists() and in_archive.exists()
+    assert dataset.exists()  # Without DATASET_RETENTION_DAYS datasets are kept
+    assert run.items >= 2 and run.reclaimed >= 12
@@ -0,0 +1,79 @@
+"""
+Resumable chunked uploads: out-of-order and repeated chunks, resume from status, verified assembly
+
+Run from storage-service/: python -m pytest tests
+"""
+
+import hashlib
+
+import upload_store
+
+CHUNK = 4
+CONTENT = b"id,v\n1,a\n2,b\n3,c\n"  # 18 bytes: chunks of 4, 4, 4, 4 and 2
+
+
+def start(client, content: bytes = CONTENT, **fields) -> str:
+    response = client.post("/api/uploads", json={"filename": "big.csv", "size": len(content), "chunk_size": CHUNK, **fields})
+    assert response.status_code == 200, response.text
+    return response.json()["upload_id"]
+
+
+def put(client, upload_id: str, index: int, content: bytes = CONTENT, **headers):
+    return client.put(f"/api/uploads/{upload_id}/chunks/{index}", content=content[index * CHUNK:(index + 1) * CHUNK], headers=headers)
+
+
+def test_upload_resumes_from_the_received_chunks(client):
+    upload_id = start(client, sha256=hashlib.sha256(CONTENT).hexdigest())
+    for index in (3, 0, 4):
+        assert put(client, upload_id, index).status_code == 200
+
+    # After an interruption the client asks what is missing
+    status = client.get(f"/api/uploads/{upload_id}").json()
+    assert status["total_chunks"] == 5 and status["received"] == [0, 3, 4]
+    missing = client.post(f"/api/uploads/{upload_id}/complete")
+    assert missing.status_code == 409 and "[1, 2]" in missing.json()["detail"]
+
+    for index in (1, 2, 2):  # Re-sending a chunk is harmless
+        assert put(client, upload_id, index).status_code == 200
+    body = client.post(f"/api/uploads/{upload_id}/complete").json()
+    assert body["sha256"] == hashlib.sha256(CONTENT).hexdigest() and body["filename"] == "big.csv"
+    assert (upload_store.UPLOAD_DIR / f"{body['sha256']}.csv").read_bytes() == CONTENT
+    assert not (upload_store.CHUNKED_DIR / upload_id).exists()
+    assert client.get(f"/api/uploads/{upload_id}").status_code == 404
+
+
+def test_same_content_as_a_plain_upload_is_deduplicated(client):
+    content = b"k\n" + b"9\n" * 10
+    plain = client.post("/api/upload-csv", files={"file": ("k.csv", content, "text/csv")}).json()
+    upload_id = start(client, content)
+    for index in range((len(content) + CHUNK - 1) // CHUNK):
+        assert put(client, upload_id, index, content).status_code == 200
+    chunked = client.post(f"/api/uploads/{upload_id}/complete").json()
+    assert chunked["deduplicated"] and chunked["csv_url"] == plain["csv_url"]
+
+
+def test_bad_chunks_are_rejected_and_not_kept(client):
+    upload_id = start(client)
+    wrong_size = client.put(f"/api/uploads/{upload_id}/chunks/0", content=b"id,v\n1")
+    assert wrong_size.status_code == 400
+    corrupted = put(client, upload_id, 0, **{"X-Chunk-SHA256": hashlib.sha256(b"other").hexdigest()})
+    assert corrupted.status_code == 422
+    assert put(client, upload_id, 5).status_code == 400  # Past the last chunk
+    assert client.get(f"/api/uploads/{upload_id}").json()["received"] == []
+    assert not list((upload_store.CHUNKED_DIR / upload_id).glob("*.tmp"))
+
+
+def test_assembled_file_must_match_the_declared_checksum(client):
+    upload_id = start(client, sha256=hashlib.sha256(b"something else").hexdigest())
+    for index in range(5):
+        assert put(client, upload_id, index).status_code == 200
+    assert client.post(f"/api/uploads/{upload_id}/complete").status_code == 422
+    assert client.get(f"/api/uploads/{upload_id}").json()["received"] == [0, 1, 2, 3, 4]  # Chunks are kept
+
+
+def test_aborted_upload_is_gone(client):
+    upload_id = start(client)
+    assert put(client, upload_id, 0).status_code == 200
+    assert client.delete(f"/api/uploads/{upload_id}").status_code == 200
+    assert not (upload_store.CHUNKED_DIR / upload_id).exists()
+    assert client.put(f"/api/uploads/{upload_id}/chunks/1", content=CONTENT[4:8]).status_code == 404
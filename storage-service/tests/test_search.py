@@ -0,0 +1,71 @@
+"""
+Full-text search: user input never reaches FTS5 as syntax, prefixes and accents match, snippets are escaped
+
+Run from storage-service/: python -m pytest tests
+"""
+
+import pytest
+
+import main  # noqa: F401  Creates the search indexes
+import search
+
+pytestmark = pytest.mark.skipif(not search.search_available, reason="SQLite built without FTS5")
+
+
+def conversation(client, title: str, *contents: str) -> int:
+    conversation_id = client.post("/api/conversations", json={"title": title}).json()["id"]
+    for content in contents:
+        response = client.post(f"/api/conversations/{conversation_id}/messages", json={"role": "user", "content": content})
+        assert response.status_code == 200
+    return conversation_id
+
+
+def message_search(client, q: str, **params) -> dict:
+    response = client.get("/api/search", params={"q": q, **params})
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("revenue", '"revenue"*'),
+    ('north "region', '"north" "region"*'),
+    ("a OR b", '"a" "OR" "b"*'),
+    ("-excluded NEAR(x y)", '"excluded" "NEAR" "x" "y"*'),
+    ("title:sales^ *", '"title" "sales"*'),
+    ("'); DROP TABLE messages; --", '"DROP" "TABLE" "messages"*'),
+])
+def test_match_query_quotes_every_term(query, expected):
+    assert search.build_match_query(query) == expected
+
+
+def test_queries_of_fts_syntax_are_searched_as_words(client):
+    conversation_id = conversation(client, "Operators", 'Compare quillwort OR "NEAR" in column:north (east*)')
+    for q in ('quillwort OR', '"NEAR', 'column:north', '(east*', 'quillwort -NEAR', 'NEAR(quillwort'):
+        hits = message_search(client, q)["messages"]
+        assert [hit["conversation_id"] for hit in hits] == [conversation_id], q
+    assert message_search(client, '*^"()')["messages"] == []  # No words: nothing to match
+
+
+def test_last_word_matches_as_a_prefix_and_accents_fold(client):
+    conversation(client, "Cafés", "Café bookings in Zürich by hornwrack")
+    assert len(message_search(client, "hornwr")["messages"]) == 1
+    assert len(message_search(client, "cafe zurich hornwrack")["messages"]) == 1
+    assert message_search(client, "hornwr bookin")["messages"] == []  # Only the last word is a prefix
+
+
+def test_snippets_and_titles_are_html_escaped(client):
+    conversation(client, "<b>lungwort</b> & co", "<script>alert('lungwort')</script>")
+    results = message_search(client, "lungwort")
+    assert results["messages"][0]["snippet"] == "&lt;script&gt;alert(&#x27;<mark>lungwort</mark>&#x27;)&lt;/script&gt;"
+    assert results["conversations"][0]["title"] == "&lt;b&gt;<mark>lungwort</mark>&lt;/b&gt; &amp; co"
+
+
+def test_search_within_a_conversation_and_pages(client):
+    first = conversation(client, "One", *[f"saltwort row {n}" for n in range(3)])
+    conversation(client, "Two", "saltwort elsewhere")
+    scoped = message_search(client, "saltwort", conversation_id=first, order="recent", limit=2)
+    assert [hit["conversation_id"] for hit in scoped["messages"]] == [first, first]
+    assert scoped["next_offset"] == 2 and scoped["conversations"] == []
+    rest = message_search(client, "saltwort", conversation_id=first, order="recent", limit=2, offset=2)
+    assert len(rest["messages"]) == 1 and rest["next_offset"] is None
+    assert len(message_search(client, "saltwort")["messages"]) == 4
@@ -0,0 +1,80 @@
+"""
+/uploads: hash ETags and immutable caching, conditional GETs, byte ranges and precompressed siblings
+
+Run from storage-service/: python -m pytest tests
+"""
+
+import hashlib
+
+import pytest
+
+import static_files
+import upload_store
+
+CONTENT = b"region,sales\n" + b"north,1200\nsouth,950\n" * 200
+IDENTITY = {"Accept-Encoding": "identity"}
+
+
+@pytest.fixture
+def upload(client):
+    response = client.post("/api/upload-csv", files={"file": ("sales.csv", CONTENT, "text/csv")})
+    assert response.status_code == 200
+    return response.json()
+
+
+def test_content_addressed_file_is_immutable(client, upload):
+    response = client.get(upload["csv_url"], headers=IDENTITY)
+    assert response.status_code == 200 and response.content == CONTENT
+    assert response.headers["etag"] == f'"{upload["sha256"]}"'
+    assert response.headers["cache-control"] == static_files.IMMUTABLE_CACHE_CONTROL
+
+    revalidated = client.get(upload["csv_url"], headers={**IDENTITY, "If-None-Match": response.headers["etag"]})
+    assert revalidated.status_code == 304 and revalidated.content == b""
+
+
+def test_byte_ranges(client, upload):
+    response = client.get(upload["csv_url"], headers={"Range": "bytes=13-22", "Accept-Encoding": "gzip, br"})
+    assert response.status_code == 206
+    assert response.content == CONTENT[13:23] and response.content == b"north,1200"
+    assert response.headers["content-range"] == f"bytes 13-22/{len(CONTENT)}"
+    assert "content-encoding" not in response.headers
+
+    suffix = client.get(upload["csv_url"], headers={**IDENTITY, "Range": "bytes=-10"})
+    assert suffix.status_code == 206 and suffix.content == CONTENT[-10:]
+    unsatisfiable = client.get(upload["csv_url"], headers={**IDENTITY, "Range": f"bytes={len(CONTENT) + 5}-"})
+    assert unsatisfiable.status_code == 416
+
+
+def test_legacy_file_must_revalidate(client):
+    path = upload_store.UPLOAD_DIR / "0b4f6c1e-legacy.csv"
+    path.write_bytes(CONTENT)
+    response = client.get(f"/uploads/{path.name}", headers=IDENTITY)
+    assert response.status_code == 200
+    assert response.headers["cache-control"] == static_files.REVALIDATE_CACHE_CONTROL
+    revalidated = client.get(f"/uploads/{path.name}", headers={**IDENTITY, "If-None-Match": response.headers["etag"]})
+    assert revalidated.status_code == 304
+
+
+def test_precompressed_sibling_is_served_as_an_encoding(client, upload, monkeypatch):
+    monkeypatch.setattr(static_files, "PRECOMPRESS_UPLOADS", True)
+    monkeypatch.setattr(static_files, "PRECOMPRESS_MIN_BYTES", 0)
+    path = upload_store.UPLOAD_DIR / f"{upload['sha256']}.csv"
+    static_files.precompress(path)
+    encoding, suffix = ("br", ".br") if static_files.brotli is not None else ("gzip", ".gz")
+    assert path.with_name(path.name + suffix).exists()
+
+    response = client.get(upload["csv_url"], headers={"Accept-Encoding": encoding})
+    assert response.headers["content-encoding"] == encoding
+    assert response.content == CONTENT  # Decoded by the client
+    assert response.headers["etag"] == f'"{upload["sha256"]}-{encoding}"'
+    assert "Accept-Encoding" in response.headers["vary"]
+    assert "Accept-Encoding" in client.get(upload["csv_url"], headers=IDENTITY).headers["vary"]
+
+    revalidated = client.get(upload["csv_url"], headers={"Accept-Encoding": encoding, "If-None-Match": response.headers["etag"]})
+    assert revalidated.status_code == 304
+    # The sibling is only reachable as an encoding of the original
+    assert client.get(upload["csv_url"] + suffix).status_code == 404
+
+
+def test_unknown_file_is_not_found(client):
+    assert client.get(f"/uploads/{hashlib.sha256(b'missing').hexdigest()}.csv").status_code == 404
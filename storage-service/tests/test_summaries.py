@@ -0,0 +1,72 @@
+"""
+Sidebar summaries: aggregates kept in step with writes, matching a full recomputation
+
+Run from storage-service/: python -m pytest tests
+"""
+
+from sqlalchemy.orm import Session
+
+import summaries
+from database import engine
+
+FIELDS = ("message_count", "last_message_at", "last_message_preview", "like_count", "dislike_count", "image_count", "plot_count")
+
+
+def add(client, conversation_id: int, role: str, content: str, **fields) -> int:
+    response = client.post(f"/api/conversations/{conversation_id}/messages", json={"role": role, "content": content, **fields})
+    assert response.status_code == 200, response.text
+    return response.json()["id"]
+
+
+def vote(client, message_id: int, feedback):
+    assert client.patch(f"/api/messages/{message_id}/feedback", json={"feedback": feedback}).status_code == 200
+
+
+def summary(client, conversation_id: int) -> dict:
+    listed = client.get("/api/conversations/summaries", params={"limit": summaries.SUMMARY_LIST_MAX}).json()
+    return next(item for item in listed if item["id"] == conversation_id)
+
+
+def test_aggregates_follow_messages_and_votes(client):
+    conversation_id = client.post("/api/conversations", json={"title": "Aggregates"}).json()["id"]
+    add(client, conversation_id, "user", "What is in this picture?", image_url="/uploads/a.png")
+    first = add(client, conversation_id, "assistant", "A chart.", plots=["iVBORw0KGgo"])
+    second = add(client, conversation_id, "assistant", "Line one\n\n  line   two " + "x" * 200)
+    vote(client, first, "like")
+    vote(client, second, "dislike")
+    vote(client, first, "dislike")
+    vote(client, second, None)
+
+    current = summary(client, conversation_id)
+    assert current["message_count"] == 3
+    assert current["image_count"] == 1 and current["plot_count"] == 1
+    assert (current["like_count"], current["dislike_count"]) == (0, 1)
+    preview = current["last_message_preview"]
+    assert preview.startswith("Line one line two x") and preview.endswith("…")
+    assert len(preview) == summaries.SUMMARY_PREVIEW_CHARS
+
+
+def test_incremental_aggregates_match_a_recomputation(client):
+    conversation_id = client.post("/api/conversations", json={"title": "Recomputed"}).json()["id"]
+    for n in range(4):
+        message_id = add(client, conversation_id, "assistant", f"answer {n}", plots=["p"] if n % 2 else [])
+        vote(client, message_id, "like" if n < 3 else "dislike")
+    before = summary(client, conversation_id)
+    with Session(engine) as db:
+        summaries.refresh_summaries(db, [conversation_id])
+        db.commit()
+    after = summary(client, conversation_id)
+    assert {name: after[name] for name in FIELDS} == {name: before[name] for name in FIELDS}
+    assert (after["plot_count"], after["like_count"], after["dislike_count"]) == (2, 3, 1)
+
+
+def test_votes_do_not_reorder_the_sidebar(client):
+    older = client.post("/api/conversations", json={"title": "Older"}).json()["id"]
+    message_id = add(client, older, "assistant", "voted on later")
+    newer = client.post("/api/conversations", json={"title": "Newer"}).json()["id"]
+    add(client, newer, "user", "most recent")
+    vote(client, message_id, "like")
+
+    listed = [item["id"] for item in client.get("/api/conversations/summaries").json()]
+    assert listed.index(newer) < listed.index(older)
+    assert client.get("/api/conversations/summaries", params={"limit": 0}).status_code == 400
@@ -0,0 +1,85 @@
+"""
+NDJSON export and import: round trip, ids remapped on import, failed imports leave nothing behind
+
+Run from storage-service/: python -m pytest tests
+"""
+
+import json
+
+import pytest
+
+import transfer
+
+
+@pytest.fixture(autouse=True)
+def small_batches(monkeypatch):
+    monkeypatch.setattr(transfer, "IMPORT_BATCH_ROWS", 2)
+    monkeypatch.setattr(transfer, "EXPORT_BATCH_ROWS", 2)
+
+
+def conversation(client, title: str, *contents: str) -> int:
+    conversation_id = client.post("/api/conversations", json={"title": title}).json()["id"]
+    for n, content in enumerate(contents):
+        role = "user" if n % 2 == 0 else "assistant"
+        client.post(f"/api/conversations/{conversation_id}/messages", json={"role": role, "content": content})
+    return conversation_id
+
+
+def records(response) -> list:
+    assert response.status_code == 200
+    return [json.loads(line) for line in response.text.splitlines()]
+
+
+def conversation_count(client) -> int:
+    return len(client.get("/api/conversations", params={"limit": 10_000}).json())
+
+
+def test_export_lists_the_conversation_then_its_messages(client):
+    conversation_id = conversation(client, "Exported", "first", "second", "third")
+    exported = records(client.get(f"/api/conversations/{conversation_id}/export"))
+    assert [record["type"] for record in exported] == ["conversation", "message", "message", "message"]
+    assert exported[0]["id"] == conversation_id and exported[0]["title"] == "Exported"
+    assert [record["content"] for record in exported[1:]] == ["first", "second", "third"]
+    assert {record["conversation_id"] for record in exported[1:]} == {conversation_id}
+
+
+def test_import_gives_new_ids_and_remaps_messages(client):
+    first = conversation(client, "Alpha", "a1", "a2")
+    second = conversation(client, "Beta", "b1", "b2", "b3")
+    exported = records(client.get("/api/export"))
+    mine = [r for r in exported if r.get("id") in (first, second) and r["type"] == "conversation"]
+    mine += [r for r in exported if r["type"] == "message" and r["conversation_id"] in (first, second)]
+    # Messages out of order, over several batches of two
+    body = "\n".join(json.dumps(record) for record in mine[:2] + mine[2:][::-1]) + "\n"
+
+    response = client.post("/api/import", content=body)
+    assert response.status_code == 200, response.text
+    assert response.json() == {"conversations": 2, "messages": 5}
+
+    summaries = client.get("/api/conversations/summaries").json()
+    imported = {s["title"]: s for s in summaries if s["title"] in ("Alpha", "Beta") and s["id"] not in (first, second)}
+    assert {title: s["message_count"] for title, s in imported.items()} == {"Alpha": 2, "Beta": 3}
+    for title, original in (("Alpha", first), ("Beta", second)):
+        copied = client.get(f"/api/conversations/{imported[title]['id']}/messages").json()
+        kept = client.get(f"/api/conversations/{original}/messages").json()
+        assert sorted(m["content"] for m in copied) == sorted(m["content"] for m in kept)
+        assert not {m["id"] for m in copied} & {m["id"] for m in kept}
+
+
+def test_malformed_import_adds_nothing(client):
+    before = conversation_count(client)
+    lines = [
+        {"type": "conversation", "id": 1, "title": "Partial"},
+        {"type": "conversation", "id": 2, "title": "Partial"},
+        {"type": "conversation", "id": 3, "title": "Partial"},
+        {"type": "message", "conversation_id": 1, "role": "user", "content": "kept?"},
+        {"type": "message", "conversation_id": 99, "role": "user", "content": "orphan"},
+    ]
+    body = "\n".join(json.dumps(line) for line in lines)
+    response = client.post("/api/import", content=body)
+    assert response.status_code == 400 and response.json()["detail"].startswith("Line 5:")
+    assert conversation_count(client) == before
+
+    response = client.post("/api/import", content='{"type": "conversation", "id": 1}\nnot json\n')
+    assert response.status_code == 400 and response.json()["detail"].startswith("Line 2:")
+    assert conversation_count(client) == before
@@ -0,0 +1,49 @@
+"""
+Uploads: streamed to a content address, identical bytes stored once, size limit enforced
+
+Run from storage-service/: python -m pytest tests
+"""
+
+import hashlib
+
+import main
+import upload_store
+
+CSV = b"a,b\n1,2\n3,4\n"
+
+
+def upload_csv(client, content: bytes, filename: str = "data.csv"):
+    return client.post("/api/upload-csv", files={"file": (filename, content, "text/csv")})
+
+
+def test_upload_is_stored_under_its_hash(client):
+    response = upload_csv(client, CSV)
+    assert response.status_code == 200
+    body = response.json()
+    digest = hashlib.sha256(CSV).hexdigest()
+    assert body["sha256"] == digest and body["size"] == len(CSV)
+    assert body["csv_url"] == f"/uploads/{digest}.csv"
+    assert (upload_store.UPLOAD_DIR / f"{digest}.csv").read_bytes() == CSV
+
+
+def test_identical_upload_is_deduplicated(client):
+    content = b"x,y\n5,6\n"
+    first = upload_csv(client, content, "first.csv").json()
+    second = upload_csv(client, content, "second.csv").json()
+    assert second["deduplicated"] and second["csv_url"] == first["csv_url"]
+    assert second["filename"] == "second.csv"
+    assert not list(upload_store.UPLOAD_TMP_DIR.glob("*.part"))
+
+
+def test_oversized_upload_is_rejected_without_leftovers(client, monkeypatch):
+    monkeypatch.setattr(upload_store, "MAX_UPLOAD_BYTES", 1024)
+    monkeypatch.setattr(upload_store, "UPLOAD_CHUNK_BYTES", 256)
+    content = b"a\n" + b"1\n" * 1000
+    response = upload_csv(client, content)
+    assert response.status_code == 413
+    assert not (upload_store.UPLOAD_DIR / f"{hashlib.sha256(content).hexdigest()}.csv").exists()
+    assert not list(upload_store.UPLOAD_TMP_DIR.glob("*.part"))
+
+    # Content-Length alone is enough to refuse a body far over the limit
+    monkeypatch.setattr(main, "MAX_UPLOAD_BYTES", 1024)
+    assert upload_csv(client, b"a\n" + b"1\n" * 100_000).status_code == 413
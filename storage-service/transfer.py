@@ -0,0 +1,223 @@
+"""
+Streaming NDJSON export and bulk import of conversations
+
+An export is one JSON object per line: every conversation ({"type":
+"conversation", ...}) followed by every message ({"type": "message", ...}).
+Rows are streamed from the database in batches, so memory stays flat
+whatever the size of the history or its base64 plots; messages of archived
+conversations are streamed from their archive files. The rows come from one
+read transaction, a consistent snapshot that (in WAL mode) does not hold up
+writes however long the download takes.
+
+Imports read the same format from a spooled file and insert in large batches,
+each committed on its own so other writes are never held up for long; a
+failed import deletes what it had added. Conversations get new ids and their
+messages are remapped, so an export can be loaded into a database that
+already has data.
+"""
+
+import json
+import os
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+import aiofiles
+from fastapi import Request
+from sqlalchemy import delete, insert, select
+
+import models
+from archive import archived_conversation_ids, archived_lines, ndjson_line, parse_timestamp
+from database import SessionLocal
+from summaries import refresh_summaries
+from upload_store import new_temp_path
+
+EXPORT_BATCH_ROWS = int(os.getenv("EXPORT_BATCH_ROWS", "50"))  # Rows can carry MBs of base64 plots
+EXPORT_FLUSH_BYTES = int(os.getenv("EXPORT_FLUSH_BYTES", str(256 * 1024)))
+IMPORT_BATCH_ROWS = int(os.getenv("IMPORT_BATCH_ROWS", "2000"))
+IMPORT_BATCH_BYTES = int(os.getenv("IMPORT_BATCH_BYTES", str(16 * 1024 * 1024)))
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+conversations_table = models.Conversation.__table__
+messages_table = models.Message.__table__
+
+
+class ImportFormatError(ValueError):
+    """Malformed import line; what the import had added is deleted"""
+
+    def __init__(self, line_number: int, detail: str):
+        super().__init__(f"Line {line_number}: {detail}")
+
+
+def export_ndjson(conversation_id: Optional[int] = None) -> Iterator[bytes]:
+    """
+    Yield the export in ~EXPORT_FLUSH_BYTES chunks
+
+    Runs on its own session (the response outlives the request's dependencies)
+    and reads rows EXPORT_BATCH_ROWS at a time from streaming cursors, all in
+    one read transaction so no message refers to a conversation missing from it.
+    """
+    conversations = select(conversations_table).order_by(conversations_table.c.id)
+    # Archived conversations' messages come from their archive files (some may not be deleted yet)
+    live = select(conversations_table.c.id).where(conversations_table.c.archived_at.is_(None))
+    messages = select(messages_table).where(messages_table.c.conversation_id.in_(live)).order_by(messages_table.c.id)
+    if conversation_id is not None:
+        conversations = conversations.where(conversations_table.c.id == conversation_id)
+        messages = messages.where(messages_table.c.conversation_id == conversation_id)
+
+    db = SessionLocal()
+    try:
+        db.connection().exec_driver_sql("BEGIN")  # pysqlite does not open a transaction for reads
+        buffer: List[str] = []
+        buffered = 0
+        for kind, statement in (("conversation", conversations), ("message", messages)):
+            result = db.execute(statement.execution_options(stream_results=True, yield_per=EXPORT_BATCH_ROWS))
+            for row in result.mappings():
+                line = ndjson_line(kind, row)
+                buffer.append(line)
+                buffered += len(line)
+                if buffered >= EXPORT_FLUSH_BYTES:
+                    yield "".join(buffer).encode("utf-8")
+                    buffer, buffered = [], 0
+        if buffer:
+            yield "".join(buffer).encode("utf-8")
+        chunk: List[bytes] = []
+        chunked = 0
+        for archived_id in archived_conversation_ids(db, conversation_id):
+            for raw in _archived_message_lines(archived_id):
+                chunk.append(raw)
+                chunked += len(raw)
+                if chunked >= EXPORT_FLUSH_BYTES:
+                    yield b"".join(chunk)
+                    chunk, chunked = [], 0
+        if chunk:
+            yield b"".join(chunk)
+    finally:
+        db.close()
+
+
+def _archived_message_lines(conversation_id: int) -> Iterator[bytes]:
+    """Export lines of a conversation archived in the export's snapshot"""
+    try:
+        yield from archived_lines(conversation_id, missing_ok=False)
+    except FileNotFoundError:
+        # Restored since the snapshot was taken: its messages are back in the database
+        statement = select(messages_table).where(messages_table.c.conversation_id == conversation_id).order_by(messages_table.c.id)
+        with SessionLocal() as db:
+            for row in db.execute(statement.execution_options(stream_results=True, yield_per=EXPORT_BATCH_ROWS)).mappings():
+                yield ndjson_line("message", row).encode("utf-8")
+
+
+async def spool_request_body(request: Request) -> Path:
+    """Stream a request body to a temp file so the import can run in one worker thread"""
+    temp_path = new_temp_path()
+    try:
+        async with aiofiles.open(temp_path, "wb") as out:
+            async for chunk in request.stream():
+                await out.write(chunk)
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+    return temp_path
+
+
+def import_ndjson(path: Path) -> dict:
+    """Insert an NDJSON export, committing every batch; on failure the imported conversations are deleted"""
+    db = SessionLocal()
+    id_map: Dict[int, int] = {}  # Exported conversation id -> new id
+    imported_ids: List[int] = []
+    pending_conversations: List[tuple] = []  # (exported id, row)
+    pending_messages: List[dict] = []
+    pending_bytes = 0
+    counts = {"conversations": 0, "messages": 0}
+
+    def flush_conversations():
+        if not pending_conversations:
+            return
+        new_ids = db.execute(
+            insert(conversations_table).returning(conversations_table.c.id, sort_by_parameter_order=True),
+            [row for _, row in pending_conversations],
+        ).scalars().all()
+        imported_ids.extend(new_ids)
+        db.commit()
+        for (old_id, _), new_id in zip(pending_conversations, new_ids):
+            if old_id is not None:
+                id_map[old_id] = new_id
+        counts["conversations"] += len(pending_conversations)
+        pending_conversations.clear()
+
+    def flush_messages():
+        nonlocal pending_bytes
+        if not pending_messages:
+            return
+        db.execute(insert(messages_table), pending_messages)
+        refresh_summaries(db, {row["conversation_id"] for row in pending_messages})
+        db.commit()
+        counts["messages"] += len(pending_messages)
+        pending_messages.clear()
+        pending_bytes = 0
+
+    try:
+        with path.open("rb") as f:
+            for line_number, raw in enumerate(f, 1):
+                if not raw.strip():
+                    continue
+                try:
+                    record = json.loads(raw)
+                    kind = record.get("type")
+                    if kind == "conversation":
+                        pending_conversations.append((record.get("id"), {
+                            "title": record.get("title") or "New Conversation",
+                            "created_at": parse_timestamp(record.get("created_at")),
+                            "updated_at": parse_timestamp(record.get("updated_at")),
+                        }))
+                        if len(pending_conversations) >= IMPORT_BATCH_ROWS:
+                            flush_conversations()
+                    elif kind == "message":
+                        # A message may belong to a conversation still waiting in the batch
+                        flush_conversations()
+                        conversation_id = id_map.get(record.get("conversation_id"))
+                        if conversation_id is None:
+                            raise ImportFormatError(line_number, "message references a conversation not in the import")
+                        pending_messages.append({
+                            "conversation_id": conversation_id,
+                            "role": record["role"],
+                            "content": record["content"],
+                            "image_url": record.get("image_url"),
+                            "plots": record.get("plots"),
+                            "timestamp": parse_timestamp(record.get("timestamp")),
+                            "feedback": record.get("feedback"),
+                        })
+                        pending_bytes += len(raw)
+                        if len(pending_messages) >= IMPORT_BATCH_ROWS or pending_bytes >= IMPORT_BATCH_BYTES:
+                            flush_messages()
+                    else:
+                        raise ImportFormatError(line_number, f"unknown record type {kind!r}")
+                except ImportFormatError:
+                    raise
+                except (ValueError, KeyError, TypeError, AttributeError) as e:
+                    raise ImportFormatError(line_number, f"invalid record ({e})")
+        flush_conversations()
+        flush_messages()
+    except BaseException:
+        db.rollback()
+        _delete_conversations(db, imported_ids)
+        raise
+    finally:
+        db.close()
+    return counts
+
+
+def _delete_conversations(db, conversation_ids: List[int]):
+    """Delete conversations and their messages, IMPORT_BATCH_ROWS rows per transaction"""
+    c, m = conversations_table, messages_table
+    for start in range(0, len(conversation_ids), IMPORT_BATCH_ROWS):
+        ids = conversation_ids[start:start + IMPORT_BATCH_ROWS]
+        while True:
+            batch = select(m.c.id).where(m.c.conversation_id.in_(ids)).limit(IMPORT_BATCH_ROWS)
+            deleted = db.execute(delete(m).where(m.c.id.in_(batch))).rowcount
+            db.commit()
+            if not deleted:
+                break
+        db.execute(delete(c).where(c.c.id.in_(ids)))
+        db.commit()
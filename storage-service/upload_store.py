@@ -0,0 +1,247 @@
+"""
+Content-addressed storage for uploaded files
+
+Uploads are streamed to a temporary file in chunks while being hashed, then
+renamed to <sha256>.<ext>. Re-uploading identical bytes returns the existing
+file, so anything keyed on the path or hash downstream hits immediately.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import re
+import shutil
+import uuid
+from dataclasses import dataclass
+from pathlib import Path
+from typing import AsyncIterator, List, Optional, Tuple
+
+import aiofiles
+from fastapi import UploadFile
+
+UPLOAD_DIR = Path("uploads")
+# Same filesystem as UPLOAD_DIR (for atomic renames) but outside the static mount
+UPLOAD_TMP_DIR = Path(os.getenv("UPLOAD_TMP_DIR", ".upload-tmp"))
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(2 * 1024**3)))
+UPLOAD_CHUNK_BYTES = int(os.getenv("UPLOAD_CHUNK_BYTES", str(1024 * 1024)))
+
+UPLOAD_DIR.mkdir(exist_ok=True)
+UPLOAD_TMP_DIR.mkdir(exist_ok=True)
+
+CONTENT_NAME_RE = re.compile(r"^[0-9a-f]{64}\.")
+
+
+class UploadTooLarge(Exception):
+    """Raised when an upload exceeds MAX_UPLOAD_BYTES"""
+
+
+@dataclass
+class StoredFile:
+    sha256: str
+    filename: str  # Name under UPLOAD_DIR
+    path: Path
+    size: int
+    deduplicated: bool  # True if identical content was already stored
+
+    @property
+    def url(self) -> str:
+        return f"/uploads/{self.filename}"
+
+
+def safe_extension(filename: str, default: str) -> str:
+    """Lower-cased alphanumeric extension from a client-supplied filename"""
+    extension = filename.rsplit('.', 1)[-1].lower() if filename and '.' in filename else default
+    return extension if extension.isalnum() and len(extension) <= 10 else default
+
+
+def new_temp_path() -> Path:
+    return UPLOAD_TMP_DIR / f"{uuid.uuid4()}.part"
+
+
+def finalize(temp_path: Path, sha256: str, size: int, extension: str) -> StoredFile:
+    """Move a fully written temp file to its content address, or drop it if already stored"""
+    filename = f"{sha256}.{extension}"
+    final_path = UPLOAD_DIR / filename
+    try:
+        os.utime(final_path)  # Garbage collection and retention go by the latest upload
+    except FileNotFoundError:
+        pass
+    else:
+        temp_path.unlink(missing_ok=True)
+        return StoredFile(sha256, filename, final_path, size, deduplicated=True)
+    os.replace(temp_path, final_path)
+    return StoredFile(sha256, filename, final_path, size, deduplicated=False)
+
+
+async def store_upload(file: UploadFile, extension: str) -> StoredFile:
+    """Stream an upload to disk in chunks, hashing as it goes and enforcing MAX_UPLOAD_BYTES"""
+    temp_path = new_temp_path()
+    hasher = hashlib.sha256()
+    size = 0
+    try:
+        async with aiofiles.open(temp_path, "wb") as out:
+            while chunk := await file.read(UPLOAD_CHUNK_BYTES):
+                size += len(chunk)
+                if size > MAX_UPLOAD_BYTES:
+                    raise UploadTooLarge(f"File exceeds the {MAX_UPLOAD_BYTES // 1024**2} MB upload limit")
+                hasher.update(chunk)
+                await out.write(chunk)
+        return finalize(temp_path, hasher.hexdigest(), size, extension)
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+
+
+# --- Resumable chunked uploads -------------------------------------------------
+# Each upload session is a directory holding a manifest written once at init and
+# one file per received chunk. Chunks are written to a temp name and renamed, so
+# the set of *.part files is always the set of fully received chunks, even with
+# parallel PUTs, and survives restarts for resumption.
+
+CHUNKED_DIR = UPLOAD_TMP_DIR / "chunked"
+DEFAULT_CHUNK_BYTES = int(os.getenv("DEFAULT_CHUNK_BYTES", str(8 * 1024 * 1024)))
+MAX_CHUNK_BYTES = int(os.getenv("MAX_CHUNK_BYTES", str(64 * 1024 * 1024)))
+
+CHUNKED_DIR.mkdir(exist_ok=True)
+
+UPLOAD_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+_completing = set()  # Upload ids currently being assembled
+
+
+class ChunkedUploadError(Exception):
+    """Invalid chunked-upload request; carries the HTTP status to return"""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def _session_dir(upload_id: str) -> Path:
+    if not UPLOAD_ID_RE.match(upload_id):
+        raise ChunkedUploadError(404, "Upload not found")
+    session_dir = CHUNKED_DIR / upload_id
+    if not (session_dir / "manifest.json").exists():
+        raise ChunkedUploadError(404, "Upload not found")
+    return session_dir
+
+
+def load_manifest(upload_id: str) -> dict:
+    with (_session_dir(upload_id) / "manifest.json").open() as f:
+        return json.load(f)
+
+
+def received_chunks(upload_id: str) -> List[int]:
+    session_dir = _session_dir(upload_id)
+    return sorted(int(p.stem) for p in session_dir.glob("*.part"))
+
+
+def create_chunked_upload(filename: str, size: int, chunk_size: Optional[int], sha256: Optional[str]) -> dict:
+    """Start an upload session and return its manifest"""
+    if size <= 0:
+        raise ChunkedUploadError(400, "size must be positive")
+    if size > MAX_UPLOAD_BYTES:
+        raise ChunkedUploadError(413, f"File exceeds the {MAX_UPLOAD_BYTES // 1024**2} MB upload limit")
+    chunk_size = chunk_size or DEFAULT_CHUNK_BYTES
+    if not 0 < chunk_size <= MAX_CHUNK_BYTES:
+        raise ChunkedUploadError(400, f"chunk_size must be between 1 and {MAX_CHUNK_BYTES} bytes")
+    if sha256 is not None and not re.fullmatch(r"[0-9a-f]{64}", sha256.lower()):
+        raise ChunkedUploadError(400, "sha256 must be a hex SHA-256 digest")
+
+    manifest = {
+        "upload_id": uuid.uuid4().hex,
+        "filename": filename,
+        "size": size,
+        "chunk_size": chunk_size,
+        "total_chunks": (size + chunk_size - 1) // chunk_size,
+        "sha256": sha256.lower() if sha256 else None,
+    }
+    session_dir = CHUNKED_DIR / manifest["upload_id"]
+    session_dir.mkdir()
+    with (session_dir / "manifest.json").open("w") as f:
+        json.dump(manifest, f)
+    return manifest
+
+
+def expected_chunk_size(manifest: dict, index: int) -> int:
+    if not 0 <= index < manifest["total_chunks"]:
+        raise ChunkedUploadError(400, f"Chunk index must be between 0 and {manifest['total_chunks'] - 1}")
+    if index < manifest["total_chunks"] - 1:
+        return manifest["chunk_size"]
+    return manifest["size"] - manifest["chunk_size"] * (manifest["total_chunks"] - 1)
+
+
+async def store_chunk(upload_id: str, index: int, body: AsyncIterator[bytes], checksum: Optional[str]) -> dict:
+    """Write one chunk from a streamed request body, verifying its length and optional SHA-256"""
+    manifest = load_manifest(upload_id)
+    expected = expected_chunk_size(manifest, index)
+    session_dir = CHUNKED_DIR / upload_id
+    temp_path = session_dir / f"{index}.{uuid.uuid4().hex}.tmp"
+    hasher = hashlib.sha256()
+    size = 0
+    try:
+        async with aiofiles.open(temp_path, "wb") as out:
+            async for data in body:
+                size += len(data)
+                if size > expected:
+                    raise ChunkedUploadError(400, f"Chunk {index} is larger than the expected {expected} bytes")
+                hasher.update(data)
+                await out.write(data)
+        if size != expected:
+            raise ChunkedUploadError(400, f"Chunk {index} has {size} bytes, expected {expected}")
+        digest = hasher.hexdigest()
+        if checksum and checksum.lower() != digest:
+            raise ChunkedUploadError(422, f"Checksum mismatch for chunk {index}")
+        os.replace(temp_path, session_dir / f"{index}.part")
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+    return {"index": index, "size": size, "sha256": digest}
+
+
+def _assemble(upload_id: str, manifest: dict) -> StoredFile:
+    session_dir = CHUNKED_DIR / upload_id
+    temp_path = new_temp_path()
+    hasher = hashlib.sha256()
+    try:
+        with temp_path.open("wb") as out:
+            for index in range(manifest["total_chunks"]):
+                with (session_dir / f"{index}.part").open("rb") as chunk:
+                    while data := chunk.read(UPLOAD_CHUNK_BYTES):
+                        hasher.update(data)
+                        out.write(data)
+        digest = hasher.hexdigest()
+        if manifest["sha256"] and manifest["sha256"] != digest:
+            raise ChunkedUploadError(422, "Checksum mismatch for the assembled file")
+        stored = finalize(temp_path, digest, manifest["size"], safe_extension(manifest["filename"], "csv"))
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+    shutil.rmtree(session_dir, ignore_errors=True)
+    return stored
+
+
+async def complete_chunked_upload(upload_id: str) -> Tuple[dict, StoredFile]:
+    """Assemble all chunks into the content-addressed store and drop the session"""
+    manifest = load_manifest(upload_id)
+    missing = sorted(set(range(manifest["total_chunks"])) - set(received_chunks(upload_id)))
+    if missing:
+        raise ChunkedUploadError(409, f"Missing chunks: {missing[:20]}{'...' if len(missing) > 20 else ''}")
+    if upload_id in _completing:
+        raise ChunkedUploadError(409, "Upload is already being completed")
+    _completing.add(upload_id)
+    try:
+        # Sequential copy + hash of a multi-GB file; keep it off the event loop
+        stored = await asyncio.to_thread(_assemble, upload_id, manifest)
+    finally:
+        _completing.discard(upload_id)
+    return manifest, stored
+
+
+def is_completing(upload_id: str) -> bool:
+    return upload_id in _completing
+
+
+def abort_chunked_upload(upload_id: str):
+    shutil.rmtree(_session_dir(upload_id), ignore_errors=True)